@@ -2,8 +2,10 @@
 
 import codecs
 import os
+import sys
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 
 here = os.path.abspath(os.path.dirname(__file__))
 with codecs.open(os.path.join(here, 'README.rst'), encoding='utf-8') as f:
@@ -12,6 +14,19 @@ with codecs.open(os.path.join(here, 'README.rst'), encoding='utf-8') as f:
 with codecs.open('requirements.txt', 'r', 'utf-8') as f:
     requirements = [x.strip() for x in f.read().splitlines() if x.strip()]
 
+
+class BuildPy(build_py):
+    # Пул asyncio написан на async/await: в сборку под python до 3.5 модуль не попадает,
+    # иначе установка падает на компиляции в байткод
+    PY3_ONLY_MODULES = ('asyncio_pool',)
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [x for x in modules if x[1] not in self.PY3_ONLY_MODULES]
+        return modules
+
+
 setup(
     name='shire',
     version='0.2.1',
@@ -24,6 +39,7 @@ setup(
     packages=find_packages(include=['shire']),
     data_files=[('.', ['requirements.txt', 'README.rst'], ), ],
     install_requires=requirements,
+    cmdclass={'build_py': BuildPy},
     entry_points={
         'console_scripts': ['shire-cli=shire.cli:cli']
     },
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Только для python 3.5+, импортируется в shire.pool_starter по условию
+import asyncio
+import functools
+import os
+import signal
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from shire.redis_managers import PoolStatusManager
+from shire.thread_pool import ThreadPool
+from shire.workhorse import ThreadWorkhorse, WorkhorseStatusContext
+from shire.utils import capture_thread_output
+
+
+__all__ = ['AsyncioPool']
+
+
+class AsyncioWorkhorse(ThreadWorkhorse):
+    # Корутины (async def run) выполняются в цикле событий пула, обычные задачи и работа с базой - в пуле потоков.
+    # Вывод корутин не перехватывается: они разделяют один поток
+
+    def __init__(self, pool, job_id):
+        super(AsyncioWorkhorse, self).__init__(pool=pool, job_id=job_id)
+        self.loop = pool.loop
+        self.executor = pool.executor
+
+    def in_executor(self, func, *args, **kwargs):
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def run_sync_job(self, job, args, kwargs):
+        stream = self.create_output()
+        try:
+            with capture_thread_output(stream):
+                job.run(*args, **kwargs)
+        finally:
+            stream.close()
+
+    async def run_async(self):
+        self.job_entry = await self.in_executor(self._load_from_db)
+        self.prepare_environment()
+        job = self.job_entry.get_job_cls(by_module=self.import_by_module)(workhorse=self)
+        args, kwargs = self.job_entry.get_params()
+        context = WorkhorseStatusContext(workhorse=self)
+        await self.in_executor(context.__enter__)
+        try:
+            if asyncio.iscoroutinefunction(job.run):
+                await job.run(*args, **kwargs)
+            else:
+                await self.in_executor(self.run_sync_job, job, args, kwargs)
+        except Exception:
+            if not await self.in_executor(context.__exit__, *sys.exc_info()):
+                raise
+        else:
+            await self.in_executor(context.__exit__, None, None, None)
+
+    async def execute_async(self):
+        try:
+            await self.run_async()
+        except Exception:
+            self.log.exception('In job #{} with workhorse uuid {} (pool {}/{})'.format(
+                self.job_id, self.uuid, self.pool.name, self.pool.uuid))
+            return False
+        return True
+
+
+class AsyncioPool(ThreadPool):
+    # Пул с циклом событий asyncio: async def run выполняется нативно, сотни задач в одном процессе
+    BACKEND_NAME = 'asyncio'
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncioPool, self).__init__(*args, **kwargs)
+        self.loop = None
+        self.executor = None
+        self._tasks = set()
+        self._stopping = False
+
+    def run(self):
+        self.prepare_process()
+        self.pool_log('Asyncio pool "{}" started'.format(self.name))
+        self.pool_log('Max jobs: {}'.format(self.max_workhorses))
+        self.pool_log('Redis check timeout: {}s'.format(self.check_time))
+        self.loop = asyncio.get_event_loop()
+        # +1 поток на ожидание задач из очереди
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workhorses + 1)
+        self.set_status(PoolStatusManager.STATUS_ACTIVE)
+        # Обработчик через цикл событий: ожидание задач не должно блокировать цикл
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        # Как и в ThreadPool: предупреждения отключены только на время работы пула
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.loop.run_until_complete(self._main())
+        self.set_status(PoolStatusManager.STATUS_TERMITATED)
+        self.log.flush()
+        sys.exit(0)
+
+    def stop(self):
+        self._stopping = True
+
+    def kill_children(self):
+        # Потоки ThreadPoolExecutor интерпретатор дожидается при выходе, и sys.exit ждал бы синхронные задачи.
+        # Поэтому после записи статуса и логов процесс завершается сразу, без finally и atexit;
+        # незавершенные задачи перезапустит hostler
+        self.pool_log('Pool "{}" killed with {} running jobs'.format(self.name, self._get_children_count()))
+        self.set_status(PoolStatusManager.STATUS_TERMITATED)
+        self.log.flush()
+        os._exit(1)
+
+    def _in_executor(self, func, *args, **kwargs):
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _main(self):
+        while True:
+            if self._get_children_count() >= self.max_workhorses and not self._stopping:
+                await asyncio.sleep(self.sleep_time)
+                continue
+            key = job_id = None
+            if not self._stopping:
+                key, pool, job_id = await self._in_executor(self.pop_queued_job)
+            await self._in_executor(self.refresh_jobs)
+            status = await self._in_executor(lambda: self.status)
+            if self._stopping or status in (PoolStatusManager.STATUS_DEAD, PoolStatusManager.STATUS_KILL):
+                if job_id:
+                    await self._in_executor(self._queue_manager.push_back, key, job_id)
+                if status == PoolStatusManager.STATUS_KILL:
+                    self.kill_children()
+                if self._tasks:
+                    await asyncio.wait(self._tasks)
+                return
+            if job_id:
+                self._start_workhorse(job_id)
+
+    def _start_workhorse(self, job_id):
+        self.pool_log('Task for job #{} started'.format(job_id))
+        task = asyncio.ensure_future(AsyncioWorkhorse(pool=self, job_id=job_id).execute_async())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _get_children_count(self):
+        return len(self._tasks)
@@ -8,17 +8,19 @@ import tabulate
 
 from shire.config import Config
 from shire.hostler import Hostler
-from shire.models import JobEntry, Queue, Limit, Crontab
+from shire.models import JobEntry, JobEntryArchive, Queue, Limit, Crontab, create_indexes, migrate_db as migrate_models
 from shire.manager import ShireManager
-from shire.pool import Pool
-from shire.pool_starter import PoolStarter
+from shire.multi_pool import MultiPool
+from shire.pool_starter import PoolStarter, create_pool
+from shire.recorder import Recorder
+from shire.scheduler import Scheduler
 from shire.scribe import Scribe
 from shire.whip import Whip
 from shire.utils import to_list, is_venv
 
 __all__ = ['cli']
 
-SHIRE_MODELS = (JobEntry, Queue, Limit, Crontab)  # TODO автогенерить?
+SHIRE_MODELS = (JobEntry, JobEntryArchive, Queue, Limit, Crontab)  # TODO автогенерить?
 
 
 @click.group()
@@ -46,6 +48,24 @@ def init_db(ctx):
         for model in SHIRE_MODELS:
             model.create_table(fail_silently=True)
             print('Table {} created'.format(model.__name__))
+        for name in create_indexes():
+            print('Index {} created'.format(name))
+
+
+@cli.command()
+@click.pass_context
+def migrate_db(ctx):
+    # Обновление существующей базы: недостающие колонки и индексы
+    with ctx.obj['cfg'].with_db():
+        for model in SHIRE_MODELS:
+            if not model.table_exists():
+                model.create_table()
+                print('Table {} created'.format(model.__name__))
+        columns, indexes = migrate_models()
+        for name in columns:
+            print('Column {} added'.format(name))
+        for name in indexes:
+            print('Index {} created'.format(name))
 
 
 @cli.command()
@@ -156,15 +176,42 @@ def create_config(
 @click.option('-n', '--name', type=click.STRING)
 @click.pass_context
 def run_pool(ctx, name):
-    pool = Pool(config=ctx.obj['cfg'], name=name, verbose=ctx.obj['verbose'])
+    pool = create_pool(config=ctx.obj['cfg'], name=name, verbose=ctx.obj['verbose'])
+    pool.run()
+
+
+def parse_weights(names, weights):
+    if not weights:
+        return None
+    weights = [int(weight) for weight in to_list(weights)]
+    if len(weights) != len(names) or min(weights) < 1:
+        raise click.BadParameter(u'Weights should be positive integers, one per pool name', param_hint='--weights')
+    return dict(zip(names, weights))
+
+
+@cli.command()
+@click.option('-n', '--names', type=click.STRING)
+@click.option('-w', '--weights', type=click.STRING, default=None)
+@click.pass_context
+def run_multi_pool(ctx, names, weights):
+    names = to_list(names)
+    pool = MultiPool(
+        config=ctx.obj['cfg'], names=names, weights=parse_weights(names, weights), verbose=ctx.obj['verbose']
+    )
     pool.run()
 
 
 @cli.command()
 @click.option('-n', '--names', type=click.STRING)
+@click.option('-m', '--multi', is_flag=True)
+@click.option('-w', '--weights', type=click.STRING, default=None)
 @click.pass_context
-def start_pools(ctx, names):
-    starter = PoolStarter(config=ctx.obj['cfg'], pools=to_list(names), config_path=ctx.obj['config_path'])
+def start_pools(ctx, names, multi, weights):
+    names = to_list(names)
+    starter = PoolStarter(
+        config=ctx.obj['cfg'], pools=names, config_path=ctx.obj['config_path'], multi=multi,
+        weights=parse_weights(names, weights)
+    )
     starter.run()
 
 
@@ -182,6 +229,20 @@ def run_hostler(ctx):
     hostler.run()
 
 
+@cli.command()
+@click.pass_context
+def run_recorder(ctx):
+    recorder = Recorder(config=ctx.obj['cfg'], verbose=ctx.obj['verbose'])
+    recorder.run()
+
+
+@cli.command()
+@click.pass_context
+def run_scheduler(ctx):
+    scheduler = Scheduler(config=ctx.obj['cfg'], verbose=ctx.obj['verbose'])
+    scheduler.run()
+
+
 @cli.command()
 @click.pass_context
 def run_scribe(ctx):
@@ -217,11 +278,26 @@ def manager(ctx, command, pools, statuses):
 
 @cli.command()
 @click.option('-d', '--days_ago', type=click.INT, default=7)
+@click.option('-b', '--batch_size', type=click.INT, default=500)
+@click.option('-p', '--pause', type=click.FLOAT, default=0.1)
 @click.pass_context
-def cleanup_old_jobs(ctx, days_ago):
+def cleanup_old_jobs(ctx, days_ago, batch_size, pause):
     with ctx.obj['cfg'].with_db():
         from shire.utils import cleanup_old_jobs
-        cleanup_old_jobs(days_ago=days_ago)
+        cleanup_old_jobs(days_ago=days_ago, batch_size=batch_size, pause=pause)
+
+
+@cli.command()
+@click.option('-m', '--minutes_ago', type=click.INT, default=60)
+@click.option('-b', '--batch_size', type=click.INT, default=500)
+@click.option('-p', '--pause', type=click.FLOAT, default=0.1)
+@click.pass_context
+def archive_jobs(ctx, minutes_ago, batch_size, pause):
+    # Перенос завершенных задач всех хостов в shire_job_archive
+    with ctx.obj['cfg'].with_db():
+        from shire.utils import archive_ended_jobs
+        count = archive_ended_jobs(minutes_ago=minutes_ago, batch_size=batch_size, pause=pause)
+        print('{} jobs archived'.format(count))
 
 
 @cli.command()
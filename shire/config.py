@@ -21,6 +21,16 @@ class Config(dict):
     SHIRE_VENV_PATH_DEFAULT = ''
     SHIRE_VENV_EXCLUSIVE = 'venv_path'
     SHIRE_VENV_EXCLUSIVE_DEFAULT = None
+    SHIRE_DELAY_QUEUE = 'delay_queue'
+    SHIRE_DELAY_QUEUE_DEFAULT = '0'
+    SHIRE_IMPORT_BY_MODULE = 'import_by_module'
+    SHIRE_IMPORT_BY_MODULE_DEFAULT = '0'
+    SHIRE_JOB_EVENTS = 'job_events'  # 1 - статусы задач пишет в базу recorder, а не каждый workhorse
+    SHIRE_JOB_EVENTS_DEFAULT = '0'
+    SHIRE_HEARTBEAT = 'heartbeat'  # 1 - выполняющиеся задачи отмечаются в redis, hostler проверяет только просроченные
+    SHIRE_HEARTBEAT_DEFAULT = '0'
+    SHIRE_HEARTBEAT_TIME = 'heartbeat_time'
+    SHIRE_HEARTBEAT_TIME_DEFAULT = '10'
 
     CONNECTION_SECTION = 'connection'
     CONNECTION_DB_URL = 'db_url'
@@ -31,6 +41,27 @@ class Config(dict):
     POOL_SECTION = 'pool'
     POOL_CHECK_TIME = 'check_time'
     POOL_CHECK_TIME_DEFAULT = '30'
+    POOL_NAMED_SECTION = 'pool:{name}'  # персональные настройки пула, перекрывают секцию pool
+    POOL_MAX_WORKHORSES = 'max_workhorses'
+    POOL_MAX_WORKHORSES_DEFAULT = '0'  # без ограничения
+    POOL_BACKEND = 'backend'
+    POOL_BACKEND_FORK = 'fork'
+    POOL_BACKEND_PREFORK = 'prefork'
+    POOL_BACKEND_THREAD = 'thread'
+    POOL_BACKEND_ASYNCIO = 'asyncio'
+    POOL_BACKEND_DEFAULT = POOL_BACKEND_FORK
+    POOL_WORKER_MAX_JOBS = 'worker_max_jobs'
+    POOL_WORKER_MAX_JOBS_DEFAULT = '1000'
+    POOL_WORKER_MAX_RSS = 'worker_max_rss'
+    POOL_WORKER_MAX_RSS_DEFAULT = '0'  # мегабайт, 0 - не проверять
+    POOL_TICK_INTERVAL = 'tick_interval'  # Job.tick пишет в базу не чаще, секунд
+    POOL_TICK_INTERVAL_DEFAULT = '30'
+    POOL_REFRESH_TIME = 'refresh_time'  # пул сам обновляет updated_at задач живых потомков, секунд, 0 - нет
+    POOL_REFRESH_TIME_DEFAULT = '0'
+    POOL_OUTPUT_MAX_SIZE = 'output_max_size'  # вывода задачи в лог, символов, 0 - без ограничения
+    POOL_OUTPUT_MAX_SIZE_DEFAULT = '0'
+    POOL_OUTPUT_TRUNCATE = 'output_truncate'  # head - сохранять начало вывода, tail - конец
+    POOL_OUTPUT_TRUNCATE_DEFAULT = 'head'
     
     SCRIBE_SECTION = 'scribe'
     SCRIBE_PER_POOL = 'per_pool'
@@ -45,10 +76,56 @@ class Config(dict):
     SCRIBE_MAX_SIZE_DEFAULT = str(100 * 1024 * 1024)  # 100 мегабайт
     SCRIBE_MAX_LOGS = 'max_logs'
     SCRIBE_MAX_LOGS_DEFAULT = '5'
+    SCRIBE_CONSUMER = 'consumer'  # имя в группе потребителей потока, по умолчанию <hostname>:<pid>
+    SCRIBE_CLAIM_TIME = 'claim_time'  # записи упавшего scribe, не подтвержденные дольше, забирают другие, секунд
+    SCRIBE_CLAIM_TIME_DEFAULT = '60'
+    SCRIBE_BATCH_SIZE = 'batch_size'
+    SCRIBE_BATCH_SIZE_DEFAULT = '100'
+
+    LOGGER_SECTION = 'logger'
+    LOGGER_BUFFERED = 'buffered'
+    LOGGER_BUFFERED_DEFAULT = '0'
+    LOGGER_BUFFER_SIZE = 'buffer_size'
+    LOGGER_BUFFER_SIZE_DEFAULT = '10000'
+    LOGGER_FLUSH_SIZE = 'flush_size'
+    LOGGER_FLUSH_SIZE_DEFAULT = '100'
+    LOGGER_FLUSH_TIME = 'flush_time'
+    LOGGER_FLUSH_TIME_DEFAULT = '0.5'
+    LOGGER_OVERFLOW = 'overflow'
+    LOGGER_OVERFLOW_BLOCK = 'block'
+    LOGGER_OVERFLOW_DROP = 'drop'
+    LOGGER_OVERFLOW_DEFAULT = LOGGER_OVERFLOW_BLOCK
+    LOGGER_TRANSPORT = 'transport'
+    LOGGER_TRANSPORT_LIST = 'list'
+    LOGGER_TRANSPORT_STREAM = 'stream'
+    LOGGER_TRANSPORT_DEFAULT = LOGGER_TRANSPORT_LIST
+    LOGGER_STREAM_MAX_LENGTH = 'stream_max_length'
+    LOGGER_STREAM_MAX_LENGTH_DEFAULT = '100000'
 
     HOSTLER_SECTION = 'hostler'
     HOSTLER_CHECK_TIME = 'check_time'
     HOSTLER_CHECK_TIME_DEFAULT = '5'
+    HOSTLER_HEARTBEAT_TIMEOUT = 'heartbeat_timeout'
+    HOSTLER_HEARTBEAT_TIMEOUT_DEFAULT = '60'
+    HOSTLER_STALE_CHECK_TIME = 'stale_check_time'  # при heartbeat - проверка зависших задач по базе, секунд
+    HOSTLER_STALE_CHECK_TIME_DEFAULT = '300'
+    HOSTLER_ARCHIVE_AFTER = 'archive_after'  # минут после завершения, 0 - не архивировать
+    HOSTLER_ARCHIVE_AFTER_DEFAULT = '0'
+    HOSTLER_ARCHIVE_TIME = 'archive_time'
+    HOSTLER_ARCHIVE_TIME_DEFAULT = '60'
+    HOSTLER_ARCHIVE_BATCH_SIZE = 'archive_batch_size'
+    HOSTLER_ARCHIVE_BATCH_SIZE_DEFAULT = '500'
+
+    RECORDER_SECTION = 'recorder'
+    RECORDER_CONSUMER = 'consumer'  # по умолчанию <hostname>:<pid>
+    RECORDER_BATCH_SIZE = 'batch_size'
+    RECORDER_BATCH_SIZE_DEFAULT = '1000'
+    RECORDER_FLUSH_TIME = 'flush_time'
+    RECORDER_FLUSH_TIME_DEFAULT = '0.2'
+
+    SCHEDULER_SECTION = 'scheduler'
+    SCHEDULER_RELOAD_TIME = 'reload_time'  # как быстро подхватываются измененные кронтабы, секунд
+    SCHEDULER_RELOAD_TIME_DEFAULT = '60'
 
     WHIP_SECTION = 'whip'
     WHIP_CHECK_TIME = 'check_time'
@@ -57,6 +134,20 @@ class Config(dict):
     WHIP_LIMITS_UPDATE_TIME_DEFAULT = '60'
     WHIP_MAX_JOBS = 'max_jobs'
     WHIP_MAX_JOBS_DEFAULT = '100'
+    WHIP_BATCH_SIZE = 'batch_size'
+    WHIP_BATCH_SIZE_DEFAULT = '100'
+    WHIP_RECONCILE_TIME = 'reconcile_time'
+    WHIP_RECONCILE_TIME_DEFAULT = '60'
+    # 1 - whip ждет сигналов от start_job/start_jobs вместо опроса базы каждые check_time секунд.
+    # Задачи, добавленные в базу в обход них, ставятся только при опросе раз в poll_time секунд
+    WHIP_WAKEUP = 'wakeup'
+    WHIP_WAKEUP_DEFAULT = '0'
+    WHIP_POLL_TIME = 'poll_time'
+    WHIP_POLL_TIME_DEFAULT = '30'
+    # 1 - несколько whip на хост захватывают задачи через SKIP LOCKED (Postgres, MySQL 8+).
+    # По умолчанию выключено: MySQL до 8.0 отвергает FOR UPDATE SKIP LOCKED синтаксической ошибкой
+    WHIP_SKIP_LOCKED = 'skip_locked'
+    WHIP_SKIP_LOCKED_DEFAULT = '0'
 
     def __init__(self, *args, **kwargs):
         self.cp = configparser.ConfigParser()
@@ -155,6 +246,26 @@ class Config(dict):
     def from_section(self, section, key, default=None):
         return self.get(section, {}).get(key, default)
 
+    def pool_section_getter(self, name):
+        named_section = self.POOL_NAMED_SECTION.format(name=name)
+        return type('_', (object,), {'get': lambda s, key, default=None: self.from_section(
+            named_section, key, self.from_section(self.POOL_SECTION, key, default)
+        )})()
+
+    def use_log_stream(self):
+        return self.from_section(
+            self.LOGGER_SECTION, self.LOGGER_TRANSPORT, self.LOGGER_TRANSPORT_DEFAULT
+        ) == self.LOGGER_TRANSPORT_STREAM
+
+    def use_delay_queue(self):
+        return self.from_section(self.SHIRE_SECTION, self.SHIRE_DELAY_QUEUE, self.SHIRE_DELAY_QUEUE_DEFAULT) == '1'
+
+    def use_job_events(self):
+        return self.from_section(self.SHIRE_SECTION, self.SHIRE_JOB_EVENTS, self.SHIRE_JOB_EVENTS_DEFAULT) == '1'
+
+    def use_heartbeat(self):
+        return self.from_section(self.SHIRE_SECTION, self.SHIRE_HEARTBEAT, self.SHIRE_HEARTBEAT_DEFAULT) == '1'
+
     def section_getter(self, section):
         return type('_', (object,), {'get': lambda s, key, default=None: self.from_section(section, key, default)})()
 
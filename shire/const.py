@@ -1,3 +1,7 @@
 # -*- coding: utf-8 -*-
 
 SHIRE_WORKHORSE_PROCESS_NAME = 'shire_workhorse_process'
+
+# Приоритеты задач: чем больше, тем раньше задача будет выбрана из очереди пула
+JOB_PRIORITY_MIN = 0
+JOB_PRIORITY_MAX = 9
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+from shire.redis_managers import HeartbeatManager
+
+
+__all__ = ['Heartbeat', 'get_heartbeat']
+
+
+class Heartbeat(object):
+    # Поток, раз в interval секунд отмечающий в redis все выполняющиеся в процессе задачи.
+    # Один на процесс: потоки не переживают fork, поэтому в дочернем процессе создается заново
+
+    def __init__(self, connection, interval):
+        self.manager = HeartbeatManager(connection)
+        self.interval = interval
+        self.pid = os.getpid()
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, job_id, host):
+        with self._lock:
+            self.jobs[job_id] = host
+            # Под блокировкой: в пуле потоков задачи стартуют одновременно, поток отметок должен быть один
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='shire_heartbeat')
+                self._thread.daemon = True
+                self._thread.start()
+        self.manager.beat({job_id: host})
+
+    def remove(self, job_id, keep_mark=False):
+        # keep_mark - только перестать отмечать задачу, последняя отметка в redis остается
+        with self._lock:
+            host = self.jobs.pop(job_id, None)
+        if host is not None and not keep_mark:
+            self.manager.remove(host, [job_id])
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                jobs = dict(self.jobs)
+            try:
+                self.manager.beat(jobs)
+            except Exception:
+                # Недоступность redis не должна останавливать отметки насовсем - повторим через interval.
+                # Если отметок не будет дольше таймаута hostler, он проверит процесс задачи
+                pass
+
+
+_heartbeat = None
+_heartbeat_lock = threading.Lock()
+
+
+def get_heartbeat(connection, interval):
+    global _heartbeat
+    with _heartbeat_lock:
+        if _heartbeat is None or _heartbeat.pid != os.getpid():
+            _heartbeat = Heartbeat(connection, interval)
+        return _heartbeat
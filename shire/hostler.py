@@ -3,8 +3,9 @@ import datetime
 import time
 import sys
 
-from shire.models import db, JobEntry
-from shire.utils import check_pid_is_shire, create_console_handler, create_logger
+from shire.models import db, JobEntry, JobEntryArchive
+from shire.redis_managers import HeartbeatManager, JobCounterManager, WakeupManager
+from shire.utils import archive_ended_jobs, check_pid_is_shire, create_console_handler, create_logger
 
 
 __all__ = ['Hostler']
@@ -16,6 +17,9 @@ class Hostler(object):
     # в ущерб стабильности
 
     CHECK_MINUTES = 5  # Задачи не обновлявшиеся с какого времени проверять
+    ARCHIVE_MAX_BATCHES = 10  # Не больше пачек архивации за один проход, что бы не задерживать проверку задач
+    ARCHIVE_PAUSE = 0.1
+    HEARTBEAT_CHECK_COUNT = 500  # Просроченных отметок за один проход
 
     def __init__(self, config, verbose=False):
         self.config = config
@@ -29,6 +33,28 @@ class Hostler(object):
             self.config.SHIRE_HOST, self.config.SHIRE_HOST_DEFAULT
         )
         self.already_checked = {}
+        self.archive_after = int(self.section.get(
+            self.config.HOSTLER_ARCHIVE_AFTER, self.config.HOSTLER_ARCHIVE_AFTER_DEFAULT
+        ))
+        self.archive_time = float(self.section.get(
+            self.config.HOSTLER_ARCHIVE_TIME, self.config.HOSTLER_ARCHIVE_TIME_DEFAULT
+        ))
+        self.archive_batch_size = int(self.section.get(
+            self.config.HOSTLER_ARCHIVE_BATCH_SIZE, self.config.HOSTLER_ARCHIVE_BATCH_SIZE_DEFAULT
+        ))
+        self.last_archived = 0
+        redis = self.config.get_redis()
+        self.counters = JobCounterManager(redis)
+        self.wakeup = WakeupManager(redis)
+        self.use_heartbeat = self.config.use_heartbeat()
+        self.heartbeats = HeartbeatManager(redis)
+        self.heartbeat_timeout = float(self.section.get(
+            self.config.HOSTLER_HEARTBEAT_TIMEOUT, self.config.HOSTLER_HEARTBEAT_TIMEOUT_DEFAULT
+        ))
+        self.stale_check_time = float(self.section.get(
+            self.config.HOSTLER_STALE_CHECK_TIME, self.config.HOSTLER_STALE_CHECK_TIME_DEFAULT
+        ))
+        self.last_stale_check = 0
 
     def hostler_log(self, msg, level='info'):
         if not self.verbose:
@@ -38,18 +64,84 @@ class Hostler(object):
     def restart_job(self, job_entry):
         self.hostler_log('Task #{} restarted'.format(job_entry.id))
         job_entry.status = JobEntry.STATUS_RESTART
+        # Счетчик - до записи статуса, см. Whip.reconcile_current_jobs
+        self.counters.incr_completed({(job_entry.pool, job_entry.queue): 1})
         job_entry.save(only=[JobEntry.status])
+        self.wakeup.notify(host=self.host, pool=job_entry.pool)
 
-    def loop(self):
+    def archive(self):
+        # Завершенные задачи своего хоста переносятся в архив небольшими пачками
+        if not self.archive_after or time.time() - self.last_archived < self.archive_time:
+            return
+        if not JobEntryArchive.table_exists():
+            # Таблицу архива создает migrate_db. Без нее задачи остаются в shire_job, проверим снова через archive_time
+            self.hostler_logger.warning('Table {} does not exist, run migrate_db to archive ended jobs'.format(
+                JobEntryArchive._meta.db_table
+            ))
+            self.last_archived = time.time()
+            return
+        count = archive_ended_jobs(
+            minutes_ago=self.archive_after, host=self.host, batch_size=self.archive_batch_size,
+            pause=self.ARCHIVE_PAUSE, max_batches=self.ARCHIVE_MAX_BATCHES
+        )
+        if count:
+            self.hostler_log('{} ended jobs archived'.format(count))
+        if count < self.archive_batch_size * self.ARCHIVE_MAX_BATCHES:
+            # Архив догнали - следующий проход через archive_time, иначе продолжаем на следующей итерации
+            self.last_archived = time.time()
+
+    def check_stale_jobs(self):
         last_updated = datetime.datetime.now() - datetime.timedelta(minutes=self.CHECK_MINUTES)
-        for job_entry in JobEntry.select(JobEntry.id, JobEntry.status, JobEntry.worker_pid).where(
-                                (JobEntry.status == JobEntry.STATUS_IN_PROGRESS) &
-                                (JobEntry.updated_at < last_updated) & (JobEntry.host == self.host)
+        for job_entry in JobEntry.select(
+                JobEntry.id, JobEntry.pool, JobEntry.queue, JobEntry.status, JobEntry.worker_pid
+        ).where(
+                (JobEntry.status == JobEntry.STATUS_IN_PROGRESS) &
+                (JobEntry.updated_at < last_updated) & (JobEntry.host == self.host)
         ):
             if job_entry.id not in self.already_checked or self.already_checked[job_entry.id] < last_updated:
                 if not check_pid_is_shire(job_entry.worker_pid):
                     self.restart_job(job_entry)
                 self.already_checked[job_entry.id] = datetime.datetime.now()
+        # Проверенные раньше last_updated все равно проверяются заново - не храним их
+        self.already_checked = {
+            job_id: checked_at for job_id, checked_at in self.already_checked.items() if checked_at >= last_updated
+        }
+
+    def check_heartbeats(self):
+        # Проверяются только задачи с просроченной отметкой, а не все выполняющиеся
+        expired = self.heartbeats.get_expired(
+            self.host, time.time() - self.heartbeat_timeout, count=self.HEARTBEAT_CHECK_COUNT
+        )
+        if not expired:
+            return
+        checked = set(expired)
+        for job_entry in JobEntry.select(
+                JobEntry.id, JobEntry.pool, JobEntry.queue, JobEntry.status, JobEntry.worker_pid
+        ).where(JobEntry.id << expired):
+            if job_entry.status != JobEntry.STATUS_IN_PROGRESS:
+                # Задача завершилась, а отметку не успели удалить
+                continue
+            if check_pid_is_shire(job_entry.worker_pid):
+                # Процесс жив, но не отмечается - проверим снова на следующем проходе
+                checked.discard(job_entry.id)
+                continue
+            self.restart_job(job_entry)
+        self.heartbeats.remove(self.host, list(checked))
+
+    def check_jobs(self):
+        if not self.use_heartbeat:
+            self.check_stale_jobs()
+            return
+        self.check_heartbeats()
+        if time.time() - self.last_stale_check >= self.stale_check_time:
+            # Редкая проверка по базе для выполняющихся задач без отметки: процесс упал до первой отметки,
+            # redis потерял данные или задача запущена до включения heartbeat
+            self.check_stale_jobs()
+            self.last_stale_check = time.time()
+
+    def loop(self):
+        self.check_jobs()
+        self.archive()
         time.sleep(float(
             self.section.get(self.config.HOSTLER_CHECK_TIME, self.config.HOSTLER_CHECK_TIME_DEFAULT)
         ))
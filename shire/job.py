@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
 import datetime
+import json
 import sys
 import time
 
 from shire.exceptions import RestartJobException
-from shire.models import JobEntry, Crontab
+from shire.models import db, JobEntry, Crontab
 from shire.pool import Pool
+from shire.redis_managers import DelayQueueManager, WakeupManager
 from shire.workhorse import Workhorse
 
 __all__ = ['Job', 'RestartJobException']
 
 
 class DummyWorkhorse(Workhorse):
+    # Задачи выполняются сразу, минуя whip: в счетчике enqueued их нет, завершение тоже не учитываем
+    COUNT_COMPLETED = False
+
     def __init__(self, config):
         pool = Pool(config, 'dummy_pool')
         super(DummyWorkhorse, self).__init__(pool=pool, job_id=None)
@@ -20,25 +25,87 @@ class DummyWorkhorse(Workhorse):
 def start_job(config, **kwargs):
     with config.with_db():
         job_entry = JobEntry.create_job(**kwargs)
+        delayed = (
+            job_entry.status == JobEntry.STATUS_NEW and job_entry.execute_at > datetime.datetime.now()
+            and config.use_delay_queue()
+        )
+        if delayed:
+            job_entry.status = JobEntry.STATUS_DELAYED
         job_entry.save()
-        return job_entry
+    if delayed:
+        DelayQueueManager(config.get_redis()).add(
+            host=job_entry.host, job_id=job_entry.id, pool=job_entry.pool, queue=job_entry.queue,
+            execute_at=job_entry.execute_at, priority=job_entry.priority
+        )
+    if job_entry.status in (JobEntry.STATUS_NEW, JobEntry.STATUS_DELAYED):
+        WakeupManager(config.get_redis()).notify(
+            host=job_entry.host, pool=job_entry.pool, execute_at=job_entry.execute_at
+        )
+    return job_entry
+
+
+def start_jobs(config, items, chunk_size=None, atomic=True, **kwargs):
+    # items - [(args, kwargs), ...], остальные параметры create_job общие для всех задач.
+    # Задачи записываются многострочными INSERT, whip получает один сигнал на всю пачку
+    with config.with_db():
+        template = JobEntry.create_job(**kwargs)
+        delayed = (
+            template.status == JobEntry.STATUS_NEW and template.execute_at > datetime.datetime.now()
+            and config.use_delay_queue()
+        )
+        if delayed:
+            template.status = JobEntry.STATUS_DELAYED
+        func_call = template.func_call
+        rows = []
+        for args, job_kwargs in items:
+            func_call[JobEntry.FUNC_CALL_ARGS] = () if args is None else args
+            func_call[JobEntry.FUNC_CALL_KWARGS] = {} if job_kwargs is None else job_kwargs
+            rows.append(dict(template._data, func_call_=json.dumps(func_call)))
+        if atomic:
+            with db.atomic():
+                ids = JobEntry.insert_rows(rows, chunk_size=chunk_size)
+        else:
+            ids = JobEntry.insert_rows(rows, chunk_size=chunk_size)
+    if ids and delayed:
+        DelayQueueManager(config.get_redis()).add_many(
+            host=template.host, execute_at=template.execute_at,
+            jobs=[(job_id, template.pool, template.queue, template.priority) for job_id in ids]
+        )
+    if ids and template.status in (JobEntry.STATUS_NEW, JobEntry.STATUS_DELAYED):
+        WakeupManager(config.get_redis()).notify(host=template.host, pool=template.pool, execute_at=template.execute_at)
+    return ids
 
 
 class Job(object):
 
     @classmethod
     def delay(cls, config, pool, queue=None, host=None, args=(), kwargs=None,
-              sys_path=None, venv_path=None, venv_exclusive=None, wait_minutes=0):
+              sys_path=None, venv_path=None, venv_exclusive=None, wait_minutes=0, priority=None):
+        # priority - от JobEntry.PRIORITY_MIN до JobEntry.PRIORITY_MAX, задачи с большим приоритетом выполняются раньше
         kwargs = {} if kwargs is None else kwargs
         queue = pool if queue is None else queue
         job_entry = start_job(
             config, pool=pool, queue=queue, host=host,
-            file_path=sys.modules[cls.__module__].__file__, file_cls=cls.__name__,
+            file_path=sys.modules[cls.__module__].__file__, file_cls=cls.__name__, file_module=cls.__module__,
             args=args, kwargs=kwargs,
             sys_path=sys_path, venv_path=venv_path, venv_exclusive=venv_exclusive, wait_minutes=wait_minutes,
+            priority=priority,
         )
         return job_entry
 
+    @classmethod
+    def delay_many(cls, config, pool, items, queue=None, host=None, sys_path=None, venv_path=None,
+                   venv_exclusive=None, wait_minutes=0, priority=None, chunk_size=None, atomic=True):
+        # Пакетная постановка задач: items - [(args, kwargs), ...]. Возвращает список id созданных задач.
+        # atomic - все задачи создаются в одной транзакции
+        queue = pool if queue is None else queue
+        return start_jobs(
+            config, items=items, chunk_size=chunk_size, atomic=atomic, pool=pool, queue=queue, host=host,
+            file_path=sys.modules[cls.__module__].__file__, file_cls=cls.__name__, file_module=cls.__module__,
+            sys_path=sys_path, venv_path=venv_path, venv_exclusive=venv_exclusive, wait_minutes=wait_minutes,
+            priority=priority,
+        )
+
     @classmethod
     def execute(cls, config, args=(), kwargs=None, job_entry=None):
         # Немедленный вызов задачи на выполнение, минуя whip
@@ -46,7 +113,8 @@ class Job(object):
         # TODO здесь нужны sys_path и venv_path?
         job_entry = start_job(
             config, pool='dummy_pool', queue='dummy_queue', file_path=sys.modules[cls.__module__].__file__,
-            file_cls=cls.__name__, args=args, kwargs=kwargs, status=JobEntry.STATUS_ENQUEUED, host='dummy_host'
+            file_cls=cls.__name__, file_module=cls.__module__, args=args, kwargs=kwargs,
+            status=JobEntry.STATUS_ENQUEUED, host='dummy_host'
         ) if job_entry is None else job_entry
         # Т.к. execute однопоточный, то повторять выполнение мы должны прямо здесь.
         # Чтобы не достигнуть maximum recursion depth exceeded раскрываем в while
@@ -64,6 +132,7 @@ class Job(object):
 
     def __init__(self, workhorse):
         self.workhorse = workhorse
+        self._last_tick = 0
 
     @property
     def log(self):
@@ -77,10 +146,21 @@ class Job(object):
     def job_entry(self):
         return self.workhorse.job_entry
 
-    def tick(self):
-        # Обновляет информацию о последнем обновлении задачи в базу данных
+    @property
+    def tick_interval(self):
+        pool = self.workhorse.pool
+        return float(pool.section.get(self.config.POOL_TICK_INTERVAL, self.config.POOL_TICK_INTERVAL_DEFAULT))
+
+    def tick(self, force=False):
+        # Обновляет информацию о последнем обновлении задачи в базу данных не чаще tick_interval секунд,
+        # частые вызовы ничего не стоят. force - записать сразу. Возвращает True, если запись была
+        now = time.time()
+        if not force and now - self._last_tick < self.tick_interval:
+            return False
+        self._last_tick = now
         self.job_entry.updated_at = datetime.datetime.now()
-        self.job_entry.save(only=[JobEntry.updated_at])
+        self.workhorse.save_job_entry([JobEntry.updated_at])
+        return True
 
     def run(self, *args, **kwargs):
         raise NotImplementedError()
@@ -1,16 +1,29 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
 import sys
+import threading
+import time
 import traceback
 import json
 
 import six
+from six.moves import queue
 
-from shire.redis_managers import LogMessageManager
+from shire.redis_managers import LogMessageManager, LogStreamManager
 
 
-__all__ = ['RedisLogger']
+__all__ = ['RedisLogger', 'create_log_manager']
+
+
+def create_log_manager(config):
+    # Транспорт логов выбирается настройкой transport секции logger
+    if config.use_log_stream():
+        return LogStreamManager(config.get_redis(), max_length=int(config.from_section(
+            config.LOGGER_SECTION, config.LOGGER_STREAM_MAX_LENGTH, config.LOGGER_STREAM_MAX_LENGTH_DEFAULT
+        )))
+    return LogMessageManager(config.get_redis())
 
 
 class RedisLogger(logging.Logger):
@@ -18,8 +31,21 @@ class RedisLogger(logging.Logger):
 
     def __init__(self, config, pool='shire'):
         self.shire_config = config
-        self.shire_log_manager = LogMessageManager(config.get_redis())
+        self.shire_log_manager = create_log_manager(config)
         super(RedisLogger, self).__init__(pool, level=logging.NOTSET)
+        # Буферизованный режим: записи копятся в очереди и пишутся в redis пачками из фонового потока
+        section = config.section_getter(config.LOGGER_SECTION)
+        self.buffered = section.get(config.LOGGER_BUFFERED, config.LOGGER_BUFFERED_DEFAULT) == '1'
+        self.buffer_size = int(section.get(config.LOGGER_BUFFER_SIZE, config.LOGGER_BUFFER_SIZE_DEFAULT))
+        self.flush_size = int(section.get(config.LOGGER_FLUSH_SIZE, config.LOGGER_FLUSH_SIZE_DEFAULT))
+        self.flush_time = float(section.get(config.LOGGER_FLUSH_TIME, config.LOGGER_FLUSH_TIME_DEFAULT))
+        self.overflow = section.get(config.LOGGER_OVERFLOW, config.LOGGER_OVERFLOW_DEFAULT)
+        # Счетчик меняют и пишущие потоки, и поток записи - только под self._dropped_lock
+        self.dropped_count = 0
+        self._dropped_lock = threading.Lock()
+        self._buffer = None
+        self._buffer_pid = None
+        self._buffer_lock = threading.Lock()
 
     @classmethod
     def format_exception(cls, ei):
@@ -50,4 +76,70 @@ class RedisLogger(logging.Logger):
     def handle(self, record):
         # Вместо вызова хенделоров сразу пишем в редис
         json_str = self.format_record(record)
-        self.shire_log_manager.write(pool=self.name, message=json_str)
+        if not self.buffered:
+            self.shire_log_manager.write(pool=self.name, message=json_str)
+            return
+        buf = self._get_buffer()
+        if self.overflow == self.shire_config.LOGGER_OVERFLOW_DROP:
+            try:
+                buf.put_nowait(json_str)
+            except queue.Full:
+                self._add_dropped(1)
+        else:
+            buf.put(json_str)
+
+    def _get_buffer(self):
+        # Поток записи не переживает fork, поэтому буфер и поток заводятся в каждом процессе свои
+        if self._buffer_pid != os.getpid():
+            with self._buffer_lock:
+                if self._buffer_pid != os.getpid():
+                    # блокировку мог держать поток родителя в момент fork
+                    self._dropped_lock = threading.Lock()
+                    self.dropped_count = 0
+                    self._buffer = queue.Queue(maxsize=self.buffer_size)
+                    flusher = threading.Thread(target=self._flush_loop, args=(self._buffer,), name='shire_log_flusher')
+                    flusher.daemon = True
+                    flusher.start()
+                    self._buffer_pid = os.getpid()
+        return self._buffer
+
+    def _add_dropped(self, count):
+        with self._dropped_lock:
+            self.dropped_count += count
+
+    def _pop_dropped(self):
+        with self._dropped_lock:
+            dropped, self.dropped_count = self.dropped_count, 0
+        return dropped
+
+    def _flush_loop(self, buf):
+        while True:
+            batch = [buf.get()]
+            deadline = time.time() + self.flush_time
+            while len(batch) < self.flush_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(buf.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            messages = [(self.name, x) for x in batch]
+            dropped = self._pop_dropped()
+            if dropped:
+                messages.append((self.name, self.format_record(self.makeRecord(
+                    self.name, logging.WARNING, __file__, 0, 'Log buffer is full, %s records dropped', (dropped,), None
+                ))))
+            try:
+                self.shire_log_manager.write_many(messages)
+            except Exception:
+                # Логгер не должен ронять задачу, а flush - зависать на недописанной пачке
+                self._add_dropped(len(batch) + dropped)
+            finally:
+                for _ in batch:
+                    buf.task_done()
+
+    def flush(self):
+        # Дожидается записи всех накопленных сообщений. Вызывается перед завершением процесса
+        if self.buffered and self._buffer_pid == os.getpid():
+            self._buffer.join()
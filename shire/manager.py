@@ -27,16 +27,11 @@ class ShireManager(object):
     def get_pools(self):
         # TODO: Добавить опциональный параметр get_extra=False, при получении которого загружать так же из
         # базы данных кол-во активных, ожидающих и выполненных задач, а так же время последнего обновления задачи
-        for key in self.status_manager.get_all():
-            try:
-                prefix, pool, uuid = key.rsplit(':', 2)
-            except ValueError:
-                # Плохое значение в get_all. Кейс скорее невозможный, проверка на всякий
-                continue
+        for pool, uuid, status in self.status_manager.get_statuses():
             yield {
                 'name': pool,
                 'uuid': uuid,
-                'status': self.status_manager.get_status(pool, uuid)
+                'status': status
             }
 
     def get_status(self, pools=CONST_ALL, from_statuses=CONST_ALL):
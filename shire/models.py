@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 import datetime
+import importlib
 import json
 import sys
 import os
+
+import croniter
 import peewee
+from playhouse.shortcuts import case
+
+from shire.const import JOB_PRIORITY_MAX, JOB_PRIORITY_MIN
 
 if sys.version_info < (3, 5):
     # Python 2 и старые версии 3
@@ -22,16 +28,58 @@ else:
         return _module
 
 
-__all__ = ['db', 'Limit', 'JobEntry', 'Queue']
+__all__ = ['db', 'Limit', 'JobEntry', 'JobEntryArchive', 'Queue', 'create_indexes', 'migrate_db']
+
+
+# Загруженные классы задач: (путь, имя класса) -> ((mtime, size), класс)
+_job_cls_cache = {}
+
+
+def load_job_cls_from_source(module_path, cls_name):
+    # Модуль перечитывается только если файл изменился с прошлой загрузки
+    stat = os.stat(module_path)
+    signature = (stat.st_mtime, stat.st_size)
+    cached = _job_cls_cache.get((module_path, cls_name))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    module_name = 'shire_fake_module{}'.format(module_path.rsplit('.', 1)[0].replace(os.path.sep, '_'))
+    fake_module = import_from_source(module_name, module_path)
+    job_cls = getattr(fake_module, cls_name)
+    _job_cls_cache[(module_path, cls_name)] = (signature, job_cls)
+    return job_cls
 
 
 db = peewee.Proxy()
 
 
 class BaseModel(peewee.Model):
+    UPDATE_CHUNK_SIZE = 500
+    SQLITE_MAX_VARIABLES = 999  # ограничение sqlite на количество параметров в запросе
+
     class Meta:
         database = db
 
+    @classmethod
+    def update_rows(cls, changes, chunk_size=None):
+        # Пакетное обновление разных значений у разных записей: один UPDATE ... SET поле = CASE id ... END на пачку.
+        # changes - {id: {имя поля: значение}}. Возвращает количество обновленных строк
+        chunk_size = chunk_size or cls.UPDATE_CHUNK_SIZE
+        items = list(changes.items())
+        if isinstance(db.obj, peewee.SqliteDatabase):
+            # на запись - id в WHERE и пара параметров WHEN ... THEN на каждое поле
+            chunk_size = min(chunk_size, cls.SQLITE_MAX_VARIABLES // (2 * len(cls._meta.fields) + 1))
+        count = 0
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            values = {}
+            for name in {name for row_id, fields in chunk for name in fields}:
+                field = cls._meta.fields[name]
+                values[field] = case(cls.id, [
+                    (row_id, field.db_value(fields[name])) for row_id, fields in chunk if name in fields
+                ], field)
+            count += cls.update(values).where(cls.id << [row_id for row_id, fields in chunk]).execute()
+        return count
+
 
 class Limit(BaseModel):
     ENTITY_POOL = 'pool'
@@ -57,12 +105,14 @@ class Queue(BaseModel):
 
 class JobEntry(BaseModel):
     STATUS_NEW = 'new'
+    STATUS_DELAYED = 'delayed'
     STATUS_RESTART = 'restart'
     STATUS_ENQUEUED = 'enqueued'
     STATUS_IN_PROGRESS = 'in_progress'
     STATUS_ENDED = 'ended'
     STATUS_CHOICES = (
         (STATUS_NEW, u'новая'),
+        (STATUS_DELAYED, u'отложена в redis'),
         (STATUS_RESTART, u'на перезапуск'),
         (STATUS_ENQUEUED, u'в очереди'),
         (STATUS_IN_PROGRESS, u'выполняется'),
@@ -72,12 +122,17 @@ class JobEntry(BaseModel):
     VALID_STATUSES = {k for k, v in STATUS_CHOICES}
     FUNC_CALL_PATH = 'path'
     FUNC_CALL_CLASS = 'class'
+    FUNC_CALL_MODULE = 'module'
     FUNC_CALL_ARGS = 'args'
     FUNC_CALL_KWARGS = 'kwargs'
     FUNC_CALL_SYS_PATH = 'sys_path'
     FUNC_CALL_VENV_PATH = 'venv_path'
     FUNC_CALL_VENV_EXCLUSIVE = 'venv_exclusive'
     HOST_DEFAULT = 'default'
+    PRIORITY_MIN = JOB_PRIORITY_MIN
+    PRIORITY_MAX = JOB_PRIORITY_MAX
+    PRIORITY_DEFAULT = JOB_PRIORITY_MIN
+    INSERT_CHUNK_SIZE = 500
 
     func_call_ = peewee.TextField(db_column='func_call')
     pool = peewee.CharField(max_length=256, index=True)
@@ -91,6 +146,8 @@ class JobEntry(BaseModel):
     execute_at = peewee.DateTimeField(default=datetime.datetime.now, index=True)
     updated_at = peewee.DateTimeField(default=None, null=True, index=True)
     ended_at = peewee.DateTimeField(default=None, null=True)
+    # DEFAULT в базе - что бы колонку можно было добавить к существующей таблице одним ALTER TABLE
+    priority = peewee.IntegerField(default=PRIORITY_DEFAULT, constraints=[peewee.SQL('DEFAULT 0')])
 
     class Meta:
         db_table = 'shire_job'
@@ -105,26 +162,73 @@ class JobEntry(BaseModel):
 
     @classmethod
     def create_job(cls, file_path, file_cls, pool, queue=None, status=None, host=None, args=None, kwargs=None,
-                   sys_path=None, venv_path=None, venv_exclusive=None, wait_minutes=0):
+                   sys_path=None, venv_path=None, venv_exclusive=None, wait_minutes=0, file_module=None,
+                   priority=None):
         status = status if status in cls.VALID_STATUSES else cls.STATUS_DEFAULT
         host = cls.HOST_DEFAULT if host is None else host
-        job = cls(pool=pool, queue=queue, status=status, host=host)
+        job = cls(pool=pool, queue=queue, status=status, host=host, priority=cls.clean_priority(priority))
         job.func_call = cls.make_func_call(
             file_path=file_path, file_cls=file_cls, args=args, kwargs=kwargs,
-            sys_path=sys_path, venv_path=venv_path, venv_exclusive=venv_exclusive)
+            sys_path=sys_path, venv_path=venv_path, venv_exclusive=venv_exclusive, file_module=file_module)
         if wait_minutes > 0:
             job.execute_at = datetime.datetime.now() + datetime.timedelta(minutes=wait_minutes)
         return job
 
+    @classmethod
+    def insert_rows(cls, rows, chunk_size=None):
+        # Многострочный INSERT пачками по chunk_size. Возвращает id созданных записей в порядке rows
+        chunk_size = chunk_size or cls.INSERT_CHUNK_SIZE
+        is_sqlite = isinstance(db.obj, peewee.SqliteDatabase)
+        if is_sqlite:
+            chunk_size = min(chunk_size, cls.SQLITE_MAX_VARIABLES // len(cls._meta.fields))
+        # Строки не проходят через save(): время записи проставляем так же, как он
+        now = datetime.datetime.now()
+        rows = [dict(row, created_at=row.get('created_at') or now, updated_at=row.get('updated_at') or now)
+                for row in rows]
+        consecutive_ids = isinstance(db.obj, peewee.MySQLDatabase) and cls._mysql_consecutive_ids()
+        ids = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            query = cls.insert_many(chunk)
+            if db.insert_returning:
+                ids.extend(query.return_id_list().execute())
+            elif is_sqlite:
+                # sqlite выдает rowid подряд, lastrowid - id последней строки
+                sql, params = query.sql()
+                last_id = db.last_insert_id(db.execute_sql(sql, params), cls)
+                ids.extend(range(last_id - len(chunk) + 1, last_id + 1))
+            elif consecutive_ids:
+                # MySQL: LAST_INSERT_ID() многострочной вставки - id первой строки, остальные идут подряд
+                sql, params = query.sql()
+                first_id = db.last_insert_id(db.execute_sql(sql, params), cls)
+                ids.extend(range(first_id, first_id + len(chunk)))
+            else:
+                # innodb_autoinc_lock_mode = 2 (по умолчанию в MySQL 8) не гарантирует id подряд - вставка по строке
+                ids.extend(cls.insert(**row).execute() for row in chunk)
+        return ids
+
+    @staticmethod
+    def _mysql_consecutive_ids():
+        # Режимы 0 и 1 выдают id многострочной вставки подряд
+        return db.execute_sql('SELECT @@innodb_autoinc_lock_mode').fetchone()[0] != 2
+
+    @classmethod
+    def clean_priority(cls, priority):
+        if priority is None:
+            return cls.PRIORITY_DEFAULT
+        return min(max(int(priority), cls.PRIORITY_MIN), cls.PRIORITY_MAX)
+
     @classmethod
     def make_func_call(cls, file_path, file_cls, args=None, kwargs=None,
-                       sys_path=None, venv_path=None, venv_exclusive=None):
+                       sys_path=None, venv_path=None, venv_exclusive=None, file_module=None):
         func_call = {
             cls.FUNC_CALL_PATH: file_path,
             cls.FUNC_CALL_CLASS: file_cls,
             cls.FUNC_CALL_ARGS: () if args is None else args,
             cls.FUNC_CALL_KWARGS: {} if kwargs is None else kwargs
         }
+        if file_module is not None and file_module != '__main__':
+            func_call[cls.FUNC_CALL_MODULE] = file_module
         if sys_path is not None:
             func_call[cls.FUNC_CALL_SYS_PATH] = sys_path
         if venv_path is not None:
@@ -135,12 +239,23 @@ class JobEntry(BaseModel):
 
     @property
     def job_cls(self):
-        module_path = self.func_call[self.FUNC_CALL_PATH]
+        return self.get_job_cls()
+
+    def get_job_cls(self, by_module=False):
+        # by_module - импорт по имени модуля через стандартный механизм (с использованием .pyc),
+        # иначе - загрузка из файла по пути
+        func_call = self.func_call
+        module = func_call.get(self.FUNC_CALL_MODULE)
+        if by_module and module is not None:
+            try:
+                return getattr(importlib.import_module(module), func_call[self.FUNC_CALL_CLASS])
+            except ImportError:
+                # Модуля нет в sys.path воркера - грузим по пути
+                pass
+        module_path = func_call[self.FUNC_CALL_PATH]
         if module_path.endswith('.pyc'):
             module_path = module_path[:-1]
-        module_name = 'shire_fake_module{}'.format(module_path.rsplit('.', 1)[0].replace(os.path.sep, '_'))
-        fake_module = import_from_source(module_name, module_path)
-        return getattr(fake_module, self.func_call[self.FUNC_CALL_CLASS])
+        return load_job_cls_from_source(module_path, func_call[self.FUNC_CALL_CLASS])
 
     def get_params(self):
         # параметры для конкретной задачи
@@ -164,7 +279,26 @@ class JobEntry(BaseModel):
             if only is not None and self.__class__.updated_at not in only:
                 only = [x for x in only] + [self.__class__.updated_at]
             self.updated_at = datetime.datetime.now()
-        return super(self.__class__, self).save(force_insert=force_insert, only=only)
+        return super(JobEntry, self).save(force_insert=force_insert, only=only)
+
+
+class JobEntryArchive(JobEntry):
+    # Завершенные задачи, перенесенные из shire_job, что бы они не мешали запросам whip и hostler.
+    # Колонки те же, id задачи сохраняется
+
+    class Meta:
+        db_table = 'shire_job_archive'
+
+    @classmethod
+    def archive(cls, ids):
+        # Переносит задачи с указанными id одной транзакцией
+        fields = JobEntry._meta.sorted_fields
+        with db.atomic():
+            cls.insert_from(
+                fields=[cls._meta.fields[field.name] for field in fields],
+                query=JobEntry.select(*fields).where(JobEntry.id << ids)
+            ).execute()
+            return JobEntry.delete().where(JobEntry.id << ids).execute()
 
 
 class Crontab(BaseModel):
@@ -172,6 +306,8 @@ class Crontab(BaseModel):
     cron_string = peewee.TextField()
     description = peewee.TextField(null=True)
     last_scheduled = peewee.DateTimeField(null=True)
+    # Ближайший еще не запланированный запуск: планировщик выбирает только наступающие кронтабы
+    next_run_at = peewee.DateTimeField(null=True, index=True)
 
     func_call_ = peewee.TextField(db_column='func_call')
     pool = peewee.CharField(max_length=256, index=True)
@@ -181,6 +317,19 @@ class Crontab(BaseModel):
     class Meta:
         db_table = 'shire_crontab'
 
+    def get_next_run(self, start=None):
+        return croniter.croniter(
+            self.cron_string, start or datetime.datetime.now(), ret_type=datetime.datetime
+        ).get_next()
+
+    def save(self, force_insert=False, only=None):
+        # next_run_at пересчитывается при изменении расписания
+        if self.next_run_at is None or {'cron_string', 'last_scheduled'} & self._dirty:
+            self.next_run_at = self.get_next_run(self.last_scheduled)
+            if only is not None and Crontab.next_run_at not in only:
+                only = [x for x in only] + [Crontab.next_run_at]
+        return super(Crontab, self).save(force_insert=force_insert, only=only)
+
     @property
     def func_call(self):
         return json.loads(self.func_call_)
@@ -188,3 +337,99 @@ class Crontab(BaseModel):
     @func_call.setter
     def func_call(self, value):
         self.func_call_ = json.dumps(value)
+
+
+# Составные индексы shire_job под запросы whip, hostler и очистки старых задач:
+# (имя, колонки, колонки частичного индекса для postgres, статусы частичного индекса).
+# Без колонок общего индекса - индекс создается только в postgres. Индекс с прежним набором колонок пересоздается
+JOB_INDEXES = (
+    # whip: задачи к выполнению в порядке priority DESC, execute_at ASC и ближайшее время выполнения
+    ('shire_job_due', ('host', 'status', 'priority', 'execute_at'), ('host', 'priority', 'execute_at'),
+     (JobEntry.STATUS_NEW, JobEntry.STATUS_RESTART)),
+    # whip: текущая нагрузка по пулам и очередям
+    ('shire_job_active', ('status', 'pool', 'queue'), ('pool', 'queue'),
+     (JobEntry.STATUS_ENQUEUED, JobEntry.STATUS_IN_PROGRESS)),
+    # whip: отложенные задачи, не попавшие в redis
+    ('shire_job_delayed', None, ('host', 'execute_at'), (JobEntry.STATUS_DELAYED,)),
+    # hostler: зависшие задачи
+    ('shire_job_stale', ('host', 'status', 'updated_at'), ('host', 'updated_at'), (JobEntry.STATUS_IN_PROGRESS,)),
+    # очистка и архивация завершенных задач
+    ('shire_job_ended', ('status', 'updated_at'), ('updated_at',), (JobEntry.STATUS_ENDED,)),
+)
+
+
+def _execute_index_sql(clause, concurrently=False):
+    database = db.obj
+    sql, params = database.compiler().parse_node(clause)
+    if concurrently:
+        # CREATE/DROP INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        conn = database.get_conn()
+        conn.autocommit = True
+        try:
+            conn.cursor().execute(sql, params)
+        finally:
+            conn.autocommit = False
+    else:
+        database.execute_sql(sql, params)
+
+
+def _drop_index(name, concurrently=False):
+    database = db.obj
+    concurrently = concurrently and isinstance(database, peewee.PostgresqlDatabase)
+    clause = [peewee.SQL('DROP INDEX CONCURRENTLY' if concurrently else 'DROP INDEX'), peewee.Entity(name)]
+    if isinstance(database, peewee.MySQLDatabase):
+        clause.extend([peewee.SQL('ON'), JobEntry.as_entity()])
+    _execute_index_sql(peewee.Clause(*clause), concurrently=concurrently)
+
+
+def create_indexes(concurrently=False):
+    # Создает недостающие индексы из JOB_INDEXES. concurrently - без блокировки записи (только postgres)
+    database = db.obj
+    is_postgres = isinstance(database, peewee.PostgresqlDatabase)
+    existing = {index.name: list(index.columns) for index in database.get_indexes(JobEntry._meta.db_table)}
+    created = []
+    for name, columns, partial_columns, partial_statuses in JOB_INDEXES:
+        if is_postgres:
+            columns = partial_columns
+        elif columns is None:
+            continue
+        if existing.get(name) == list(columns):
+            continue
+        if name in existing:
+            # Индекс из прежней версии с другими колонками
+            _drop_index(name, concurrently=concurrently)
+        clause = [
+            peewee.SQL('CREATE INDEX CONCURRENTLY' if concurrently and is_postgres else 'CREATE INDEX'),
+            peewee.Entity(name), peewee.SQL('ON'), JobEntry.as_entity(),
+            peewee.EnclosedClause(*[peewee.Entity(column) for column in columns]),
+        ]
+        if is_postgres:
+            clause.extend([peewee.SQL('WHERE'), JobEntry.status << list(partial_statuses)])
+        _execute_index_sql(peewee.Clause(*clause), concurrently=concurrently and is_postgres)
+        created.append(name)
+    return created
+
+
+def migrate_db():
+    # Приводит существующую базу к текущим моделям: недостающие колонки shire_job, shire_job_archive, shire_crontab
+    # и индексы. Возвращает (добавленные колонки, созданные индексы)
+    database = db.obj
+    compiler = database.compiler()
+    added = []
+    indexes = []
+    for model in (JobEntry, JobEntryArchive, Crontab):
+        if not model.table_exists():
+            continue
+        existing = {column.name for column in database.get_columns(model._meta.db_table)}
+        for field in model._meta.sorted_fields:
+            if field.db_column in existing:
+                continue
+            sql, params = compiler.parse_node(peewee.Clause(
+                peewee.SQL('ALTER TABLE'), model.as_entity(), peewee.SQL('ADD COLUMN'), compiler.field_definition(field)
+            ))
+            database.execute_sql(sql, params)
+            added.append('{}.{}'.format(model._meta.db_table, field.db_column))
+            if field.index:
+                database.create_index(model, [field])
+                indexes.append('{}.{}'.format(model._meta.db_table, field.db_column))
+    return added, indexes + create_indexes(concurrently=True)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import signal
+
+from shire.pool import Pool
+from shire.redis_managers import PoolStatusManager
+from shire.utils import check_pid_is_shire
+
+
+__all__ = ['MultiPool']
+
+
+class MultiPool(Pool):
+    # Один процесс пула на несколько очередей: задачи выбираются одним BRPOP по всем очередям,
+    # ограничение max_workhorses общее. Пул регистрируется с одним uuid под каждым из имен
+    NAME_SEPARATOR = ','
+    NAME_PREFIX = 'multi:'
+    STOPPED_STATUSES = (PoolStatusManager.STATUS_DEAD, PoolStatusManager.STATUS_KILL)
+
+    def __init__(self, config, names, weights=None, **kwargs):
+        # weights - {pool: вес}. Без весов очереди проверяются строго в порядке names,
+        # с весами - в случайном порядке, где очередь оказывается первой пропорционально своему весу.
+        # Процесс общий, поэтому лог и настройки у него свои: multi:<names> и секция [pool:multi:<names>]
+        super(MultiPool, self).__init__(config=config, name=self.make_name(names), **kwargs)
+        self.names = list(names)
+        self.weights = weights or {}
+        self._job_names = {}  # job_id -> имя, из очереди которого взята задача
+        for name in self.get_ignored_sections():
+            message = u'Options of [{}] are ignored by multi pool "{}", set them in [{}]'.format(
+                self.config.POOL_NAMED_SECTION.format(name=name), self.name,
+                self.config.POOL_NAMED_SECTION.format(name=self.name)
+            )
+            self.log.warning(message)
+            self.pool_log(message, 'warning')
+
+    @classmethod
+    def make_name(cls, names):
+        return cls.NAME_PREFIX + cls.NAME_SEPARATOR.join(names)
+
+    def get_ignored_sections(self):
+        # Очереди с персональными настройками - к общему процессу они не применяются
+        return [name for name in self.names if self.config.POOL_NAMED_SECTION.format(name=name) in self.config]
+
+    def get_active_names(self):
+        # Очереди, которые менеджер остановил по отдельности, больше не опрашиваются
+        return [name for name in self.names if self._statuses.get(name) not in self.STOPPED_STATUSES]
+
+    def get_pop_order(self):
+        names = self.get_active_names()
+        if not self.weights:
+            return names
+        return sorted(names, key=lambda name: random.random() ** (1.0 / self.weights.get(name, 1)), reverse=True)
+
+    def pop_queued_job(self):
+        names = self.get_pop_order()
+        if not names:
+            return None, None, None
+        key, pool, job_id = self._queue_manager.pop_with_key(pools=names, timeout=self.check_time)
+        if job_id:
+            # Имя нужно, что бы KILL отдельного имени уничтожил задачи только его очереди
+            running = set(self._children.values())
+            self._job_names = {x: name for x, name in self._job_names.items() if x in running}
+            self._job_names[job_id] = pool
+        return key, pool, job_id
+
+    @property
+    def status(self):
+        status = super(MultiPool, self).status
+        self.kill_names_children()
+        return status
+
+    def kill_names_children(self):
+        # KILL отдельного имени: пул продолжает работать с остальными очередями, а задачи этой уничтожаются сразу.
+        # Убитые процессы остаются в учете до reap_children, зомби check_pid_is_shire не проходят
+        killed = [name for name in self.names if self._statuses.get(name) == PoolStatusManager.STATUS_KILL]
+        if not killed:
+            return
+        for child_pid, job_id in list(self._children.items()):
+            if self._job_names.get(job_id) in killed and check_pid_is_shire(child_pid):
+                os.kill(child_pid, signal.SIGKILL)
+
+    def get_pool_status(self):
+        # Пул завершается, когда остановлены все его очереди
+        if self.get_active_names():
+            return PoolStatusManager.STATUS_ACTIVE
+        if PoolStatusManager.STATUS_KILL in self._statuses.values():
+            return PoolStatusManager.STATUS_KILL
+        return PoolStatusManager.STATUS_DEAD
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
+from collections import Counter
+import datetime
+import errno
+import fcntl
 import os
+import select
 import signal
 import time
 
 import sys
 
 from shire.logger import RedisLogger
+from shire.models import JobEntry
 from shire.redis_managers import PoolStatusManager, QueueManager
 from shire.utils import check_pid_is_shire, create_console_handler, create_logger
 from shire.workhorse import Daemon, Workhorse
@@ -17,6 +23,8 @@ __all__ = ['Pool']
 class Pool(Daemon):
     SLEEP_TIME = 1
     MAX_WORKHORSES = None  # без ограничения
+    # Статус приходит через pub/sub, раз в STATUS_REFRESH_TIME секунд он перечитывается на случай потери сообщения
+    STATUS_REFRESH_TIME = 60
 
     def __init__(self, config, name, sleep_time=None, max_workhorses=None, verbose=False):
         super(Pool, self).__init__()
@@ -24,17 +32,34 @@ class Pool(Daemon):
         self.verbose = verbose
         self.redis = config.get_redis()
         self.name = name
+        # Очереди, из которых пул берет задачи, и под которыми он зарегистрирован в PoolStatusManager
+        self.names = [name]
         self.pool_logger = create_logger('shire.pool.{}'.format(name))
         if verbose:
             create_console_handler(self.pool_logger)
         self.sleep_time = sleep_time if sleep_time else self.SLEEP_TIME
-        self.section = self.config.section_getter(self.config.POOL_SECTION)
+        self.section = self.config.pool_section_getter(name)
         self.check_time = int(self.section.get(self.config.POOL_CHECK_TIME, self.config.POOL_CHECK_TIME_DEFAULT))
+        if not max_workhorses:
+            max_workhorses = int(self.section.get(
+                self.config.POOL_MAX_WORKHORSES, self.config.POOL_MAX_WORKHORSES_DEFAULT
+            ))
         self.max_workhorses = max_workhorses if max_workhorses else self.MAX_WORKHORSES
         self._queue_manager = QueueManager(connection=self.redis)
-        self._children = []
+        # pid -> id задачи (None для процессов без задачи)
+        self._children = {}
+        # Коды завершения потомков: код -> количество, при завершении по сигналу - минус номер сигнала
+        self.exit_codes = Counter()
+        self._wakeup_fds = None
         self.log = RedisLogger(config=self.config, pool=self.name)
         self._ps = PoolStatusManager(connection=self.redis)
+        self._statuses = {}
+        self._status_pubsub = None
+        self._status_loaded_at = 0
+        self.refresh_time = float(self.section.get(
+            self.config.POOL_REFRESH_TIME, self.config.POOL_REFRESH_TIME_DEFAULT
+        ))
+        self._jobs_refreshed_at = 0
         # когда форкуется workhorse, то она наследует signal.signal(signal.SIGTERM, self.terminate)
         # и надо проверять в  self.terminate кто сейчас завершается
         self.i_am_pool = True
@@ -48,17 +73,20 @@ class Pool(Daemon):
         self.pool_log('Pool "{}" started'.format(self.name))
         self.pool_log('Max workhorses: {}'.format('unlimited' if self.max_workhorses is None else self.max_workhorses))
         self.pool_log('Redis check timeout: {}s'.format(self.check_time))
-        self._ps.set_status(pool=self.name, _uuid=self.uuid, status=PoolStatusManager.STATUS_ACTIVE)
+        self.set_status(PoolStatusManager.STATUS_ACTIVE)
         signal.signal(signal.SIGTERM, self.terminate)
+        self.setup_child_wakeup()
         while True:
+            self.refresh_jobs()
             if not self.can_start_new_workhorse():
-                time.sleep(self.sleep_time)
+                self.wait_child_wakeup(self.sleep_time)
                 continue
             while True:
-                job_id = self._queue_manager.pop(pool=self.name, timeout=self.check_time)
+                key, pool, job_id = self.pop_queued_job()
+                self.refresh_jobs()
                 if self.status in (PoolStatusManager.STATUS_DEAD, PoolStatusManager.STATUS_KILL):
                     if job_id:
-                        self._queue_manager.push(pool=self.name, job_id=job_id, to_tail=True)
+                        self._queue_manager.push_back(key, job_id)
                     if self.status == PoolStatusManager.STATUS_KILL:
                         self.kill_children()
                     self.terminate()
@@ -69,19 +97,127 @@ class Pool(Daemon):
                     # проверяем после запуска задачи, что бы понять - можно ли выбирать другие задачи
                     break
 
+    def get_live_pids(self):
+        # Процессы, в которых сейчас выполняются задачи пула
+        return list(self._children)
+
+    def refresh_jobs(self):
+        # Обновляет updated_at задач всех живых потомков одним запросом раз в refresh_time секунд:
+        # hostler не перезапустит долгую задачу, даже если она не вызывает tick
+        now = time.time()
+        if not self.refresh_time or now - self._jobs_refreshed_at < self.refresh_time:
+            return
+        self._jobs_refreshed_at = now
+        pids = self.get_live_pids()
+        if pids:
+            self.update_jobs(pids)
+
+    def update_jobs(self, pids):
+        # Соединение только на время запроса: потомки не должны унаследовать его при fork
+        with self.config.with_db():
+            return self._update_jobs(pids)
+
+    def _update_jobs(self, pids):
+        return JobEntry.update(updated_at=datetime.datetime.now()).where(
+            (JobEntry.pool_uuid == self.uuid) & (JobEntry.status == JobEntry.STATUS_IN_PROGRESS)
+            & (JobEntry.worker_pid << pids)
+        ).execute()
+
+    def pop_job(self):
+        # (pool, job_id), job_id - None при выходе из brpop по таймауту
+        key, pool, job_id = self.pop_queued_job()
+        return pool, job_id
+
+    def pop_queued_job(self):
+        # (key, pool, job_id): key - список, куда задачу возвращать, если пул остановлен
+        return self._queue_manager.pop_with_key([self.name], timeout=self.check_time)
+
+    def set_status(self, status):
+        for name in self.names:
+            self._ps.set_status(pool=name, _uuid=self.uuid, status=status)
+
     def _start_workhorse(self, job_id):
         self.pool_log('Workhorse for job #{} started'.format(job_id))
         workhorse = Workhorse(pool=self, job_id=job_id)
         pid = workhorse.fork()
-        self._children.append(pid)
+        self._children[pid] = job_id
+
+    def setup_child_wakeup(self):
+        # Завершение потомка будит пул через self-pipe: обработчик SIGCHLD пишет в канал,
+        # пул ждет на нем select вместо sleep и сразу забирает освободившееся место
+        read_fd, write_fd = os.pipe()
+        for fd in (read_fd, write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._wakeup_fds = read_fd, write_fd
+        signal.signal(signal.SIGCHLD, self.on_child_exit)
+        # системные вызовы (brpop в том числе) не должны прерываться по SIGCHLD
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def reset_child_wakeup(self):
+        # Вызывается в потомке после fork: его собственные дочерние процессы не должны попадать в учет пула
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        if self._wakeup_fds:
+            for fd in self._wakeup_fds:
+                os.close(fd)
+            self._wakeup_fds = None
+
+    def on_child_exit(self, sign=None, frame=None):
+        self.notify_child_wakeup()
+
+    def notify_child_wakeup(self):
+        if not self._wakeup_fds:
+            return
+        try:
+            os.write(self._wakeup_fds[1], b'\0')
+        except OSError as e:
+            # канал переполнен - пул и так будет разбужен
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def wait_child_wakeup(self, timeout):
+        if not self._wakeup_fds:
+            time.sleep(timeout)
+            return
+        read_fd = self._wakeup_fds[0]
+        try:
+            ready, _, _ = select.select([read_fd], [], [], timeout)
+        except (select.error, OSError) as e:
+            # python 2 не повторяет select, прерванный сигналом
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            try:
+                while os.read(read_fd, 1024):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
 
     @property
     def status(self):
-        return self._ps.get_status(pool=self.name, _uuid=self.uuid)
+        if self._status_pubsub is None:
+            # Подписываемся до чтения статуса, что бы не пропустить изменение между ними
+            self._status_pubsub = self._ps.subscribe(pools=self.names, _uuid=self.uuid)
+            self._load_status()
+            return self.get_pool_status()
+        published = self._ps.get_published_statuses(self._status_pubsub)
+        if published:
+            self._statuses.update(published)
+        elif time.time() - self._status_loaded_at >= self.STATUS_REFRESH_TIME:
+            self._load_status()
+        return self.get_pool_status()
+
+    def _load_status(self):
+        self._statuses = {name: self._ps.get_status(pool=name, _uuid=self.uuid) for name in self.names}
+        self._status_loaded_at = time.time()
+
+    def get_pool_status(self):
+        return self._statuses.get(self.name)
 
     def wait_children(self):
         while self._get_children_count() > 0:
-            time.sleep(self.sleep_time)
+            self.wait_child_wakeup(self.sleep_time)
             if self.status == PoolStatusManager.STATUS_KILL:
                 self.kill_children()
                 return
@@ -90,7 +226,7 @@ class Pool(Daemon):
         for child_pid in self._children:
             if check_pid_is_shire(child_pid):
                 os.kill(child_pid, signal.SIGKILL)
-        self._children = []
+        self._children = {}
 
     def can_start_new_workhorse(self):
         children_count = self._get_children_count()
@@ -99,23 +235,26 @@ class Pool(Daemon):
         return True
 
     def _get_children_count(self):
-        ended_pids = []
-        try:
-            while True:
-                pid, ret_code = os.waitpid(-1, os.WNOHANG)
-                if not pid:
-                    break
-                ended_pids.append(pid)
-        except OSError:
-            # нет child-процессов
-            pass
-        for child_pid in self._children[:]:
-            if child_pid in ended_pids:
-                self._children.remove(child_pid)
+        self.reap_children()
         return len(self._children)
 
+    def reap_children(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                # нет child-процессов
+                break
+            if not pid:
+                break
+            job_id = self._children.pop(pid, None)
+            code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            self.exit_codes[code] += 1
+            self.pool_log('Child {} (job #{}) exited with code {}'.format(pid, job_id, code))
+
     def terminate(self, sign=None, frame=None):
         if self.i_am_pool:
             self.wait_children()
-            self._ps.set_status(pool=self.name, _uuid=self.uuid, status=PoolStatusManager.STATUS_TERMITATED)
+            self.set_status(PoolStatusManager.STATUS_TERMITATED)
+            self.log.flush()
         sys.exit(0)
@@ -6,29 +6,62 @@ import time
 
 import setproctitle
 
+from shire.config import Config
+from shire.exceptions import ShireException
 from shire.manager import ShireManager
+from shire.multi_pool import MultiPool
 from shire.pool import Pool
+from shire.prefork import PreforkPool
+from shire.thread_pool import ThreadPool
+
+
+__all__ = ['PoolStarter', 'create_pool']
+
+
+POOL_BACKENDS = {
+    Config.POOL_BACKEND_FORK: Pool,
+    Config.POOL_BACKEND_PREFORK: PreforkPool,
+    Config.POOL_BACKEND_THREAD: ThreadPool,
+}
+
+if sys.version_info >= (3, 5):
+    from shire.asyncio_pool import AsyncioPool
+    POOL_BACKENDS[Config.POOL_BACKEND_ASYNCIO] = AsyncioPool
+
+
+def create_pool(config, name, **kwargs):
+    # Класс пула выбирается настройкой backend из секции пула
+    backend = config.pool_section_getter(name).get(config.POOL_BACKEND, config.POOL_BACKEND_DEFAULT)
+    if backend not in POOL_BACKENDS:
+        raise ShireException('Unknown pool backend {}'.format(backend))
+    return POOL_BACKENDS[backend](config=config, name=name, **kwargs)
 
 
 class PoolStarter(object):
 
-    def __init__(self, config, pools=(), config_path=''):
+    def __init__(self, config, pools=(), config_path='', multi=False, weights=None):
         self.config = config
         self.pools = pools
         self.config_path = config_path
+        # multi - все пулы обслуживаются одним процессом MultiPool
+        self.multi = multi
+        self.weights = weights
 
     def run(self):
         signal.signal(signal.SIGTERM, self.terminate)
         signal.signal(signal.SIGINT, self.terminate)
-        for pool_name in self.pools:
-            self.spawn_child(pool_name=pool_name)
+        if self.multi:
+            self.spawn_child(pool_names=self.pools)
+        else:
+            for pool_name in self.pools:
+                self.spawn_child(pool_name=pool_name)
         try:
             while True:
                 time.sleep(1)
         except Exception as exc:
             self.terminate()
 
-    def spawn_child(self, pool_name):
+    def spawn_child(self, pool_name=None, pool_names=None):
         # see https://stackoverflow.com/questions/972362/spawning-process-from-python/972383#972383
 
         try:
@@ -78,9 +111,15 @@ class PoolStarter(object):
         os.dup2(0, 2)
 
         # and finally let's execute the executable for the daemon!
-        cmd = 'shire.cli --config={} run_pool --name {}'.format(self.config_path, pool_name)
+        if pool_names:
+            cmd = 'shire.cli --config={} run_multi_pool --names {}'.format(
+                self.config_path, MultiPool.NAME_SEPARATOR.join(pool_names)
+            )
+            pool = MultiPool(config=self.config, names=pool_names, weights=self.weights)
+        else:
+            cmd = 'shire.cli --config={} run_pool --name {}'.format(self.config_path, pool_name)
+            pool = create_pool(config=self.config, name=pool_name)
         setproctitle.setproctitle(cmd + ' ' * 512)
-        pool = Pool(config=self.config, name=pool_name)
         try:
             pool.run()
         except Exception as e:
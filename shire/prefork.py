@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import signal
+import sys
+
+import setproctitle
+
+from shire.const import SHIRE_WORKHORSE_PROCESS_NAME
+from shire.models import db
+from shire.pool import Pool
+from shire.redis_managers import PoolStatusManager
+from shire.utils import get_rss
+from shire.workhorse import Daemon, Workhorse
+
+
+__all__ = ['PreforkPool', 'PreforkWorker']
+
+
+class PreforkWorker(Daemon):
+    # Долгоживущий процесс пула: сам забирает задачи из очереди и выполняет их без fork на каждую задачу.
+    # Соединение с базой и импортированные модули задач переиспользуются между задачами
+
+    def __init__(self, pool):
+        super(PreforkWorker, self).__init__()
+        self.pool = pool
+        self.config = pool.config
+        self.log = pool.log
+        self.max_jobs = int(pool.section.get(
+            self.config.POOL_WORKER_MAX_JOBS, self.config.POOL_WORKER_MAX_JOBS_DEFAULT
+        ))
+        self.max_rss = int(pool.section.get(
+            self.config.POOL_WORKER_MAX_RSS, self.config.POOL_WORKER_MAX_RSS_DEFAULT
+        )) * 1024 * 1024
+        self.stopping = False
+        self.jobs_done = 0
+
+    def set_title(self, job_id=None):
+        title = '{} prefork worker pool={}'.format(SHIRE_WORKHORSE_PROCESS_NAME, self.pool.name)
+        if job_id is not None:
+            title += ' job_id={}'.format(job_id)
+        setproctitle.setproctitle(title + ' ' * 128)
+
+    def fork(self):
+        pid = os.fork()
+        if pid:
+            return pid
+        self.pool.i_am_pool = False
+        self.pool.reset_child_wakeup()
+        # по SIGTERM доделываем текущую задачу и выходим, SIGKILL от пула - жесткое завершение
+        signal.signal(signal.SIGTERM, self.stop)
+        # SIGTERM, пришедший до установки обработчика, отметился только в копии пула
+        self.stopping = self.pool.terminating
+        self.set_title()
+        db.initialize(self.config.get_db())
+        try:
+            self.run()
+        finally:
+            self.log.flush()
+            # процесс мог завершиться, так и не открыв соединение
+            if not db.is_closed():
+                db.close()
+        sys.exit(0)
+
+    def stop(self, sign=None, frame=None):
+        self.stopping = True
+
+    def need_recycle(self):
+        if self.max_jobs and self.jobs_done >= self.max_jobs:
+            return True
+        if self.max_rss and get_rss() >= self.max_rss:
+            return True
+        return False
+
+    def run(self):
+        while not self.stopping:
+            key, pool, job_id = self.pool.pop_queued_job()
+            if not job_id:
+                continue
+            if self.stopping:
+                # Пул завершается - возвращаем задачу в очередь для других пулов
+                self.pool._queue_manager.push_back(key, job_id)
+                break
+            self.set_title(job_id)
+            Workhorse(pool=self.pool, job_id=job_id).execute()
+            self.set_title()
+            self.jobs_done += 1
+            if self.need_recycle():
+                # Пул запустит вместо нас новый процесс
+                break
+
+
+class PreforkPool(Pool):
+    # Пул с постоянными процессами-исполнителями вместо fork на каждую задачу.
+    # Количество процессов - max_workhorses, либо число ядер, если ограничение не задано
+
+    def __init__(self, *args, **kwargs):
+        super(PreforkPool, self).__init__(*args, **kwargs)
+        self.workers_count = self.max_workhorses or multiprocessing.cpu_count()
+        self.terminating = False
+
+    def run(self):
+        self.pool_log('Prefork pool "{}" started'.format(self.name))
+        self.pool_log('Workers: {}'.format(self.workers_count))
+        self.pool_log('Redis check timeout: {}s'.format(self.check_time))
+        self.set_status(PoolStatusManager.STATUS_ACTIVE)
+        signal.signal(signal.SIGTERM, self.request_terminate)
+        self.setup_child_wakeup()
+        while not self.terminating:
+            # Перезапускаем завершившиеся (в т.ч. по лимиту задач или памяти) процессы
+            while not self.terminating and self._get_children_count() < self.workers_count:
+                self._start_worker()
+            self.wait_child_wakeup(self.sleep_time)
+            self.refresh_jobs()
+            status = self.status
+            if status in (PoolStatusManager.STATUS_DEAD, PoolStatusManager.STATUS_KILL):
+                if status == PoolStatusManager.STATUS_KILL:
+                    self.kill_children()
+                break
+        self.terminate()
+
+    def _start_worker(self):
+        pid = PreforkWorker(pool=self).fork()
+        self.pool_log('Worker {} started'.format(pid))
+        self._children[pid] = None
+
+    def request_terminate(self, sign=None, frame=None):
+        # Обработчик SIGTERM только отмечает завершение и будит цикл пула: завершение посреди fork
+        # оставило бы незарегистрированный процесс, а унаследовавший обработчик потомок - работал бы как пул
+        self.terminating = True
+        self.notify_child_wakeup()
+
+    def terminate(self, sign=None, frame=None):
+        if self.i_am_pool:
+            for child_pid in self._children:
+                try:
+                    os.kill(child_pid, signal.SIGTERM)
+                except OSError:
+                    pass
+        super(PreforkPool, self).terminate(sign, frame)
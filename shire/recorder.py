@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import collections
+import os
+import socket
+import sys
+import time
+
+from shire.models import db, JobEntry
+from shire.redis_managers import JobEventManager
+from shire.utils import create_console_handler, create_logger
+
+
+__all__ = ['Recorder']
+
+
+class Recorder(object):
+    # Специально написан по методологии "let it crash".
+    # В случае непредвиденных ситуаций должен быть перезапущен супервайзером, а не пытаться разрешить их самостоятельно,
+    # в ущерб стабильности
+
+    # Применяет к shire_job изменения задач, которые workhorse отправляют в поток при включенных job_events:
+    # одним UPDATE на пачку вместо нескольких UPDATE на каждую задачу.
+    # События одной задачи должны применяться по порядку, поэтому recorder запускается в одном экземпляре
+
+    def __init__(self, config, verbose=False):
+        self.config = config
+        self.verbose = verbose
+        self.recorder_logger = create_logger('shire.recorder')
+        if verbose:
+            create_console_handler(self.recorder_logger)
+        self.section = self.config.section_getter(self.config.RECORDER_SECTION)
+        db.initialize(self.config.get_db())
+        self.manager = JobEventManager(self.config.get_redis())
+        self.consumer = self.section.get(
+            self.config.RECORDER_CONSUMER, '{}:{}'.format(socket.gethostname(), os.getpid())
+        )
+        self.batch_size = max(1, int(self.section.get(
+            self.config.RECORDER_BATCH_SIZE, self.config.RECORDER_BATCH_SIZE_DEFAULT
+        )))
+        self.flush_time = float(self.section.get(
+            self.config.RECORDER_FLUSH_TIME, self.config.RECORDER_FLUSH_TIME_DEFAULT
+        ))
+
+    def recorder_log(self, msg, level='info'):
+        if not self.verbose:
+            return
+        getattr(self.recorder_logger, level)(msg)
+
+    @staticmethod
+    def merge_events(entries):
+        # Изменения одной задачи сливаются в одно, у поля остается последнее значение
+        changes = collections.OrderedDict()
+        for entry_id, job_id, fields in entries:
+            if job_id is not None:
+                changes.setdefault(job_id, {}).update(fields)
+        return changes
+
+    def apply(self, entries):
+        changes = self.merge_events(entries)
+        if changes:
+            with db.atomic():
+                JobEntry.update_rows(changes)
+            self.recorder_log('{} job changes recorded'.format(len(changes)))
+        # Подтверждаем только после записи в базу: при падении события будут применены повторно
+        self.manager.ack([entry_id for entry_id, job_id, fields in entries])
+
+    def loop(self, pending=False):
+        started = time.time()
+        entries = self.manager.read(self.consumer, count=self.batch_size, timeout=self.flush_time, pending=pending)
+        self.apply(entries)
+        if not pending and len(entries) < self.batch_size:
+            # Пачка неполная - копим события до следующей записи
+            time.sleep(max(0, self.flush_time - (time.time() - started)))
+        return entries
+
+    def take_over_pending(self):
+        # Применяет события, прочитанные, но не подтвержденные до перезапуска, в том числе прежним процессом
+        # под другим именем. Recorder один, поэтому забираются все события группы сразу, раньше новых:
+        # порядок событий задачи сохраняется
+        while True:
+            claimed = self.manager.claim(self.consumer, 0, self.batch_size)
+            while self.loop(pending=True):
+                pass
+            if not claimed:
+                return
+
+    def run(self):
+        self.recorder_log('Recorder started as consumer {}'.format(self.consumer))
+        try:
+            self.manager.create_group()
+            self.take_over_pending()
+            while True:
+                self.loop()
+        except Exception as e:
+            self.recorder_log(e, 'exception')
+            sys.exit(1)
@@ -1,10 +1,27 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import datetime
+import json
+import math
+import time
 import uuid
 
+from redis.exceptions import ResponseError
+
+from shire.const import JOB_PRIORITY_MAX, JOB_PRIORITY_MIN
 from shire.exceptions import PoolInvalidStatusException
 
-__all__ = ['QueueManager', 'PoolStatusManager', 'LogMessageManager']
+__all__ = [
+    'QueueManager', 'PoolStatusManager', 'LogMessageManager', 'JobCounterManager', 'WakeupManager',
+    'DelayQueueManager', 'LogStreamManager', 'JobEventManager', 'HeartbeatManager', 'SchedulerManager',
+]
+
+
+def to_timestamp(value):
+    if value is None:
+        return time.time()
+    return time.mktime(value.timetuple()) + value.microsecond / 1000000.0
 
 
 class BaseRedisManager(object):
@@ -14,30 +31,81 @@ class BaseRedisManager(object):
 
 
 class QueueManager(BaseRedisManager):
+    # Отдельный список на каждый приоритет, приоритет 0 - в общем списке пула.
+    # Пул забирает задачи одним BRPOP по всем спискам, начиная с высшего приоритета
     PATH = 'shire:to_execute:{pool}'
+    PRIORITY_PATH = PATH + ':p{priority}'
+    PRIORITIES = tuple(range(JOB_PRIORITY_MAX, JOB_PRIORITY_MIN - 1, -1))
+
+    @classmethod
+    def get_key(cls, pool, priority=JOB_PRIORITY_MIN):
+        if not priority:
+            return cls.PATH.format(pool=pool)
+        return cls.PRIORITY_PATH.format(pool=pool, priority=priority)
+
+    @classmethod
+    def get_keys(cls, pools):
+        # {key: pool} в порядке опроса: сначала приоритет, затем порядок pools
+        keys = collections.OrderedDict()
+        for priority in cls.PRIORITIES:
+            for pool in pools:
+                keys[cls.get_key(pool, priority)] = pool
+        return keys
 
-    def push(self, pool, job_id, to_tail=False):
-        key = self.PATH.format(pool=pool)
+    def push(self, pool, job_id, to_tail=False, priority=JOB_PRIORITY_MIN):
+        key = self.get_key(pool, priority)
         if to_tail:
             return self.db.rpush(key, str(job_id))
         return self.db.lpush(key, str(job_id))
 
+    def push_many(self, jobs):
+        # jobs - {(pool, priority): [job_id, ...]}. Один LPUSH на список, все списки за один round trip
+        pipe = self.db.pipeline(transaction=False)
+        for (pool, priority), job_ids in jobs.items():
+            if job_ids:
+                pipe.lpush(self.get_key(pool, priority), *[str(job_id) for job_id in job_ids])
+        return pipe.execute()
+
     def pop(self, pool, timeout=None):
-        key = self.PATH.format(pool=pool)
-        res = self.db.brpop(key, timeout=timeout)
+        pool, job_id = self.pop_any([pool], timeout=timeout)
+        return job_id
+
+    def pop_any(self, pools, timeout=None):
+        # BRPOP по нескольким очередям: очереди проверяются в порядке pools. Возвращает (pool, job_id)
+        key, pool, job_id = self.pop_with_key(pools, timeout=timeout)
+        return pool, job_id
+
+    def pop_with_key(self, pools, timeout=None):
+        # Как pop_any, но еще и список, из которого забрана задача: (key, pool, job_id)
+        keys = self.get_keys(pools)
+        res = self.db.brpop(list(keys), timeout=timeout)
         if res:
             key, job_id = res
-            return job_id.decode()
-        return None
+            key = key.decode()
+            return key, keys[key], job_id.decode()
+        return None, None, None
+
+    def push_back(self, key, job_id):
+        # Возвращает забранную задачу в тот же список, откуда её заберут первой - приоритет сохраняется
+        return self.db.rpush(key, str(job_id))
 
     def show_queue(self, pool):
-        return self.db.lrange(self.PATH.format(pool=pool), 0, -1)
+        # Как и для одного списка: задачи, которые пул заберет первыми, в конце
+        pipe = self.db.pipeline(transaction=False)
+        for key in reversed(list(self.get_keys([pool]))):
+            pipe.lrange(key, 0, -1)
+        return [job_id for job_ids in pipe.execute() for job_id in job_ids]
 
 
 class PoolStatusManager(BaseRedisManager):
     BASE_PATH = 'shire:pool'
     POOL_PATH = BASE_PATH + ':{pool}'
     UUID_PATH = POOL_PATH + ':{uuid}'
+    REGISTRY_PATH = 'shire:pools'
+    POOL_UUIDS_PATH = 'shire:pool_uuids:{pool}'
+    ID_FORMAT = '{pool}:{uuid}'
+    # Канал, в который публикуются изменения статуса пула - пул держит статус в памяти
+    CHANNEL_PATH = 'shire:pool_status:{pool}:{uuid}'
 
     STATUS_ACTIVE = 'active'
     STATUS_DEAD = 'dead'
@@ -45,12 +113,27 @@ class PoolStatusManager(BaseRedisManager):
     STATUS_TERMITATED = 'terminated'
     _valid_statuses = (STATUS_ACTIVE, STATUS_DEAD, STATUS_KILL, STATUS_TERMITATED)
 
+    def _get_ids(self, pool=None):
+        # Реестр пулов вместо KEYS: общий набор '{pool}:{uuid}' и набор uuid для каждого имени пула
+        if pool:
+            return sorted((pool, _uuid.decode()) for _uuid in self.db.smembers(self.POOL_UUIDS_PATH.format(pool=pool)))
+        return sorted(tuple(_id.decode().rsplit(':', 1)) for _id in self.db.smembers(self.REGISTRY_PATH))
+
     def get_all(self, pool=None):
-        keys = self.POOL_PATH.format(pool=pool) + ':*' if pool else self.BASE_PATH + ':*'
-        value = self.db.keys(keys)
-        if value:
-            return [v.decode() for v in value]
-        return value
+        return [self.UUID_PATH.format(pool=name, uuid=_uuid) for name, _uuid in self._get_ids(pool)]
+
+    def get_statuses(self, pool=None):
+        # [(pool, uuid, status), ...] за два обращения к redis
+        ids = self._get_ids(pool)
+        if not ids:
+            return []
+        pipe = self.db.pipeline(transaction=False)
+        for name, _uuid in ids:
+            pipe.hget(self.UUID_PATH.format(pool=name, uuid=_uuid), 'status')
+        return [
+            (name, _uuid, status.decode() if status else status)
+            for (name, _uuid), status in zip(ids, pipe.execute())
+        ]
 
     def get_status(self, pool, _uuid):
         value = self.db.hget(self.UUID_PATH.format(pool=pool, uuid=_uuid), 'status')
@@ -61,10 +144,40 @@ class PoolStatusManager(BaseRedisManager):
     def set_status(self, pool, _uuid, status):
         if status not in self._valid_statuses:
             raise PoolInvalidStatusException(status)
-        return self.db.hset(self.UUID_PATH.format(pool=pool, uuid=_uuid), 'status', status)
+        key = self.UUID_PATH.format(pool=pool, uuid=_uuid)
+        pipe = self.db.pipeline(transaction=False)
+        # hmset устарел, а hset(mapping=...) нет в redis-py < 3.5 и mockredis - пишем поля по одному
+        pipe.hset(key, 'status', status)
+        pipe.hset(key, 'heartbeat', int(time.time()))
+        pipe.sadd(self.REGISTRY_PATH, self.ID_FORMAT.format(pool=pool, uuid=_uuid))
+        pipe.sadd(self.POOL_UUIDS_PATH.format(pool=pool), str(_uuid))
+        pipe.publish(self.CHANNEL_PATH.format(pool=pool, uuid=_uuid), status)
+        return pipe.execute()[0]
+
+    def subscribe(self, pools, _uuid):
+        # Подтверждения подписки не скрываем: get_message вернул бы на них None, как при отсутствии сообщений
+        pubsub = self.db.pubsub()
+        pubsub.subscribe(*[self.CHANNEL_PATH.format(pool=pool, uuid=_uuid) for pool in pools])
+        return pubsub
+
+    def get_published_statuses(self, pubsub):
+        # Опубликованные с прошлого вызова статусы без ожидания: {pool: status}
+        prefix = self.CHANNEL_PATH.format(pool='', uuid='')[:-1]
+        statuses = {}
+        while True:
+            message = pubsub.get_message()
+            if message is None:
+                return statuses
+            if message['type'] == 'message':
+                pool = message['channel'].decode()[len(prefix):].rsplit(':', 1)[0]
+                statuses[pool] = message['data'].decode()
 
     def del_status(self, pool, _uuid):
-        return self.db.delete(self.UUID_PATH.format(pool=pool, uuid=_uuid))
+        pipe = self.db.pipeline(transaction=False)
+        pipe.delete(self.UUID_PATH.format(pool=pool, uuid=_uuid))
+        pipe.srem(self.REGISTRY_PATH, self.ID_FORMAT.format(pool=pool, uuid=_uuid))
+        pipe.srem(self.POOL_UUIDS_PATH.format(pool=pool), str(_uuid))
+        return pipe.execute()[0]
 
 
 class LogMessageManager(BaseRedisManager):
@@ -79,6 +192,15 @@ class LogMessageManager(BaseRedisManager):
         self.db.set(self.UUID_PATH.format(pool=pool, uuid=_uuid), message, ex=self.EXPIRE_TIME)
         self.db.lpush(self.QUEUE_PATH, self.ID_FORMAT.format(pool=pool, uuid=_uuid))
 
+    def write_many(self, messages):
+        # messages - [(pool, message), ...], запись одним pipeline
+        pipe = self.db.pipeline(transaction=False)
+        for pool, message in messages:
+            _uuid = uuid.uuid4()
+            pipe.set(self.UUID_PATH.format(pool=pool, uuid=_uuid), message, ex=self.EXPIRE_TIME)
+            pipe.lpush(self.QUEUE_PATH, self.ID_FORMAT.format(pool=pool, uuid=_uuid))
+        return pipe.execute()
+
     def pop_next(self, timeout=0):
         res = self.db.brpop(self.QUEUE_PATH, timeout=timeout)
         if res:
@@ -93,3 +215,362 @@ class LogMessageManager(BaseRedisManager):
             self.db.delete(log_path)
         return result
 
+    def pop_batch(self, count, timeout=0):
+        # Ожидаем первую запись, остальные (до count) забираем без ожидания.
+        # Возвращает [(pool, message), ...] в порядке записи, message - None для истекших записей
+        first = self.pop_next(timeout)
+        if not first:
+            return []
+        logs = [first]
+        if count > 1:
+            pipe = self.db.pipeline()
+            pipe.lrange(self.QUEUE_PATH, -(count - 1), -1)
+            pipe.ltrim(self.QUEUE_PATH, 0, -count)
+            rest, _ = pipe.execute()
+            # Новые записи добавляются слева, старые - справа
+            for log in reversed(rest):
+                pool, _uuid = log.decode().split(':', 1)
+                logs.append({'pool': pool, 'uuid': _uuid})
+        paths = [self.UUID_PATH.format(pool=log['pool'], uuid=log['uuid']) for log in logs]
+        pipe = self.db.pipeline(transaction=False)
+        for path in paths:
+            pipe.get(path)
+        pipe.delete(*paths)
+        messages = pipe.execute()[:-1]
+        return [(log['pool'], message) for log, message in zip(logs, messages)]
+
+
+class BaseStreamManager(BaseRedisManager):
+    # Поток с группой потребителей: запись удаляется после подтверждения
+    STREAM_PATH = None
+    GROUP = None
+
+    def create_group(self):
+        try:
+            self.db.xgroup_create(self.STREAM_PATH, self.GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def ack(self, entry_ids):
+        if not entry_ids:
+            return
+        pipe = self.db.pipeline(transaction=False)
+        pipe.xack(self.STREAM_PATH, self.GROUP, *entry_ids)
+        pipe.xdel(self.STREAM_PATH, *entry_ids)
+        return pipe.execute()
+
+    def claim(self, consumer, min_idle_time, count):
+        # Переназначает потребителю consumer записи, которые другие потребители прочитали, но не подтвердили
+        # дольше min_idle_time секунд (процесс упал). XCLAIM сам перепроверяет простой - запись не достанется двоим.
+        # Возвращает количество забранных записей, сами записи читаются через read(pending=True)
+        min_idle = int(min_idle_time * 1000)
+        entry_ids = [
+            x['message_id'] for x in self.db.xpending_range(self.STREAM_PATH, self.GROUP, '-', '+', count)
+            if x['consumer'].decode() != consumer and x['time_since_delivered'] >= min_idle
+        ]
+        if not entry_ids:
+            return 0
+        return len(self.db.xclaim(self.STREAM_PATH, self.GROUP, consumer, min_idle, entry_ids, justid=True))
+
+
+class LogStreamManager(BaseStreamManager):
+    # Транспорт логов через ограниченный Redis Stream: одна команда на запись вместо SET+LPUSH+GET+DEL,
+    # чтение пачками через группу потребителей с подтверждением - несколько scribe не теряют записи
+    STREAM_PATH = 'shire:lstream'
+    GROUP = 'shire_scribe'
+    MAX_LENGTH = 100000
+
+    def __init__(self, connection, max_length=None):
+        super(LogStreamManager, self).__init__(connection)
+        self.max_length = max_length or self.MAX_LENGTH
+
+    def write(self, pool, message):
+        return self.db.xadd(
+            self.STREAM_PATH, {'pool': pool, 'message': message}, maxlen=self.max_length, approximate=True
+        )
+
+    def write_many(self, messages):
+        pipe = self.db.pipeline(transaction=False)
+        for pool, message in messages:
+            pipe.xadd(self.STREAM_PATH, {'pool': pool, 'message': message}, maxlen=self.max_length, approximate=True)
+        return pipe.execute()
+
+    def read(self, consumer, count, timeout=0, pending=False):
+        # pending - перечитать выданные этому потребителю, но не подтвержденные записи (после перезапуска scribe).
+        # Возвращает [(entry_id, pool, message), ...], pool и message - None для уже удаленных записей
+        res = self.db.xreadgroup(
+            self.GROUP, consumer, {self.STREAM_PATH: '0' if pending else '>'}, count=count,
+            block=None if pending else int(timeout * 1000)
+        )
+        entries = []
+        for stream, stream_entries in res or []:
+            for entry_id, fields in stream_entries:
+                if fields:
+                    entries.append((entry_id, fields[b'pool'].decode(), fields[b'message'].decode()))
+                else:
+                    entries.append((entry_id, None, None))
+        return entries
+
+
+class JobEventManager(BaseStreamManager):
+    # Изменения задач от workhorse для пакетной записи в базу процессом recorder.
+    # Поток без ограничения длины: события не должны теряться, подтвержденные записи удаляются
+    STREAM_PATH = 'shire:job_events'
+    GROUP = 'shire_recorder'
+    DATETIME_FIELDS = ('updated_at', 'execute_at', 'ended_at')
+
+    def encode(self, job_id, fields):
+        fields = {
+            name: to_timestamp(value) if name in self.DATETIME_FIELDS and value is not None else value
+            for name, value in fields.items()
+        }
+        return {'job_id': job_id, 'fields': json.dumps(fields)}
+
+    def emit(self, job_id, **fields):
+        # fields - {имя поля JobEntry: значение}
+        return self.db.xadd(self.STREAM_PATH, self.encode(job_id, fields))
+
+    def read(self, consumer, count, timeout=0, pending=False):
+        # Возвращает [(entry_id, job_id, fields), ...] в порядке записи, job_id и fields - None для удаленных записей.
+        # timeout - сколько ждать новых событий, 0 - не ждать
+        res = self.db.xreadgroup(
+            self.GROUP, consumer, {self.STREAM_PATH: '0' if pending else '>'}, count=count,
+            block=int(timeout * 1000) if timeout and not pending else None
+        )
+        entries = []
+        for stream, stream_entries in res or []:
+            for entry_id, data in stream_entries:
+                if not data:
+                    entries.append((entry_id, None, None))
+                    continue
+                fields = json.loads(data[b'fields'].decode())
+                for name in self.DATETIME_FIELDS:
+                    if fields.get(name) is not None:
+                        fields[name] = datetime.datetime.fromtimestamp(fields[name])
+                entries.append((entry_id, int(data[b'job_id']), fields))
+        return entries
+
+
+class JobCounterManager(BaseRedisManager):
+    # Монотонные счетчики поставленных и завершенных задач. Whip считает текущую нагрузку как разницу
+    # с последним снимком, сделанным при сверке с базой данных
+    PATH = 'shire:job_counters'
+    FIELD_FORMAT = '{kind}:{entity}:{name}'
+    TOTAL_FORMAT = '{kind}:total'
+
+    KIND_ENQUEUED = 'enqueued'
+    KIND_COMPLETED = 'completed'
+    ENTITY_POOL = 'pool'
+    ENTITY_QUEUE = 'queue'
+
+    def _incr(self, kind, counts):
+        # counts - {(pool, queue): количество}
+        if not counts:
+            return
+        pipe = self.db.pipeline(transaction=False)
+        for (pool, queue), amount in counts.items():
+            pipe.hincrby(self.PATH, self.TOTAL_FORMAT.format(kind=kind), amount)
+            pipe.hincrby(self.PATH, self.FIELD_FORMAT.format(kind=kind, entity=self.ENTITY_POOL, name=pool), amount)
+            pipe.hincrby(self.PATH, self.FIELD_FORMAT.format(kind=kind, entity=self.ENTITY_QUEUE, name=queue), amount)
+        return pipe.execute()
+
+    def incr_enqueued(self, counts):
+        return self._incr(self.KIND_ENQUEUED, counts)
+
+    def incr_completed(self, counts):
+        return self._incr(self.KIND_COMPLETED, counts)
+
+    def get_all(self):
+        result = {
+            kind: {'total': 0, self.ENTITY_POOL: {}, self.ENTITY_QUEUE: {}}
+            for kind in (self.KIND_ENQUEUED, self.KIND_COMPLETED)
+        }
+        for field, value in self.db.hgetall(self.PATH).items():
+            parts = field.decode().split(':', 2)
+            if parts[0] not in result:
+                continue
+            if len(parts) == 2:
+                result[parts[0]]['total'] = int(value)
+            elif parts[1] in (self.ENTITY_POOL, self.ENTITY_QUEUE):
+                result[parts[0]][parts[1]][parts[2]] = int(value)
+        return result
+
+
+class HeartbeatManager(BaseRedisManager):
+    # Время последней отметки выполняющихся задач по хостам. Hostler находит зависшие задачи через ZRANGEBYSCORE,
+    # не перебирая все выполняющиеся
+    PATH = 'shire:heartbeat:{host}'
+
+    def beat(self, jobs, timestamp=None):
+        # jobs - {job_id: host}
+        if not jobs:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        by_host = collections.defaultdict(dict)
+        for job_id, host in jobs.items():
+            by_host[host][job_id] = timestamp
+        pipe = self.db.pipeline(transaction=False)
+        for host, mapping in by_host.items():
+            pipe.zadd(self.PATH.format(host=host), mapping)
+        return pipe.execute()
+
+    def remove(self, host, job_ids):
+        if job_ids:
+            return self.db.zrem(self.PATH.format(host=host), *job_ids)
+
+    def get_expired(self, host, before, count=None):
+        # Задачи хоста без отметки с before (timestamp), не больше count
+        return [int(x) for x in self.db.zrangebyscore(
+            self.PATH.format(host=host), '-inf', before, start=0 if count else None, num=count
+        )]
+
+
+class SchedulerManager(BaseRedisManager):
+    # Отметка работающего scheduler: пока она есть, CrontabJob не создает задачи и не перезапускает себя
+    PATH = 'shire:scheduler'
+
+    def mark_alive(self, ttl):
+        return self.db.set(self.PATH, time.time(), ex=max(1, int(math.ceil(ttl))))
+
+    def is_alive(self):
+        return bool(self.db.exists(self.PATH))
+
+
+class WakeupManager(BaseRedisManager):
+    # Сигналы для whip о появлении задач, чтобы не опрашивать базу каждые check_time секунд
+    PATH = 'shire:wakeup:{host}'
+    SIGNAL_FORMAT = '{pool}:{timestamp}'
+    MAX_LENGTH = 1000  # whip нужен сам факт сигнала, поэтому хвост можно не хранить
+
+    def notify(self, host, pool, execute_at=None):
+        timestamp = to_timestamp(execute_at)
+        key = self.PATH.format(host=host)
+        pipe = self.db.pipeline(transaction=False)
+        pipe.lpush(key, self.SIGNAL_FORMAT.format(pool=pool, timestamp=timestamp))
+        pipe.ltrim(key, 0, self.MAX_LENGTH - 1)
+        return pipe.execute()
+
+    def wait(self, host, timeout):
+        # Блокируется до первого сигнала и забирает все накопившиеся. Возвращает [(pool, timestamp), ...]
+        key = self.PATH.format(host=host)
+        res = self.db.brpop(key, timeout=max(1, int(math.ceil(timeout))))
+        if not res:
+            return []
+        pipe = self.db.pipeline(transaction=True)
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        rest, _ = pipe.execute()
+        signals = []
+        for value in [res[1]] + list(rest):
+            pool, timestamp = value.decode().rsplit(':', 1)
+            signals.append((pool, float(timestamp)))
+        return signals
+
+
+class DelayQueueManager(BaseRedisManager):
+    # Отложенные задачи хоста в ZSET с execute_at в качестве score. Whip переносит наступившие задачи
+    # в очереди пулов атомарно, соблюдая лимиты, без запросов к базе данных
+    PATH = 'shire:delayed:{host}'
+    MOVE_LIMIT = 1000
+
+    # Все ключи передаются через KEYS, но очереди разных пулов и zset хоста лежат в разных слотах,
+    # поэтому Redis Cluster не поддерживается - только одиночный redis (в том числе с Sentinel).
+    # KEYS[1] - zset отложенных задач, KEYS[2..] - очереди пулов.
+    # ARGV[1] - оставшиеся слоты в json: {"total": n, "pools": {pool: n}, "queues": {queue: n}}, n < 0 - без лимита,
+    # далее пары: member - json [id, pool, queue, priority] (priority может отсутствовать), номер ключа его очереди
+    MOVE_SCRIPT = '''
+        local limits = cjson.decode(ARGV[1])
+        local moved = {}
+        for i = 2, #ARGV, 2 do
+            if limits['total'] == 0 then
+                break
+            end
+            local member = ARGV[i]
+            -- задачу мог уже перенести другой whip
+            if redis.call('ZSCORE', KEYS[1], member) then
+                local job = cjson.decode(member)
+                local pool, queue = job[2], job[3]
+                local pool_left = limits['pools'][pool]
+                local queue_left = limits['queues'][queue]
+                if (pool_left == nil or pool_left ~= 0) and (queue_left == nil or queue_left ~= 0) then
+                    redis.call('LPUSH', KEYS[tonumber(ARGV[i + 1])], job[1])
+                    redis.call('ZREM', KEYS[1], member)
+                    if limits['total'] > 0 then
+                        limits['total'] = limits['total'] - 1
+                    end
+                    if pool_left ~= nil then
+                        limits['pools'][pool] = pool_left - 1
+                    end
+                    if queue_left ~= nil then
+                        limits['queues'][queue] = queue_left - 1
+                    end
+                    table.insert(moved, member)
+                end
+            end
+        end
+        return moved
+    '''
+
+    def __init__(self, connection):
+        super(DelayQueueManager, self).__init__(connection)
+        self._move_script = None
+
+    @classmethod
+    def make_member(cls, job_id, pool, queue, priority=JOB_PRIORITY_MIN):
+        if not priority:
+            return json.dumps([str(job_id), pool, queue])
+        return json.dumps([str(job_id), pool, queue, priority])
+
+    def add(self, host, job_id, pool, queue, execute_at, priority=JOB_PRIORITY_MIN):
+        # ZADD идемпотентен для одного и того же member, повторная постановка безопасна
+        return self.db.execute_command(
+            'ZADD', self.PATH.format(host=host), to_timestamp(execute_at),
+            self.make_member(job_id, pool, queue, priority)
+        )
+
+    def add_many(self, host, jobs, execute_at):
+        # jobs - [(job_id, pool, queue, priority), ...] с одним временем выполнения, одной командой ZADD
+        if not jobs:
+            return
+        score = to_timestamp(execute_at)
+        args = []
+        for job_id, pool, queue, priority in jobs:
+            args.extend((score, self.make_member(job_id, pool, queue, priority)))
+        return self.db.execute_command('ZADD', self.PATH.format(host=host), *args)
+
+    def remove_many(self, host, jobs):
+        # jobs - [(job_id, pool, queue, priority), ...]
+        if jobs:
+            return self.db.zrem(self.PATH.format(host=host), *[self.make_member(*job) for job in jobs])
+
+    def get_next_time(self, host):
+        res = self.db.zrange(self.PATH.format(host=host), 0, 0, withscores=True)
+        if res:
+            return float(res[0][1])
+        return None
+
+    def move_due(self, host, limits, count=None):
+        # Возвращает [(job_id, pool, queue), ...] перенесенных задач. Наступившие задачи читаются заранее,
+        # чтобы передать скрипту ключи их очередей
+        key = self.PATH.format(host=host)
+        due = self.db.zrangebyscore(key, '-inf', time.time(), start=0, num=count or self.MOVE_LIMIT)
+        if not due:
+            return []
+        keys = [key]
+        args = [json.dumps(limits)]
+        key_numbers = {}
+        for member in due:
+            job = json.loads(member.decode())
+            queue_key = QueueManager.get_key(job[1], job[3] if len(job) > 3 else JOB_PRIORITY_MIN)
+            if queue_key not in key_numbers:
+                keys.append(queue_key)
+                key_numbers[queue_key] = len(keys)
+            args.extend((member, key_numbers[queue_key]))
+        if self._move_script is None:
+            self._move_script = self.db.register_script(self.MOVE_SCRIPT)
+        result = []
+        for member in self._move_script(keys=keys, args=args):
+            job_id, pool, queue = json.loads(member.decode())[:3]
+            result.append((int(job_id), pool, queue))
+        return result
@@ -1,12 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import datetime
+import heapq
+import sys
+import time
 
 import croniter
 
 from shire.job import Job
-from shire.models import Crontab, JobEntry
-from shire.utils import create_logger
+from shire.models import db, Crontab, JobEntry
+from shire.redis_managers import DelayQueueManager, SchedulerManager, WakeupManager, to_timestamp
+from shire.utils import create_console_handler, create_logger
+
+
+__all__ = ['CrontabJob', 'Scheduler']
+
+
+def make_job_row(crontab, execute_at):
+    # Строка задачи кронтаба для JobEntry.insert_rows, с значениями остальных полей по умолчанию
+    return JobEntry(
+        func_call_=crontab.func_call_, pool=crontab.pool, queue=crontab.queue, host=crontab.host,
+        execute_at=execute_at,
+    )._data
 
 
 class CrontabJob(Job):
@@ -19,35 +35,39 @@ class CrontabJob(Job):
         super(CrontabJob, self).__init__(workhorse=workhorse)
 
     def run(self):
+        if SchedulerManager(self.workhorse.config.get_redis()).is_alive():
+            # Кронтабы запускает run_scheduler: завершаемся, не создавая задач и не перезапуская себя
+            self.logger.info(u'Кронтабы запускает scheduler, CrontabJob остановлен')
+            return
         start = datetime.datetime.now()
-        for crontab in Crontab.select():
+        schedule_until = start + datetime.timedelta(minutes=self.SCHEDULE_DELTA_MINUTES)
+        rows = []
+        changes = {}
+        # Только наступающие кронтабы. next_run_at пуст у добавленных в обход Crontab.save - посчитаем его здесь
+        for crontab in Crontab.select().where(
+            (Crontab.next_run_at >> None) | (Crontab.next_run_at <= schedule_until)
+        ):
             schedule_from = crontab.last_scheduled if crontab.last_scheduled else start
-            schedule_until = start + datetime.timedelta(minutes=self.SCHEDULE_DELTA_MINUTES)
             if schedule_until <= schedule_from:
+                changes[crontab.id] = {'next_run_at': crontab.get_next_run(schedule_from)}
                 continue
             croniter_obj = croniter.croniter(
                 expr_format=crontab.cron_string,
                 start_time=schedule_from,
                 ret_type=datetime.datetime
             )
+            fields = {}
             next_run = croniter_obj.get_next()
             while next_run <= schedule_until:
-                try:
-                    JobEntry.create(
-                        func_call_=crontab.func_call_,
-                        pool=crontab.pool,
-                        queue=crontab.queue,
-                        host=crontab.host,
-                        execute_at=next_run,
-                    )
-                    crontab.last_scheduled = next_run
-                    crontab.save()
-                except Exception as e:
-                    self.logger.error(u'Ошибка во время запуска задачи #%s', crontab.id)
-                    self.logger.exception(e)
-                else:
-                    self.logger.info(u'Задача #%s успешно поставлена на выполнение в %s', crontab.id, next_run)
+                rows.append(make_job_row(crontab, next_run))
+                fields['last_scheduled'] = next_run
                 next_run = croniter_obj.get_next()
+            fields['next_run_at'] = next_run
+            changes[crontab.id] = fields
+            if len(rows) >= JobEntry.INSERT_CHUNK_SIZE or len(changes) >= Crontab.UPDATE_CHUNK_SIZE:
+                self.write_schedule(rows, changes)
+                rows, changes = [], {}
+        self.write_schedule(rows, changes)
 
         future_crontab_jobs = list(JobEntry.select().where(
             (JobEntry.execute_at > start) &
@@ -60,9 +80,35 @@ class CrontabJob(Job):
             for job in future_crontab_jobs:
                 job.delete_instance()
         else:
-            self.start_crontab(config=self.workhorse.config, pool=self.workhorse.pool.name,
+            self.start_crontab(config=self.workhorse.config, pool=self.workhorse.job_entry.pool,
                                wait_minutes=self.RERUN_PERIOD_MINUTES)
 
+    def write_schedule(self, rows, changes):
+        # Задачи пачки и новое состояние кронтабов записываются вместе: при ошибке пачка будет запланирована заново
+        if not changes:
+            return
+        try:
+            with db.atomic():
+                JobEntry.insert_rows(rows)
+                Crontab.update_rows(changes)
+        except Exception as e:
+            self.logger.error(u'Ошибка во время запуска задач кронтабов %s', ', '.join(str(x) for x in changes))
+            self.logger.exception(e)
+        else:
+            self.logger.info(u'Запланировано задач: %s, кронтабов: %s', len(rows), len(changes))
+            self.notify_whip(rows)
+
+    def notify_whip(self, rows):
+        # Сигнал после фиксации транзакции, один на хост и пул - с ближайшим запуском
+        execute_at = {}
+        for row in rows:
+            key = (row['host'], row['pool'])
+            if key not in execute_at or row['execute_at'] < execute_at[key]:
+                execute_at[key] = row['execute_at']
+        wakeup = WakeupManager(self.workhorse.config.get_redis())
+        for (host, pool), value in execute_at.items():
+            wakeup.notify(host=host, pool=pool, execute_at=value)
+
     @classmethod
     def start_crontab(cls, *args, **kwargs):
         kwargs['queue'] = cls.CRONTAB_QUEUE
@@ -85,3 +131,145 @@ class CrontabJob(Job):
     def list(cls, config):
         with config.with_db():
             return Crontab.select()
+
+
+class Scheduler(object):
+    # Специально написан по методологии "let it crash".
+    # В случае непредвиденных ситуаций должен быть перезапущен супервайзером, а не пытаться разрешить их самостоятельно,
+    # в ущерб стабильности
+
+    # Замена CrontabJob: ближайшие запуски кронтабов хранятся в куче в памяти, задача создается в момент запуска
+    # и whip сразу получает сигнал. Будущие задачи заранее не создаются, в пулах слоты не занимаются.
+    # Каждый запуск создал бы задачу в каждом экземпляре, поэтому scheduler запускается один на базу
+    CRONTAB_JOB_WAIT = 300  # Секунд ждать завершения уже выполняющегося CrontabJob при старте
+    ALIVE_TTL_RELOADS = 3  # Отметка работающего scheduler живет столько периодов перезагрузки кронтабов
+
+    def __init__(self, config, verbose=False):
+        self.config = config
+        self.verbose = verbose
+        self.scheduler_logger = create_logger('shire.scheduler')
+        if verbose:
+            create_console_handler(self.scheduler_logger)
+        self.section = self.config.section_getter(self.config.SCHEDULER_SECTION)
+        db.initialize(self.config.get_db())
+        redis = self.config.get_redis()
+        self.wakeup = WakeupManager(redis)
+        self.delay_queue = DelayQueueManager(redis)
+        self.manager = SchedulerManager(redis)
+        self.reload_time = float(self.section.get(
+            self.config.SCHEDULER_RELOAD_TIME, self.config.SCHEDULER_RELOAD_TIME_DEFAULT
+        ))
+        self.crontabs = {}
+        self.heap = []  # [(next_run_at, crontab_id), ...]
+        self._last_reload = 0
+
+    def scheduler_log(self, msg, level='info'):
+        if not self.verbose:
+            return
+        getattr(self.scheduler_logger, level)(msg)
+
+    def load_crontabs(self):
+        # Кронтабы перечитываются целиком: так подхватываются добавленные, измененные и удаленные.
+        # next_run_at в базе обновляется при каждом запуске, поэтому куча из базы совпадает с той, что в памяти
+        crontabs = {}
+        changes = {}
+        for crontab in Crontab.select():
+            if crontab.next_run_at is None:
+                crontab.next_run_at = crontab.get_next_run(crontab.last_scheduled)
+                changes[crontab.id] = {'next_run_at': crontab.next_run_at}
+            crontabs[crontab.id] = crontab
+        if changes:
+            Crontab.update_rows(changes)
+        self.crontabs = crontabs
+        self.heap = [(crontab.next_run_at, crontab.id) for crontab in crontabs.values()]
+        heapq.heapify(self.heap)
+        self._last_reload = time.time()
+        self.scheduler_log('{} crontabs loaded'.format(len(crontabs)))
+
+    def stop_crontab_job(self):
+        # Иначе задачи кронтабов создавали бы и CrontabJob, и scheduler. Повторяется при каждой перезагрузке кронтабов:
+        # CrontabJob может быть поставлен заново командой crontab. Уже созданные им задачи не повторятся -
+        # запуски продолжаются с last_scheduled. Возвращает количество поставленных и выполняющихся CrontabJob
+        waiting_statuses = [JobEntry.STATUS_NEW, JobEntry.STATUS_RESTART, JobEntry.STATUS_DELAYED]
+        waiting = list(JobEntry.select(
+            JobEntry.id, JobEntry.host, JobEntry.pool, JobEntry.queue, JobEntry.priority, JobEntry.status
+        ).where(
+            (JobEntry.queue == CrontabJob.CRONTAB_QUEUE) & (JobEntry.status << waiting_statuses)
+        ))
+        if waiting:
+            # Условие на статус - задачу могли уже поставить, тогда она завершится сама, увидев отметку scheduler
+            JobEntry.delete().where(
+                (JobEntry.id << [x.id for x in waiting]) & (JobEntry.status << waiting_statuses)
+            ).execute()
+            delayed = collections.defaultdict(list)
+            for job_entry in waiting:
+                if job_entry.status == JobEntry.STATUS_DELAYED:
+                    delayed[job_entry.host].append((job_entry.id, job_entry.pool, job_entry.queue, job_entry.priority))
+            for host, jobs in delayed.items():
+                self.delay_queue.remove_many(host, jobs)
+            self.scheduler_log('CrontabJob stopped')
+        return JobEntry.select().where(
+            (JobEntry.queue == CrontabJob.CRONTAB_QUEUE)
+            & (JobEntry.status << [JobEntry.STATUS_ENQUEUED, JobEntry.STATUS_IN_PROGRESS])
+        ).count()
+
+    def mark_alive(self):
+        self.manager.mark_alive(self.reload_time * self.ALIVE_TTL_RELOADS)
+
+    def wait_crontab_job(self):
+        # Выполняющийся CrontabJob мог пройти проверку отметки до старта scheduler - ждем, пока он запишет
+        # свои запуски, чтобы загрузить кронтабы после него
+        deadline = time.time() + self.CRONTAB_JOB_WAIT
+        while self.stop_crontab_job() and time.time() < deadline:
+            self.scheduler_log('Waiting for the running CrontabJob')
+            time.sleep(1)
+            self.mark_alive()
+
+    def fire_due(self, now=None):
+        # Создает задачи наступивших запусков, не больше пачки за раз. Пропущенные, пока scheduler не работал,
+        # запуски создаются все, как и у CrontabJob. Возвращает количество созданных задач
+        now = now or datetime.datetime.now()
+        rows = []
+        changes = {}
+        signals = set()
+        while self.heap and self.heap[0][0] <= now and len(rows) < JobEntry.INSERT_CHUNK_SIZE:
+            run_at, crontab_id = heapq.heappop(self.heap)
+            crontab = self.crontabs[crontab_id]
+            rows.append(make_job_row(crontab, run_at))
+            next_run = crontab.get_next_run(run_at)
+            changes[crontab_id] = {'last_scheduled': run_at, 'next_run_at': next_run}
+            heapq.heappush(self.heap, (next_run, crontab_id))
+            signals.add((crontab.host, crontab.pool))
+        if not rows:
+            return 0
+        with db.atomic():
+            JobEntry.insert_rows(rows)
+            Crontab.update_rows(changes)
+        for host, pool in signals:
+            self.wakeup.notify(host=host, pool=pool)
+        self.scheduler_log('{} crontab jobs created'.format(len(rows)))
+        return len(rows)
+
+    def get_sleep_time(self):
+        # До ближайшего запуска, но не дольше перезагрузки кронтабов
+        deadline = self._last_reload + self.reload_time
+        if self.heap:
+            deadline = min(deadline, to_timestamp(self.heap[0][0]))
+        return max(0, deadline - time.time())
+
+    def run(self):
+        self.scheduler_log('Scheduler started, crontabs reload time: {}s'.format(self.reload_time))
+        try:
+            self.mark_alive()
+            self.wait_crontab_job()
+            while True:
+                self.mark_alive()
+                if self._last_reload < (time.time() - self.reload_time):
+                    self.stop_crontab_job()
+                    self.load_crontabs()
+                while self.fire_due() >= JobEntry.INSERT_CHUNK_SIZE:
+                    pass
+                time.sleep(self.get_sleep_time())
+        except Exception as e:
+            self.scheduler_log(e, 'exception')
+            sys.exit(1)
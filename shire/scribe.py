@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 import json
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 import sys
+import time
 
 import datetime
-from shire.redis_managers import LogMessageManager
+import socket
+
+from shire.logger import create_log_manager
 from shire.utils import create_console_handler, create_logger
 
 
@@ -34,10 +38,19 @@ class Scribe(object):
         if verbose:
             create_console_handler(self.scribe_logger)
         self.section = self.config.section_getter(self.config.SCRIBE_SECTION)
-        self.manager = LogMessageManager(self.config.get_redis())
+        self.use_stream = self.config.use_log_stream()
+        self.manager = create_log_manager(self.config)
+        # Свое имя у каждого процесса: под общим именем scribe при старте дописывали бы ожидающие записи друг друга
+        self.consumer = self.section.get(
+            self.config.SCRIBE_CONSUMER, '{}:{}'.format(socket.gethostname(), os.getpid())
+        )
+        self.claim_time = float(self.section.get(self.config.SCRIBE_CLAIM_TIME, self.config.SCRIBE_CLAIM_TIME_DEFAULT))
         self.log_dir = self.section.get(self.config.SCRIBE_DIRECTORY, self.config.SCRIBE_DIRECTORY_DEFAULT)
         self.max_logs = int(self.section.get(self.config.SCRIBE_MAX_LOGS, self.config.SCRIBE_MAX_LOGS_DEFAULT))
         self.log_size = int(self.section.get(self.config.SCRIBE_MAX_SIZE, self.config.SCRIBE_MAX_SIZE_DEFAULT))
+        self.batch_size = max(1, int(self.section.get(
+            self.config.SCRIBE_BATCH_SIZE, self.config.SCRIBE_BATCH_SIZE_DEFAULT
+        )))
         self.handlers = {}
         self.loggers = {}
         self._expired_logs_count = 0
@@ -119,15 +132,72 @@ class Scribe(object):
             self.expired_logs_count += 1
             self.scribe_log('Got expired log for pool {}'.format(log['pool']))
             return
+        self.write_message(log['pool'], log_data)
+
+    def write_message(self, pool, log_data):
+        level, message = self.format_message(log_data)
+        self.get_pool_logger(name=pool).log(level, message)
+
+    def format_message(self, log_data):
         log_data = json.loads(log_data)
         log_data['asctime'] = datetime.datetime.fromtimestamp(log_data['created'])
         # Форматируем оригинальное сообщение лога
         message = self.OUR_FORMATTER % log_data
         if 'exc_text' in log_data:
             message = u'{}\n{}'.format(message, log_data['exc_text'])
-        logger = self.get_pool_logger(name=log['pool'])
-        level = logging._checkLevel(log_data['levelname'])
-        logger.log(level, message)
+        return logging._checkLevel(log_data['levelname']), message
+
+    def write_batch(self, logs):
+        # logs - [(pool, log_data), ...]. Записи группируются по файлам логов,
+        # каждая группа пишется в файл одной операцией с одним сбросом буфера
+        groups = OrderedDict()
+        for pool, log_data in logs:
+            if not log_data:
+                self.expired_logs_count += 1
+                self.scribe_log('Got expired log for pool {}'.format(pool))
+                continue
+            logger = self.get_pool_logger(name=pool)
+            groups.setdefault(logger.name, (logger, []))[1].append(self.format_message(log_data))
+        for logger, messages in groups.values():
+            records = [
+                logger.makeRecord(logger.name, level, '(unknown file)', 0, message, None, None)
+                for level, message in messages if logger.isEnabledFor(level)
+            ]
+            for handler in logger.handlers:
+                self.write_records(handler, records)
+
+    def write_records(self, handler, records):
+        # Аналог RotatingFileHandler.emit для пачки записей: проверка ротации по размеру
+        # делается перед каждой записью, как и в emit, но запись и flush - одни на пачку
+        if not records:
+            return
+        terminator = getattr(handler, 'terminator', '\n')
+        handler.acquire()
+        try:
+            if handler.stream is None:
+                handler.stream = handler._open()
+            handler.stream.seek(0, 2)
+            size = handler.stream.tell()
+            chunk = []
+            for record in records:
+                if record.levelno < handler.level:
+                    continue
+                text = handler.format(record) + terminator
+                if handler.maxBytes > 0 and size + len(text) >= handler.maxBytes:
+                    if chunk:
+                        handler.stream.write(u''.join(chunk))
+                        chunk = []
+                    handler.doRollover()
+                    size = 0
+                chunk.append(text)
+                size += len(text)
+            if chunk:
+                handler.stream.write(u''.join(chunk))
+            handler.flush()
+        except Exception:
+            handler.handleError(records[-1])
+        finally:
+            handler.release()
 
     def run(self):
         self.scribe_log('Scribe started')
@@ -138,12 +208,56 @@ class Scribe(object):
         )
         self.scribe_log('Logs directory: {}'.format(self.log_dir))
         try:
-            while True:
-                log = self.manager.pop_next(self.POP_TIMEOUT)
-                if log:
-                    self.write_log(log)
+            if self.use_stream:
+                self.read_stream()
+            else:
+                self.read_list()
         except Exception as e:
             self.system.exception(e)
             self.system.error('Scribe process terminated')
             self.scribe_log(e, 'exception')
             sys.exit(1)
+
+    def read_list(self):
+        while True:
+            if self.batch_size > 1:
+                self.write_batch(self.manager.pop_batch(self.batch_size, self.POP_TIMEOUT))
+                continue
+            log = self.manager.pop_next(self.POP_TIMEOUT)
+            if log:
+                self.write_log(log)
+
+    def write_entries(self, entries):
+        # Записи, вытесненные из потока по ограничению длины, считаются истекшими
+        self.write_batch([(pool, message) for entry_id, pool, message in entries])
+        self.manager.ack([entry_id for entry_id, pool, message in entries])
+
+    def read_pending(self):
+        # Дописывает записи, выданные этому потребителю, но не подтвержденные
+        while True:
+            entries = self.manager.read(self.consumer, count=self.batch_size, pending=True)
+            if not entries:
+                return
+            self.write_entries(entries)
+
+    def claim_idle(self):
+        # Дописывает записи упавших scribe, не подтвержденные дольше claim_time секунд
+        claimed = 0
+        while True:
+            count = self.manager.claim(self.consumer, self.claim_time, self.batch_size)
+            if not count:
+                return claimed
+            claimed += count
+            self.read_pending()
+
+    def read_stream(self):
+        self.scribe_log('Reading logs from stream as consumer {}'.format(self.consumer))
+        self.manager.create_group()
+        # Сначала дописываем записи, прочитанные, но не подтвержденные до перезапуска
+        self.read_pending()
+        last_claim = time.time()
+        while True:
+            if time.time() - last_claim >= self.claim_time:
+                self.claim_idle()
+                last_claim = time.time()
+            self.write_entries(self.manager.read(self.consumer, count=self.batch_size, timeout=self.POP_TIMEOUT))
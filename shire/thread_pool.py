@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+import warnings
+
+import setproctitle
+
+from shire.const import SHIRE_WORKHORSE_PROCESS_NAME
+from shire.models import db
+from shire.pool import Pool
+from shire.redis_managers import PoolStatusManager
+from shire.workhorse import ThreadWorkhorse
+
+
+__all__ = ['ThreadPool']
+
+
+class ThreadPool(Pool):
+    # Пул, выполняющий задачи в потоках одного процесса. Подходит для задач, которые в основном ждут ввода-вывода.
+    # Учет статусов задач тот же, что и у обычного пула: каждая задача выполняется через свой Workhorse
+    MAX_WORKHORSES = 100
+    BACKEND_NAME = 'thread'
+
+    def __init__(self, *args, **kwargs):
+        super(ThreadPool, self).__init__(*args, **kwargs)
+        self._threads = []
+
+    def prepare_process(self):
+        # Задачи выполняются в процессе пула, поэтому hostler должен узнавать его как workhorse
+        setproctitle.setproctitle('{} pool={} backend={}'.format(
+            SHIRE_WORKHORSE_PROCESS_NAME, self.name, self.BACKEND_NAME
+        ) + ' ' * 128)
+        # peewee держит отдельное соединение на каждый поток
+        db.initialize(self.config.get_db())
+
+    def run(self):
+        self.prepare_process()
+        # catch_warnings в потоках задач использовать нельзя: предупреждения отключаются на время работы пула,
+        # при выходе фильтры процесса восстанавливаются
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            super(ThreadPool, self).run()
+
+    def _start_workhorse(self, job_id):
+        self.pool_log('Thread for job #{} started'.format(job_id))
+        thread = threading.Thread(target=self._run_job, args=(job_id,), name='job_{}'.format(job_id))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _run_job(self, job_id):
+        try:
+            ThreadWorkhorse(pool=self, job_id=job_id).execute()
+        finally:
+            db.close()
+            # освободилось место - будим основной цикл пула
+            self.notify_child_wakeup()
+
+    def _get_children_count(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        return len(self._threads)
+
+    def get_live_pids(self):
+        # Задачи выполняются в процессе пула
+        return [os.getpid()] if self._get_children_count() else []
+
+    def update_jobs(self, pids):
+        # База уже подключена в prepare_process, with_db переинициализировал бы её для всех потоков
+        return self._update_jobs(pids)
+
+    def kill_children(self):
+        # Потоки не убить по отдельности - завершаем процесс целиком, незавершенные задачи перезапустит hostler.
+        # Выход обычный, с finally и atexit: потоки задач - daemon и завершение процесса не задерживают
+        self.pool_log('Pool "{}" killed with {} running jobs'.format(self.name, self._get_children_count()))
+        self.set_status(PoolStatusManager.STATUS_TERMITATED)
+        self.log.flush()
+        sys.exit(1)
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import collections
 import logging
 import os
 import sys
+import threading
+import time
+import weakref
 
 import datetime
 
@@ -11,8 +15,9 @@ from shire.const import SHIRE_WORKHORSE_PROCESS_NAME
 
 
 __all__ = [
-    'to_list', 'check_pid_is_shire', 'capture_output', 'cleanup_old_jobs', 'execute_job', 'create_console_handler',
-    'activate_venv', 'is_venv',
+    'to_list', 'check_pid_is_shire', 'capture_output', 'capture_thread_output', 'StreamingOutput', 'process_in_batches',
+    'cleanup_old_jobs', 'archive_ended_jobs', 'execute_job', 'create_console_handler', 'activate_venv', 'is_venv',
+    'get_rss',
 ]
 
 
@@ -44,10 +49,21 @@ def check_pid_is_shire(pid):
     proc = '/proc/{}/cmdline'.format(pid)
     if os.path.exists(proc):
         with open(proc, 'rb') as f:
-            return f.read().startswith(SHIRE_WORKHORSE_PROCESS_NAME)
+            return f.read().startswith(SHIRE_WORKHORSE_PROCESS_NAME.encode())
     return False
 
 
+def get_rss():
+    # Текущий RSS процесса в байтах
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss - пиковое значение в килобайтах, но для контроля утечек подходит
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 class capture_output(object):
     def __init__(self, stdout=None, stderr=None):
         self._stdout = stdout or sys.stdout
@@ -66,11 +82,244 @@ class capture_output(object):
         sys.stderr = self.old_stderr
 
 
-def cleanup_old_jobs(days_ago=7):
-    from shire.models import JobEntry
+class ThreadLocalOutput(object):
+    # Подмена sys.stdout/sys.stderr, пишущая в поток, назначенный текущему треду, или в исходный поток
+    def __init__(self, original):
+        self.original = original
+        self.local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.original
+
+    def write(self, data):
+        return self.target.write(data)
+
+    def flush(self):
+        return self.target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+_thread_output_lock = threading.Lock()
+
+
+class capture_thread_output(object):
+    # Аналог capture_output для многопоточного выполнения: перехватывает вывод только текущего потока
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __enter__(self):
+        with _thread_output_lock:
+            if not isinstance(sys.stdout, ThreadLocalOutput):
+                sys.stdout = ThreadLocalOutput(sys.stdout)
+            if not isinstance(sys.stderr, ThreadLocalOutput):
+                sys.stderr = ThreadLocalOutput(sys.stderr)
+        sys.stdout.local.stream = self._stream
+        sys.stderr.local.stream = self._stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stream.flush()
+        sys.stdout.local.stream = None
+        sys.stderr.local.stream = None
+
+
+class OutputFlusher(object):
+    # Поток, отправляющий накопленный вывод задач, которые после print() долго ничего не пишут:
+    # сама запись проверяет flush_time только при следующем write. Один на процесс, после fork создается заново
+    CHECK_TIME = 0.5
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.streams = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, stream):
+        with self._lock:
+            self.streams.add(stream)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='shire_output_flusher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, stream):
+        with self._lock:
+            self.streams.discard(stream)
+
+    def run(self):
+        while True:
+            time.sleep(self.CHECK_TIME)
+            with self._lock:
+                streams = list(self.streams)
+            for stream in streams:
+                stream.flush_due()
+
+
+_output_flusher = None
+_output_flusher_lock = threading.Lock()
+
+
+def get_output_flusher():
+    global _output_flusher
+    with _output_flusher_lock:
+        if _output_flusher is None or _output_flusher.pid != os.getpid():
+            _output_flusher = OutputFlusher()
+        return _output_flusher
+
+
+class StreamingOutput(object):
+    # Приемник вывода задачи вместо StringIO: передает вывод в emit по ходу выполнения, память ограничена.
+    # Целые строки уходят раз в flush_time секунд, при накоплении chunk_size символов или по flush() из задачи,
+    # незаконченная строка - при закрытии. max_size - ограничение вывода в символах, 0 - без ограничения.
+    # truncate: head - сохраняется начало вывода, tail - конец (выдается при закрытии, в памяти - не больше max_size)
+    TRUNCATE_HEAD = 'head'
+    TRUNCATE_TAIL = 'tail'
+    CHUNK_SIZE = 64 * 1024
+    FLUSH_TIME = 1
+    encoding = 'utf-8'
+
+    def __init__(self, emit, max_size=0, truncate=TRUNCATE_HEAD, chunk_size=CHUNK_SIZE, flush_time=FLUSH_TIME):
+        self.emit = emit
+        self.max_size = max_size
+        self.truncate = truncate
+        self.chunk_size = chunk_size
+        self.flush_time = flush_time
+        self.size = 0
+        self.skipped = 0
+        self.closed = False
+        self._emitted = 0
+        self._emitted_at = time.time()
+        self._pending = []
+        self._pending_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+        # Повторный вход из emit в том же потоке (например, logging пишет об ошибке в перехваченный stderr)
+        # не должен приводить к взаимоблокировке
+        self._lock = threading.RLock()
+        if flush_time:
+            get_output_flusher().add(self)
+
+    def write(self, data):
+        if not data:
+            return
+        with self._lock:
+            self.size += len(data)
+            self._pending.append(data)
+            self._pending_size += len(data)
+            if self._pending_size >= self.chunk_size:
+                self._send_pending(partial=True)
+            elif time.time() - self._emitted_at >= self.flush_time:
+                self._send_pending()
+
+    def flush(self):
+        with self._lock:
+            self._send_pending()
+
+    def flush_due(self):
+        # Отправка по времени для задач, которые перестали писать
+        with self._lock:
+            if not self.closed and time.time() - self._emitted_at >= self.flush_time:
+                self._send_pending()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            get_output_flusher().remove(self)
+            self._send_pending(partial=True)
+            if self._tail:
+                text = ''.join(self._tail)
+                self._tail.clear()
+                if len(text) > self.max_size:
+                    self.skipped += len(text) - self.max_size
+                    text = text[-self.max_size:]
+                if self.skipped:
+                    self.emit(u'... {} characters of output skipped ...'.format(self.skipped))
+                self.emit(text)
+            elif self.skipped:
+                self.emit(u'... {} characters of output skipped ...'.format(self.skipped))
+
+    def isatty(self):
+        return False
+
+    def _send_pending(self, partial=False):
+        # partial - вместе с незаконченной строкой
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        cut = len(text) if partial else text.rfind('\n') + 1
+        self._pending = [text[cut:]] if cut < len(text) else []
+        self._pending_size = len(text) - cut
+        if cut:
+            self._output(text[:cut])
+
+    def _output(self, text):
+        self._emitted_at = time.time()
+        if self.max_size and self.truncate == self.TRUNCATE_TAIL:
+            # Держим не больше max_size символов плюс один кусок
+            self._tail.append(text)
+            self._tail_size += len(text)
+            while self._tail_size - len(self._tail[0]) >= self.max_size:
+                dropped = self._tail.popleft()
+                self._tail_size -= len(dropped)
+                self.skipped += len(dropped)
+            return
+        if self.max_size:
+            allowed = self.max_size - self._emitted
+            if len(text) > allowed:
+                self.skipped += len(text) - max(allowed, 0)
+                text = text[:max(allowed, 0)]
+            if not text:
+                return
+        self._emitted += len(text)
+        self.emit(text)
+
+
+def process_in_batches(model, where, process, batch_size=500, pause=0.1, max_batches=None):
+    # Обрабатывает записи model, подходящие под where, пачками по id: много коротких транзакций вместо одного
+    # большого запроса, который надолго блокирует таблицу. pause - пауза между пачками в секундах.
+    # Возвращает количество обработанных записей
+    total = 0
+    batches = 0
+    while True:
+        ids = [row_id for row_id, in model.select(model.id).where(where).order_by(model.id).limit(batch_size).tuples()]
+        if ids:
+            process(ids)
+            total += len(ids)
+            batches += 1
+        if len(ids) < batch_size or (max_batches and batches >= max_batches):
+            return total
+        time.sleep(pause)
+
+
+def archive_ended_jobs(minutes_ago=60, host=None, batch_size=500, pause=0.1, max_batches=None):
+    # Переносит завершенные задачи в shire_job_archive
+    from shire.models import JobEntry, JobEntryArchive
+    ended_before = datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)
+    where = (JobEntry.status == JobEntry.STATUS_ENDED) & (JobEntry.updated_at < ended_before)
+    if host is not None:
+        where &= (JobEntry.host == host)
+    return process_in_batches(
+        JobEntry, where, JobEntryArchive.archive, batch_size=batch_size, pause=pause, max_batches=max_batches
+    )
+
+
+def cleanup_old_jobs(days_ago=7, batch_size=500, pause=0.1):
+    from shire.models import JobEntry, JobEntryArchive
     days_ago = datetime.date.today() - datetime.timedelta(days=days_ago)
-    query = JobEntry.delete().where(~(JobEntry.updated_at >> None) & (JobEntry.updated_at < days_ago))
-    return query.execute()
+    total = 0
+    for model in (JobEntry, JobEntryArchive):
+        if not model.table_exists():
+            continue
+        total += process_in_batches(
+            model, ~(model.updated_at >> None) & (model.updated_at < days_ago),
+            lambda ids, model=model: model.delete().where(model.id << ids).execute(),
+            batch_size=batch_size, pause=pause
+        )
+    return total
 
 
 def execute_job(job_id, config):
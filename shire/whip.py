@@ -4,9 +4,10 @@ import collections
 import time
 
 import datetime
+import peewee
 
 from shire.models import db, JobEntry, Limit, Queue
-from shire.redis_managers import QueueManager
+from shire.redis_managers import DelayQueueManager, JobCounterManager, QueueManager, WakeupManager, to_timestamp
 from shire.utils import create_console_handler, create_logger
 
 
@@ -18,6 +19,8 @@ class Whip(object):
     # В случае непредвиденных ситуаций должен быть перезапущен супервайзером, а не пытаться разрешить их самостоятельно,
     # в ущерб стабильности
 
+    DELAYED_RESTORE_MINUTES = 1  # Отложенные задачи, просроченные дольше этого, возвращаются в redis из базы
+
     def __init__(self, config, verbose=False):
         self.config = config
         self.verbose = verbose
@@ -30,8 +33,29 @@ class Whip(object):
         self.pool_limits = {}
         self.queue_to_pool = {}
         self.max_jobs_limit = int(self.section.get(self.config.WHIP_MAX_JOBS, self.config.WHIP_MAX_JOBS_DEFAULT))
-        self.redis_queue = QueueManager(self.config.get_redis())
+        self.batch_size = max(1, int(self.section.get(
+            self.config.WHIP_BATCH_SIZE, self.config.WHIP_BATCH_SIZE_DEFAULT
+        )))
+        self.reconcile_time = int(self.section.get(
+            self.config.WHIP_RECONCILE_TIME, self.config.WHIP_RECONCILE_TIME_DEFAULT
+        ))
+        self.redis = self.config.get_redis()
+        self.redis_queue = QueueManager(self.redis)
+        self.counters = JobCounterManager(self.redis)
+        self.wakeup = WakeupManager(self.redis)
+        self.use_delay_queue = self.config.use_delay_queue()
+        self.delay_queue = DelayQueueManager(self.redis)
+        self._next_execute_at = 0  # при старте сразу проверяем накопившиеся задачи
+        # Результат последней сверки с базой и снимок счетчиков redis на тот момент
+        self._reconciled_jobs = None
+        self._reconciled_counters = None
+        self._last_reconcile = 0
         self.host = self.section.get(self.config.SHIRE_HOST, self.config.SHIRE_HOST_DEFAULT)
+        # Захват задач через SELECT ... FOR UPDATE SKIP LOCKED позволяет запускать несколько whip на хост.
+        # Включается настройкой skip_locked; sqlite блокировок строк не умеет - с ним whip на хост должен быть один
+        self.use_claim = db.for_update and self.section.get(
+            self.config.WHIP_SKIP_LOCKED, self.config.WHIP_SKIP_LOCKED_DEFAULT
+        ) == '1'
 
     def whip_log(self, msg, level='info'):
         if not self.verbose:
@@ -52,12 +76,14 @@ class Whip(object):
         by_pool = collections.defaultdict(int)
         by_queue = collections.defaultdict(int)
 
-        for job_entry in JobEntry.select(
-                JobEntry.id, JobEntry.pool, JobEntry.queue
-        ).where(JobEntry.status << [JobEntry.STATUS_IN_PROGRESS, JobEntry.STATUS_ENQUEUED]):
-            total += 1
-            by_pool[job_entry.pool] += 1
-            by_queue[job_entry.queue] += 1
+        for pool, queue, count in JobEntry.select(
+                JobEntry.pool, JobEntry.queue, peewee.fn.COUNT(JobEntry.id)
+        ).where(
+            JobEntry.status << [JobEntry.STATUS_IN_PROGRESS, JobEntry.STATUS_ENQUEUED]
+        ).group_by(JobEntry.pool, JobEntry.queue).tuples():
+            total += count
+            by_pool[pool] += count
+            by_queue[queue] += count
 
         return {
             'total': total,
@@ -65,11 +91,148 @@ class Whip(object):
             'by_queue': by_queue
         }
 
+    def get_remaining_limits(self, current):
+        # Свободные слоты в формате, который понимает DelayQueueManager.move_due
+        return {
+            'total': max(self.max_jobs_limit - current['total'], 0),
+            'pools': {
+                pool: max(limit - current['by_pool'].get(pool, 0), 0) for pool, limit in self.pool_limits.items()
+            },
+            'queues': {
+                queue: max(limit - current['by_queue'].get(queue, 0), 0) for queue, limit in self.queue_limits.items()
+            },
+        }
+
+    def enqueue_delayed_jobs(self, current):
+        # Наступившие отложенные задачи уже лежат в очередях пулов, остается обновить статус и счетчики
+        moved = self.delay_queue.move_due(host=self.host, limits=self.get_remaining_limits(current))
+        if not moved:
+            return
+        counts = collections.defaultdict(int)
+        for job_id, pool, queue in moved:
+            counts[(pool, queue)] += 1
+            current['total'] += 1
+            current['by_queue'][queue] += 1
+            current['by_pool'][pool] += 1
+        JobEntry.update(
+            status=JobEntry.STATUS_ENQUEUED, updated_at=datetime.datetime.now()
+        ).where(
+            (JobEntry.id << [job_id for job_id, pool, queue in moved]) & (JobEntry.status == JobEntry.STATUS_DELAYED)
+        ).execute()
+        self.counters.incr_enqueued(counts)
+        self.whip_log('Delayed jobs {} enqueued'.format(', '.join('#{}'.format(x[0]) for x in moved)))
+
+    def restore_delayed_jobs(self):
+        # Страховка: задачи, сохраненные в базе, но не попавшие в redis (например, упал продюсер)
+        restore_before = datetime.datetime.now() - datetime.timedelta(minutes=self.DELAYED_RESTORE_MINUTES)
+        for job_entry in JobEntry.select(
+            JobEntry.id, JobEntry.pool, JobEntry.queue, JobEntry.execute_at, JobEntry.priority
+        ).where(
+            (JobEntry.status == JobEntry.STATUS_DELAYED)
+            & (JobEntry.host == self.host)
+            & (JobEntry.execute_at < restore_before)
+        ):
+            self.delay_queue.add(
+                host=self.host, job_id=job_entry.id, pool=job_entry.pool, queue=job_entry.queue,
+                execute_at=job_entry.execute_at, priority=job_entry.priority
+            )
+
+    def reconcile_current_jobs(self):
+        # Ошибиться можно только в сторону переоценки нагрузки, иначе будут превышены лимиты. Поэтому снимок счетчика
+        # постановок берем до запроса, а завершений - после: задача, поставленная или завершенная в промежутке,
+        # учитывается и в базе, и по разнице счетчиков - до следующей сверки. Для этого и счетчики увеличиваются
+        # после постановки в базе, а завершения - до записи статуса
+        enqueued = self.counters.get_all()[JobCounterManager.KIND_ENQUEUED]
+        self._reconciled_jobs = self.load_current_jobs()
+        self._reconciled_counters = self.counters.get_all()
+        self._reconciled_counters[JobCounterManager.KIND_ENQUEUED] = enqueued
+        self._last_reconcile = time.time()
+        if self.use_delay_queue:
+            self.restore_delayed_jobs()
+        self.whip_log('Current jobs reconciled: {}'.format(self._reconciled_jobs['total']))
+
+    def get_current_jobs(self):
+        # Текущая нагрузка = результат последней сверки + поставлено с тех пор - завершено с тех пор
+        if self._reconciled_jobs is None or self._last_reconcile < (time.time() - self.reconcile_time):
+            self.reconcile_current_jobs()
+            counters = self._reconciled_counters
+        else:
+            counters = self.counters.get_all()
+        snapshot = self._reconciled_counters
+        base = self._reconciled_jobs
+        if any(counters[kind]['total'] < snapshot[kind]['total'] for kind in snapshot):
+            # Счетчики в redis сбросились, доверять разнице нельзя
+            self.reconcile_current_jobs()
+            return self.get_current_jobs()
+
+        current = {
+            'total': base['total'],
+            'by_pool': collections.defaultdict(int, base['by_pool']),
+            'by_queue': collections.defaultdict(int, base['by_queue']),
+        }
+        for kind, sign in ((JobCounterManager.KIND_ENQUEUED, 1), (JobCounterManager.KIND_COMPLETED, -1)):
+            current['total'] += sign * (counters[kind]['total'] - snapshot[kind]['total'])
+            for entity, key in ((JobCounterManager.ENTITY_POOL, 'by_pool'),
+                                (JobCounterManager.ENTITY_QUEUE, 'by_queue')):
+                for name, value in counters[kind][entity].items():
+                    current[key][name] += sign * (value - snapshot[kind][entity].get(name, 0))
+        current['total'] = max(current['total'], 0)
+        for key in ('by_pool', 'by_queue'):
+            for name, value in current[key].items():
+                if value < 0:
+                    current[key][name] = 0
+        return current
+
     def enqueue_job(self, job_entry):
-        self.whip_log('Job #{} enqueued (Pool: {})'.format(job_entry.id, job_entry.pool))
-        self.redis_queue.push(pool=job_entry.pool, job_id=job_entry.id)
-        job_entry.status = JobEntry.STATUS_ENQUEUED
-        job_entry.save(only=[JobEntry.status])
+        return self.enqueue_jobs([job_entry])
+
+    def claim_jobs(self, job_entries):
+        # Блокирует строки еще не поставленных задач до конца транзакции. Строки, заблокированные другим whip,
+        # пропускаются, а уже поставленные им задачи не проходят по статусу
+        claimed = {job_id for job_id, in JobEntry.select(JobEntry.id).where(
+            (JobEntry.id << [x.id for x in job_entries])
+            & (JobEntry.status << [JobEntry.STATUS_NEW, JobEntry.STATUS_RESTART])
+        ).with_lock('UPDATE SKIP LOCKED').tuples()}
+        return [x for x in job_entries if x.id in claimed]
+
+    def enqueue_jobs(self, job_entries):
+        # Возвращает поставленные задачи: при нескольких whip часть пачки может достаться другим
+        if not job_entries:
+            return []
+        if not self.use_claim:
+            self.push_jobs(job_entries)
+        else:
+            # Задачи отправляются в redis до фиксации транзакции: при падении whip статус откатится и задача
+            # будет поставлена повторно, но не потеряется
+            with db.atomic():
+                job_entries = self.claim_jobs(job_entries)
+                self.push_jobs(job_entries)
+        # Счетчик - после фиксации статуса в базе, см. reconcile_current_jobs
+        counts = collections.defaultdict(int)
+        for job_entry in job_entries:
+            counts[(job_entry.pool, job_entry.queue)] += 1
+        self.counters.incr_enqueued(counts)
+        return job_entries
+
+    def push_jobs(self, job_entries):
+        # Пакетная постановка: один pipeline в redis и один UPDATE на всю пачку
+        if not job_entries:
+            return
+        jobs = collections.OrderedDict()
+        for job_entry in job_entries:
+            jobs.setdefault((job_entry.pool, job_entry.priority), []).append(job_entry.id)
+        self.redis_queue.push_many(jobs)
+        # Условие на статус - задачу могли уже взять в работу, пока мы обновляли базу
+        JobEntry.update(
+            status=JobEntry.STATUS_ENQUEUED, updated_at=datetime.datetime.now()
+        ).where(
+            (JobEntry.id << [x.id for x in job_entries])
+            & (JobEntry.status << [JobEntry.STATUS_NEW, JobEntry.STATUS_RESTART])
+        ).execute()
+        for (pool, priority), job_ids in jobs.items():
+            self.whip_log('Jobs {} enqueued (Pool: {}, priority: {})'.format(
+                ', '.join('#{}'.format(x) for x in job_ids), pool, priority
+            ))
 
     def can_enqueue(self, job_entry, current):
         if current['total'] >= self.max_jobs_limit:
@@ -82,20 +245,107 @@ class Whip(object):
             return False
         return True
 
+    def enqueue_due_jobs(self):
+        # Получаем информацию о текущих задачах
+        current = self.get_current_jobs()
+
+        if current['total'] >= self.max_jobs_limit:
+            # Превышено максимальное количество задач
+            return
+
+        if self.use_delay_queue:
+            self.enqueue_delayed_jobs(current)
+
+        # Отправляем на выполнение новые задачи пачками по self.batch_size.
+        # При нехватке слотов первыми уходят задачи с большим приоритетом
+        batch = []
+        for job_entry in JobEntry.select(
+            JobEntry.id, JobEntry.pool, JobEntry.queue, JobEntry.status, JobEntry.priority
+        ).where(
+            (JobEntry.status << [JobEntry.STATUS_NEW, JobEntry.STATUS_RESTART])
+            & (JobEntry.host == self.host)
+            & (JobEntry.execute_at <= datetime.datetime.now())
+        ).order_by(JobEntry.priority.desc(), JobEntry.execute_at.asc()):
+            if self.can_enqueue(job_entry=job_entry, current=current):
+                batch.append(job_entry)
+                current['total'] += 1
+                current['by_queue'][job_entry.queue] += 1
+                current['by_pool'][job_entry.pool] += 1
+                if len(batch) >= self.batch_size:
+                    self.release_slots(batch, self.enqueue_jobs(batch), current)
+                    batch = []
+            if current['total'] >= self.max_jobs_limit:
+                break
+        self.release_slots(batch, self.enqueue_jobs(batch), current)
+
+    def release_slots(self, batch, enqueued, current):
+        # Задачи, захваченные другим whip, учтутся по счетчикам redis - освобождаем занятые под них слоты
+        enqueued_ids = {x.id for x in enqueued}
+        for job_entry in batch:
+            if job_entry.id not in enqueued_ids:
+                current['total'] -= 1
+                current['by_queue'][job_entry.queue] -= 1
+                current['by_pool'][job_entry.pool] -= 1
+
+    def get_next_execute_at(self):
+        # Ближайшая отложенная задача - до неё можно спать, не дожидаясь сигнала
+        value = JobEntry.select(peewee.fn.MIN(JobEntry.execute_at)).where(
+            (JobEntry.status << [JobEntry.STATUS_NEW, JobEntry.STATUS_RESTART])
+            & (JobEntry.host == self.host)
+            & (JobEntry.execute_at > datetime.datetime.now())
+        ).scalar(convert=True)
+        next_time = None if value is None else to_timestamp(value)
+        if self.use_delay_queue:
+            delayed_time = self.delay_queue.get_next_time(self.host)
+            if delayed_time is not None and (next_time is None or delayed_time < next_time):
+                next_time = delayed_time
+        return next_time
+
+    def wait_for_wakeup(self, poll_time):
+        # Ждем сигнала о новых или освободивших слот задачах, но не дольше poll_time и не дольше ближайшей
+        # отложенной задачи. Опрос базы по poll_time остается страховкой от потерянных сигналов
+        deadline = time.time() + poll_time
+        if self._next_execute_at is not None:
+            deadline = min(deadline, self._next_execute_at)
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return
+            if timeout < 1:
+                # brpop не умеет ждать меньше секунды
+                time.sleep(timeout)
+                return
+            now = time.time()
+            for pool, timestamp in self.wakeup.wait(self.host, timeout):
+                if timestamp <= now:
+                    deadline = now
+                else:
+                    deadline = min(deadline, timestamp)
+                    if self._next_execute_at is None or timestamp < self._next_execute_at:
+                        self._next_execute_at = timestamp
+
     def run(self):
         last_update_limits = 0
         update_limits_time = int(self.section.get(
             self.config.WHIP_LIMITS_UPDATE_TIME, self.config.WHIP_LIMITS_UPDATE_TIME_DEFAULT
         ))
         time_to_sleep = int(self.section.get(self.config.WHIP_CHECK_TIME, self.config.WHIP_CHECK_TIME_DEFAULT))
+        use_wakeup = self.section.get(self.config.WHIP_WAKEUP, self.config.WHIP_WAKEUP_DEFAULT) == '1'
+        poll_time = int(self.section.get(self.config.WHIP_POLL_TIME, self.config.WHIP_POLL_TIME_DEFAULT))
         loop_sleep_time = 0
         self.whip_log('Whip stared')
-        self.whip_log('Jobs check time: {}s'.format(time_to_sleep))
+        if use_wakeup:
+            self.whip_log('Jobs wakeup enabled, poll time: {}s'.format(poll_time))
+        else:
+            self.whip_log('Jobs check time: {}s'.format(time_to_sleep))
         self.whip_log('Update queue limits time: {}s'.format(update_limits_time))
+        self.whip_log('Current jobs reconcile time: {}s'.format(self.reconcile_time))
 
         while True:
             next_run = time.time() + time_to_sleep
-            if loop_sleep_time > 0:
+            if use_wakeup:
+                self.wait_for_wakeup(poll_time)
+            elif loop_sleep_time > 0:
                 # Спим только если предыдущее выполнение было короче time_to_sleep
                 time.sleep(loop_sleep_time)
 
@@ -104,26 +354,9 @@ class Whip(object):
                 self.update_limits()
                 last_update_limits = time.time()
 
-            # Получаем информацию о текущих задачах
-            current = self.load_current_jobs()
-
-            if current['total'] >= self.max_jobs_limit:
-                # Превышено максимальное количество задач
-                continue
-
-            # Отправляем на выполнение новые задачи
-            for job_entry in JobEntry.select(
-                JobEntry.id, JobEntry.pool, JobEntry.queue, JobEntry.status
-            ).where(
-                (JobEntry.status << [JobEntry.STATUS_NEW, JobEntry.STATUS_RESTART]) 
-                & (JobEntry.host == self.host)
-                & (JobEntry.execute_at <= datetime.datetime.now())
-            ).order_by(JobEntry.execute_at.asc()):
-                if self.can_enqueue(job_entry=job_entry, current=current):
-                    self.enqueue_job(job_entry=job_entry)
-                    current['total'] += 1
-                    current['by_queue'][job_entry.queue] += 1
-                    current['by_pool'][job_entry.pool] += 1
+            self.enqueue_due_jobs()
+            if use_wakeup:
+                self._next_execute_at = self.get_next_execute_at()
 
             # Компенсируем время, затраченное на выполнение
             loop_sleep_time = next_run - time.time()
@@ -1,21 +1,24 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import setproctitle
 
-import six
 import os
 import uuid
 import sys
+import traceback
 
 import datetime
 import warnings
 
 from shire.const import SHIRE_WORKHORSE_PROCESS_NAME
 from shire.exceptions import RestartJobException
+from shire.heartbeat import get_heartbeat
 from shire.models import JobEntry, db
-from shire.utils import capture_output, activate_venv
+from shire.redis_managers import DelayQueueManager, JobCounterManager, JobEventManager, WakeupManager
+from shire.utils import StreamingOutput, capture_output, capture_thread_output, activate_venv
 
 
-__all__ = ['Workhorse', 'WorkhorseStatusContext']
+__all__ = ['Workhorse', 'ThreadWorkhorse', 'WorkhorseStatusContext']
 
 
 class WorkhorseStatusContext(object):
@@ -29,21 +32,50 @@ class WorkhorseStatusContext(object):
         job_entry.worker_uuid = self.workhorse.uuid
         job_entry.worker_pid = self.workhorse.pid
         job_entry.status = JobEntry.STATUS_IN_PROGRESS
-        job_entry.save(only=[JobEntry.status, JobEntry.worker_uuid, JobEntry.worker_pid, JobEntry.pool_uuid])
+        self.workhorse.save_job_entry([JobEntry.status, JobEntry.worker_uuid, JobEntry.worker_pid, JobEntry.pool_uuid])
+        heartbeat = self.workhorse.heartbeat
+        if heartbeat is not None:
+            heartbeat.add(job_entry.id, job_entry.host)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         exceptions_proceeded = False
+        delayed = False
         job_entry = self.workhorse.job_entry
         if exc_type == RestartJobException:
+            job_entry.status = JobEntry.STATUS_RESTART
             if exc_val.wait_minutes:
                 # задачка хочет рестартовать отложенно
                 job_entry.execute_at = datetime.datetime.now() + datetime.timedelta(minutes=exc_val.wait_minutes)
-            job_entry.status = JobEntry.STATUS_RESTART
+                delayed = self.workhorse.config.use_delay_queue()
+                if delayed:
+                    job_entry.status = JobEntry.STATUS_DELAYED
             exceptions_proceeded = True
         else:
             job_entry.status = JobEntry.STATUS_ENDED
-        job_entry.save(only=[JobEntry.status, JobEntry.execute_at])
+        heartbeat = self.workhorse.heartbeat
+        # Сообщаем whip, что слот в пуле и очереди освободился. Счетчик - до записи статуса:
+        # иначе сверка whip в промежутке учла бы завершение дважды, см. Whip.reconcile_current_jobs
+        if self.workhorse.COUNT_COMPLETED:
+            JobCounterManager(self.workhorse.pool.redis).incr_completed({(job_entry.pool, job_entry.queue): 1})
+        try:
+            self.workhorse.save_job_entry([JobEntry.status, JobEntry.execute_at])
+        except Exception:
+            if heartbeat is not None:
+                # Статус не сохранен: перестаем отмечать задачу, по истечении таймаута её проверит hostler
+                heartbeat.remove(job_entry.id, keep_mark=True)
+            raise
+        if heartbeat is not None:
+            heartbeat.remove(job_entry.id)
+        if delayed:
+            DelayQueueManager(self.workhorse.pool.redis).add(
+                host=job_entry.host, job_id=job_entry.id, pool=job_entry.pool, queue=job_entry.queue,
+                execute_at=job_entry.execute_at, priority=job_entry.priority
+            )
+        WakeupManager(self.workhorse.pool.redis).notify(
+            host=job_entry.host, pool=job_entry.pool,
+            execute_at=job_entry.execute_at if exceptions_proceeded else None
+        )
         return exceptions_proceeded
 
 
@@ -67,6 +99,8 @@ class Daemon(object):
 
 
 class Workhorse(Daemon):
+    # Задачи пулов поставлены whip, который учел их в счетчике enqueued - завершение учитывается в completed
+    COUNT_COMPLETED = True
 
     def __init__(self, pool, job_id):
         super(Workhorse, self).__init__()
@@ -102,6 +136,20 @@ class Workhorse(Daemon):
         )
         return venv_exclusive
 
+    @property
+    def import_by_module(self):
+        return self.config.get(self.config.SHIRE_SECTION, {}).get(
+            self.config.SHIRE_IMPORT_BY_MODULE, self.config.SHIRE_IMPORT_BY_MODULE_DEFAULT
+        ) == '1'
+
+    @property
+    def heartbeat(self):
+        if not self.config.use_heartbeat():
+            return None
+        return get_heartbeat(self.pool.redis, float(self.config.from_section(
+            self.config.SHIRE_SECTION, self.config.SHIRE_HEARTBEAT_TIME, self.config.SHIRE_HEARTBEAT_TIME_DEFAULT
+        )))
+
     def fork(self):
         pid = os.fork()
         if pid:
@@ -109,22 +157,50 @@ class Workhorse(Daemon):
         # унаследовали signal.signal(signal.SIGTERM, pool.terminate)
         # надо сказать инстансу пула, что мы теперь - workhorse
         self.pool.i_am_pool = False
+        self.pool.reset_child_wakeup()
         setproctitle.setproctitle('{} job_id={}'.format(SHIRE_WORKHORSE_PROCESS_NAME, self.job_id) + ' ' * 128)
         # отдельное соединение для потомка
         db.initialize(self.config.get_db())
+        try:
+            sys.exit(0 if self.execute() else 1)
+        finally:
+            self.log.flush()
+            db.close()
+
+    def execute(self):
+        # Выполнение задачи с логированием ошибок, без завершения процесса
         try:
             self.run()
         except Exception as exc:
             self.log.exception('In job #{} with workhorse uuid {} (pool {}/{})'.format(
                 self.job_id, self.uuid, self.pool.name, self.pool.uuid))
-            sys.exit(1)
-        else:
-            sys.exit(0)
-        finally:
-            db.close()
+            return False
+        return True
 
     def run(self):
         self.job_entry = self._load_from_db()
+        self.prepare_environment()
+
+        stream = self.create_output()
+        try:
+            with self.capture(stream):
+                job = self.job_entry.get_job_cls(by_module=self.import_by_module)(workhorse=self)
+                args, kwargs = self.job_entry.get_params()
+                with WorkhorseStatusContext(workhorse=self):
+                    job.run(*args, **kwargs)
+        finally:
+            stream.close()
+
+    def create_output(self):
+        # Вывод задачи уходит в лог по ходу выполнения, а не одной записью в конце
+        section = self.pool.section
+        return StreamingOutput(
+            self.log_output,
+            max_size=int(section.get(self.config.POOL_OUTPUT_MAX_SIZE, self.config.POOL_OUTPUT_MAX_SIZE_DEFAULT)),
+            truncate=section.get(self.config.POOL_OUTPUT_TRUNCATE, self.config.POOL_OUTPUT_TRUNCATE_DEFAULT)
+        )
+
+    def prepare_environment(self):
         # Активация virtual_env
         job_venv_path = self.job_entry.func_call.get(JobEntry.FUNC_CALL_VENV_PATH, None)
         if job_venv_path is not None:
@@ -144,21 +220,46 @@ class Workhorse(Daemon):
                 if path not in sys.path:
                     sys.path.insert(0, path)
 
-        stream = six.StringIO()
+    @contextlib.contextmanager
+    def capture(self, stream):
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
             with capture_output(stream, stream):
-                job = self.job_entry.job_cls(workhorse=self)
-                args, kwargs = self.job_entry.get_params()
-                with WorkhorseStatusContext(workhorse=self):
-                    job.run(*args, **kwargs)
-        output = stream.getvalue() or None
+                yield
+
+    def log_output(self, output):
+        output = output or None
         if output is not None:
             try:
                 self.log.info(u'Got output for job #{}: \n{}'.format(self.job_id, output))
             except UnicodeDecodeError:
                 pass
+            except Exception:
+                # Вызывается из print() задачи: ошибка записи лога не должна ронять задачу.
+                # Сообщаем в настоящий stderr процесса, текущий перехвачен
+                if sys.__stderr__ is not None:
+                    sys.__stderr__.write(u'Output of job #{} is lost:\n{}'.format(self.job_id, traceback.format_exc()))
+
+    def save_job_entry(self, fields):
+        # Сохраняет поля задачи в базу, а при включенных job_events - отправляет изменения recorder
+        if not self.config.use_job_events():
+            self.job_entry.save(only=fields)
+            return
+        self.job_entry.updated_at = datetime.datetime.now()
+        JobEventManager(self.pool.redis).emit(self.job_entry.id, **{
+            field.name: getattr(self.job_entry, field.name) for field in list(fields) + [JobEntry.updated_at]
+        })
 
     def _load_from_db(self):
         job_entry = JobEntry.get(JobEntry.id == self.job_id)
         return job_entry
+
+
+class ThreadWorkhorse(Workhorse):
+    # Выполнение задачи в потоке пула. Перехватывается вывод только своего потока,
+    # а warnings.catch_warnings не потокобезопасен - предупреждения отключает сам пул
+
+    @contextlib.contextmanager
+    def capture(self, stream):
+        with capture_thread_output(stream):
+            yield
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# Только для python 3.5+, импортируется в тестах по условию
+import asyncio
+
+from tests.app.jobs import BaseTestJob
+
+
+class TestAsyncSleepJob(BaseTestJob):
+
+    async def run(self, sleep=None):
+        self.redis.set('test_job {}'.format(self.job_entry.id), 'STARTED')
+        if sleep:
+            await asyncio.sleep(sleep)
+        self.redis.set('test_job {}'.format(self.job_entry.id), 'ENDED')
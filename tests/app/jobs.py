@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import os
 import time
 
 from shire.job import Job
@@ -21,6 +22,13 @@ class TestSleepJob(BaseTestJob):
         self.redis.set('test_job {}'.format(self.job_entry.id), 'ENDED')
 
 
+class TestPidJob(BaseTestJob):
+
+    def run(self):
+        # процесс, выполнивший задачу: по нему видно, переиспользуются ли процессы пула
+        self.redis.set('test_job_pid {}'.format(self.job_entry.id), os.getpid())
+
+
 class TestRestartJob(BaseTestJob):
 
     def run(self, sleep=None, wait_minutes=None):
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+import sys
+
+# Модули с async/await не импортируются под python до 3.5, см. BuildPy в setup.py
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append('app/async_jobs.py')
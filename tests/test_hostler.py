@@ -3,15 +3,21 @@
 import datetime
 import signal
 import random
+import threading
+import time
 
-from shire.models import JobEntry
-from tests.utils import TestWithPid
+from shire.heartbeat import Heartbeat
+from shire.hostler import Hostler
+from shire.models import JobEntry, JobEntryArchive
+from shire.redis_managers import HeartbeatManager
+from tests.utils import TestBase, TestWithPid
 
 
 class TestHostler(TestWithPid):
     def setUp(self):
         self.config[self.config.HOSTLER_SECTION][self.config.HOSTLER_CHECK_TIME] = '0.5'
         self.config.save(self.config_path)
+        super(TestHostler, self).setUp()
 
     @classmethod
     def create_fake_job(cls, **kwargs):
@@ -28,6 +34,28 @@ class TestHostler(TestWithPid):
         defaults.update(kwargs)
         return JobEntry.create_job(**defaults)
 
+    def test_archive_without_table(self):
+        JobEntry.delete().execute()
+        JobEntryArchive.drop_table(True)
+        job_entry = self.create_fake_job(status=JobEntry.STATUS_ENDED)
+        job_entry.save()
+        hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+        JobEntry.update(updated_at=hour_ago).where(JobEntry.id == job_entry.id).execute()
+        hostler = Hostler(config=self.config)
+        hostler.archive_after = 30
+        hostler.archive()
+        self.assertEqual(
+            [x.id for x in JobEntry.select()], [job_entry.id], u'Без таблицы архива задачи остаются на месте'
+        )
+
+        JobEntryArchive.create_table(True)
+        hostler.archive()
+        self.assertEqual(JobEntry.select().count(), 1, u'Повторная проверка таблицы - через archive_time')
+        hostler.last_archived = 0
+        hostler.archive()
+        self.assertEqual(JobEntry.select().count(), 0, u'После migrate_db архивация заработала без перезапуска')
+        self.assertEqual([x.id for x in JobEntryArchive.select()], [job_entry.id])
+
     def test_functional(self):
         hostler_process = self.popen_cli('run_hostler')
         self.active_pid = hostler_process.pid
@@ -54,3 +82,87 @@ class TestHostler(TestWithPid):
         self.check_for_timeout(
             callback=lambda: self.check_pid(self.active_pid), message=u'Hostler завершен некорректно'
         )
+
+
+class TestHeartbeat(TestBase):
+
+    def setUp(self):
+        self.redis.flushall()
+        self.config[self.config.SHIRE_SECTION][self.config.SHIRE_HEARTBEAT] = '1'
+        self.manager = HeartbeatManager(self.redis)
+        self.hostler = Hostler(config=self.config)
+
+    def tearDown(self):
+        del self.config[self.config.SHIRE_SECTION][self.config.SHIRE_HEARTBEAT]
+
+    def create_job(self, worker_pid):
+        job_entry = TestHostler.create_fake_job(status=JobEntry.STATUS_IN_PROGRESS)
+        job_entry.worker_pid = worker_pid
+        job_entry.save()
+        return job_entry
+
+    def test_expired(self):
+        dead_job = self.create_job(worker_pid=0)
+        alive_job = self.create_job(worker_pid=0)
+        self.manager.beat({dead_job.id: JobEntry.HOST_DEFAULT}, timestamp=time.time() - 3600)
+        self.manager.beat({alive_job.id: JobEntry.HOST_DEFAULT})
+        self.hostler.check_heartbeats()
+        self.assertEqual(
+            JobEntry.get(JobEntry.id == dead_job.id).status, JobEntry.STATUS_RESTART, u'Задача без отметок перезапущена'
+        )
+        self.assertEqual(
+            JobEntry.get(JobEntry.id == alive_job.id).status, JobEntry.STATUS_IN_PROGRESS,
+            u'Отмеченная задача не тронута'
+        )
+        self.assertEqual(
+            self.manager.get_expired(JobEntry.HOST_DEFAULT, time.time()), [alive_job.id], u'Проверенная отметка удалена'
+        )
+
+    def test_job_without_heartbeat(self):
+        # Задача выполняется, но отметки в redis нет - находится проверкой по базе
+        job_entry = self.create_job(worker_pid=0)
+        JobEntry.update(updated_at=datetime.datetime.now() - datetime.timedelta(hours=1)).where(
+            JobEntry.id == job_entry.id
+        ).execute()
+        self.hostler.check_jobs()
+        self.assertEqual(JobEntry.get(JobEntry.id == job_entry.id).status, JobEntry.STATUS_RESTART)
+
+        other_job = self.create_job(worker_pid=0)
+        JobEntry.update(updated_at=datetime.datetime.now() - datetime.timedelta(hours=1)).where(
+            JobEntry.id == other_job.id
+        ).execute()
+        self.hostler.check_jobs()
+        self.assertEqual(
+            JobEntry.get(JobEntry.id == other_job.id).status, JobEntry.STATUS_IN_PROGRESS,
+            u'Проверка по базе не чаще stale_check_time'
+        )
+
+    def test_heartbeat_thread(self):
+        heartbeat = Heartbeat(self.redis, interval=0.1)
+        heartbeat.add(1, JobEntry.HOST_DEFAULT)
+        started = time.time()
+        self.check_for_timeout(
+            lambda: self.redis.zscore(HeartbeatManager.PATH.format(host=JobEntry.HOST_DEFAULT), 1) > started,
+            message=u'Отметка обновляется потоком'
+        )
+        heartbeat.remove(1)
+        self.assertEqual(self.manager.get_expired(JobEntry.HOST_DEFAULT, time.time()), [], u'Отметка удалена')
+
+    def test_heartbeat_thread_once(self):
+        # Пул потоков: задачи добавляются одновременно, поток отметок запускается один
+        heartbeat = Heartbeat(self.redis, interval=60)
+        started = threading.Event()
+
+        def add(job_id):
+            started.wait()
+            heartbeat.add(job_id, JobEntry.HOST_DEFAULT)
+
+        before = len([x for x in threading.enumerate() if x.name == 'shire_heartbeat'])
+        threads = [threading.Thread(target=add, args=(job_id,)) for job_id in range(20)]
+        for thread in threads:
+            thread.start()
+        started.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len([x for x in threading.enumerate() if x.name == 'shire_heartbeat']), before + 1)
+        self.assertEqual(len(heartbeat.jobs), 20)
@@ -2,10 +2,12 @@
 
 import json
 import os
+import threading
 from unittest import TestCase
 
+from shire.config import Config
 from shire.logger import RedisLogger
-from shire.redis_managers import LogMessageManager
+from shire.redis_managers import LogMessageManager, LogStreamManager
 
 from tests.utils import TestConfig
 
@@ -96,3 +98,108 @@ class TestRedisLogger(TestCase):
         self.assertEqual(
             self.get_last_queue_message()['uuid'], message_uuid, u'Первый лог на обработку в очереди корректный'
         )
+
+
+class TestBufferedRedisLogger(TestRedisLogger):
+
+    def setUp(self):
+        super(TestBufferedRedisLogger, self).setUp()
+        self.config[self.config.LOGGER_SECTION] = {self.config.LOGGER_BUFFERED: '1'}
+        self.logger = RedisLogger(self.config, self.TEST_POOL)
+        self.redis.flushdb()
+
+    def test_info(self):
+        self.logger.info('test')
+        self.logger.flush()
+        self.assert_redis_has_n_messages(1)
+        message_key, message = self.get_first_message()
+        self.assertEqual(message['message'], 'test', u'Сообщения лога корректно')
+
+    def test_exception(self):
+        try:
+            0 / 0
+        except Exception as e:
+            self.logger.exception(e)
+        self.logger.error('error')
+        self.logger.flush()
+        self.assert_redis_has_n_messages(2)
+
+    def test_flush(self):
+        for i in range(10):
+            self.logger.info('test %s', i)
+        self.logger.flush()
+        self.assert_redis_has_n_messages(10)
+
+    def test_dropped_count(self):
+        self.config[self.config.LOGGER_SECTION] = {
+            self.config.LOGGER_BUFFERED: '1',
+            self.config.LOGGER_BUFFER_SIZE: '1',
+            self.config.LOGGER_OVERFLOW: self.config.LOGGER_OVERFLOW_DROP,
+        }
+        logger = RedisLogger(self.config, self.TEST_POOL)
+
+        def write_logs():
+            for i in range(50):
+                logger.info('test %s', i)
+
+        threads = [threading.Thread(target=write_logs) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.flush()
+        written = reported = 0
+        for key in self.get_messages_in_pool():
+            message = self.load_message(key)['message']
+            if message.startswith('Log buffer is full'):
+                reported += int(message.split()[4])
+            else:
+                written += 1
+        self.assertGreater(reported + logger.dropped_count, 0, u'Буфер переполнялся')
+        self.assertEqual(
+            written + reported + logger.dropped_count, 200, u'Каждая запись либо записана, либо учтена как потерянная'
+        )
+
+
+class TestStreamRedisLogger(TestCase):
+    TEST_POOL = 'test'
+
+    def setUp(self):
+        # mockredis не поддерживает потоки, нужен настоящий redis
+        self.config = Config()
+        self.config.make_default()
+        self.config[Config.CONNECTION_SECTION][Config.CONNECTION_REDIS_URL] = 'redis://localhost:6379/15'
+        self.config[self.config.LOGGER_SECTION] = {self.config.LOGGER_TRANSPORT: self.config.LOGGER_TRANSPORT_STREAM}
+        self.logger = RedisLogger(self.config, self.TEST_POOL)
+        self.redis = self.config.get_redis()
+        self.redis.flushdb()
+        self.manager = LogStreamManager(self.redis)
+        self.manager.create_group()
+
+    def test_info(self):
+        self.logger.info('test')
+        self.assertEqual(self.redis.xlen(LogStreamManager.STREAM_PATH), 1, u'Одна запись в потоке')
+        entries = self.manager.read('test_consumer', count=10, timeout=1)
+        self.assertEqual(len(entries), 1)
+        entry_id, pool, message = entries[0]
+        self.assertEqual(pool, self.TEST_POOL)
+        self.assertEqual(json.loads(message)['message'], 'test', u'Сообщения лога корректно')
+        self.assertEqual(
+            self.manager.read('test_consumer', count=10, pending=True), entries, u'До подтверждения запись в ожидании'
+        )
+        self.manager.ack([entry_id])
+        self.assertEqual(self.manager.read('test_consumer', count=10, pending=True), [], u'Запись подтверждена')
+        self.assertEqual(self.redis.xlen(LogStreamManager.STREAM_PATH), 0, u'Поток пуст')
+
+    def test_claim(self):
+        self.logger.info('test')
+        entries = self.manager.read('dead_consumer', count=10, timeout=1)
+        self.assertEqual(
+            self.manager.claim('test_consumer', 60, 10), 0, u'Свежие записи другого потребителя не забираются'
+        )
+        self.assertEqual(self.manager.claim('test_consumer', 0, 10), 1)
+        self.assertEqual(self.manager.read('dead_consumer', count=10, pending=True), [])
+        self.assertEqual(
+            self.manager.read('test_consumer', count=10, pending=True), entries, u'Запись переназначена целиком'
+        )
+        self.assertEqual(self.manager.claim('test_consumer', 0, 10), 0, u'Свои записи не забираются повторно')
@@ -98,3 +98,25 @@ class TestShireManager(TestCase):
             {'status': PoolStatusManager.STATUS_DEAD, 'name': self.SECOND_TEST_POOL, 'uuid': uuid2},
             u'Информация по второму пулу верна'
         )
+
+    def test_registry(self):
+        uuid1, uuid2 = self.emulate_pools()
+        self.assertEqual(
+            self.pool_manager.get_all(pool=self.FIRST_TEST_POOL),
+            [PoolStatusManager.UUID_PATH.format(pool=self.FIRST_TEST_POOL, uuid=uuid1)],
+            u'Пулы ищутся по реестру имени'
+        )
+        self.pool_manager.del_status(self.FIRST_TEST_POOL, uuid1)
+        self.assertEqual(
+            self.pool_manager.get_statuses(),
+            [(self.SECOND_TEST_POOL, uuid2, PoolStatusManager.STATUS_ACTIVE)],
+            u'Удаленный пул исключен из реестра'
+        )
+
+    def test_status_published(self):
+        uuid1, uuid2 = self.emulate_pools()
+        self.manager.terminate_pools(pools=(self.FIRST_TEST_POOL,))
+        channel = PoolStatusManager.CHANNEL_PATH.format(pool=self.FIRST_TEST_POOL, uuid=uuid1)
+        self.assertEqual(
+            self.redis.pubsub[channel][-1], PoolStatusManager.STATUS_DEAD, u'Новый статус опубликован для пула'
+        )
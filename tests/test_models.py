@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from shire.models import db, JobEntry, JobEntryArchive, create_indexes, migrate_db
+from shire.utils import archive_ended_jobs, cleanup_old_jobs
+
+from tests.utils import TestBase
+
+
+class TestSchema(TestBase):
+
+    def test_create_indexes(self):
+        create_indexes()
+        indexes = {index.name for index in db.obj.get_indexes(JobEntry._meta.db_table)}
+        self.assertTrue(
+            {'shire_job_due', 'shire_job_active', 'shire_job_stale', 'shire_job_ended'} <= indexes,
+            u'Составные индексы созданы'
+        )
+        self.assertEqual(create_indexes(), [], u'Повторно индексы не создаются')
+
+    def test_migrate_db(self):
+        db.obj.execute_sql('DROP TABLE {}'.format(JobEntry._meta.db_table))
+        db.obj.execute_sql(
+            'CREATE TABLE shire_job (id INTEGER PRIMARY KEY, func_call TEXT NOT NULL, pool VARCHAR(256) NOT NULL, '
+            'queue VARCHAR(256) NOT NULL, status VARCHAR(32) NOT NULL, host VARCHAR(256) NOT NULL, '
+            'pool_uuid VARCHAR(64), worker_uuid VARCHAR(64), worker_pid INTEGER, created_at DATETIME NOT NULL, '
+            'execute_at DATETIME NOT NULL, updated_at DATETIME, ended_at DATETIME)'
+        )
+        db.obj.execute_sql(
+            "INSERT INTO shire_job (func_call, pool, queue, status, host, created_at, execute_at) "
+            "VALUES ('{}', 'test', 'test', 'new', 'default', '2017-01-01', '2017-01-01')"
+        )
+        # индекс прежней версии - без priority
+        db.obj.execute_sql('CREATE INDEX shire_job_due ON shire_job (host, status, execute_at)')
+        columns, indexes = migrate_db()
+        self.assertIn('shire_job.priority', columns, u'Добавлена колонка priority')
+        self.assertIn('shire_job_due', indexes)
+        self.assertEqual(
+            [index.columns for index in db.obj.get_indexes(JobEntry._meta.db_table) if index.name == 'shire_job_due'],
+            [['host', 'status', 'priority', 'execute_at']], u'Индекс пересоздан под сортировку по priority'
+        )
+        self.assertEqual(JobEntry.get().priority, JobEntry.PRIORITY_DEFAULT, u'Существующие задачи получили значение')
+        self.assertEqual(migrate_db(), ([], []), u'Повторная миграция ничего не меняет')
+
+
+class TestArchive(TestBase):
+
+    def setUp(self):
+        JobEntryArchive.create_table(True)
+        JobEntry.delete().execute()
+        JobEntryArchive.delete().execute()
+
+    def create_job(self, status, updated_at):
+        job_entry = JobEntry.create_job(file_path='test.py', file_cls='Test', pool='test', queue='test', status=status)
+        job_entry.save()
+        JobEntry.update(updated_at=updated_at).where(JobEntry.id == job_entry.id).execute()
+        return job_entry.id
+
+    def test_archive_ended_jobs(self):
+        hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+        ended_ids = [self.create_job(JobEntry.STATUS_ENDED, hour_ago) for i in range(5)]
+        new_id = self.create_job(JobEntry.STATUS_NEW, hour_ago)
+        recent_id = self.create_job(JobEntry.STATUS_ENDED, datetime.datetime.now())
+        self.assertEqual(archive_ended_jobs(minutes_ago=30, batch_size=2, pause=0), 5, u'Перенесены все пачки')
+        self.assertEqual(
+            sorted(x.id for x in JobEntryArchive.select()), ended_ids, u'В архиве завершенные задачи с теми же id'
+        )
+        self.assertEqual(
+            sorted(x.id for x in JobEntry.select()), [new_id, recent_id], u'Остальные задачи остались на месте'
+        )
+        self.assertEqual(JobEntryArchive.get(JobEntryArchive.id == ended_ids[0]).pool, 'test', u'Поля перенесены')
+
+    def test_max_batches(self):
+        hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+        for i in range(5):
+            self.create_job(JobEntry.STATUS_ENDED, hour_ago)
+        self.assertEqual(archive_ended_jobs(minutes_ago=30, batch_size=2, pause=0, max_batches=1), 2)
+        self.assertEqual(JobEntry.select().count(), 3, u'За проход перенесено не больше max_batches пачек')
+
+    def test_cleanup_old_jobs(self):
+        month_ago = datetime.datetime.now() - datetime.timedelta(days=30)
+        for i in range(3):
+            self.create_job(JobEntry.STATUS_ENDED, month_ago)
+        self.create_job(JobEntry.STATUS_NEW, month_ago)
+        fresh_id = self.create_job(JobEntry.STATUS_ENDED, datetime.datetime.now())
+        archive_ended_jobs(minutes_ago=60, pause=0)
+        self.assertEqual(cleanup_old_jobs(days_ago=7, batch_size=2, pause=0), 4, u'Удалены старые задачи обеих таблиц')
+        self.assertEqual([x.id for x in JobEntry.select()], [fresh_id], u'Свежие задачи не удалены')
+        self.assertEqual(JobEntryArchive.select().count(), 0)
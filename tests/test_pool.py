@@ -1,11 +1,132 @@
 # -*- coding: utf-8 -*-
+import os
 import signal
+import sys
+import threading
 import time
+from unittest import TestCase, skipIf
 
+import setproctitle
+
+from shire.const import SHIRE_WORKHORSE_PROCESS_NAME
+from shire.manager import ShireManager
+from shire.models import JobEntry
+from shire.multi_pool import MultiPool
+from shire.pool import Pool
+from shire.prefork import PreforkPool, PreforkWorker
 from shire.redis_managers import QueueManager, PoolStatusManager
-from shire.utils import decode_if_not_empty
-from tests.app.jobs import TestSleepJob
-from tests.utils import TestBase
+from shire.thread_pool import ThreadPool
+from shire.utils import check_pid_is_shire, decode_if_not_empty
+from shire.workhorse import ThreadWorkhorse
+from tests.app.jobs import TestPidJob, TestSleepJob
+from tests.utils import TestBase, TestConfig
+
+if sys.version_info >= (3, 5):
+    from tests.app.async_jobs import TestAsyncSleepJob
+
+
+class TestPoolChildren(TestCase):
+
+    def setUp(self):
+        self.config = TestConfig()
+        self.config.make_default()
+        self.pool = Pool(config=self.config, name='test_pool')
+        self.pool.setup_child_wakeup()
+
+    def tearDown(self):
+        self.pool.reset_child_wakeup()
+
+    def test_reap(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(3)
+        self.pool._children[pid] = 1
+        started_at = time.time()
+        while self.pool._get_children_count() and time.time() - started_at < 5:
+            self.pool.wait_child_wakeup(5)
+        self.assertEqual(self.pool._get_children_count(), 0, u'Завершившийся потомок убран из учета')
+        self.assertLess(time.time() - started_at, 1, u'Пул разбужен по SIGCHLD, а не по таймауту')
+        self.assertEqual(self.pool.exit_codes[3], 1, u'Код завершения потомка учтен')
+
+
+class TestMultiPool(TestCase):
+
+    def setUp(self):
+        self.config = TestConfig()
+        self.config.make_default()
+        self.redis = self.config.get_redis()
+        self.redis.flushdb()
+        self.pool = MultiPool(config=self.config, names=['first', 'second'])
+        self.pool.set_status(PoolStatusManager.STATUS_ACTIVE)
+
+    def test_pop_order(self):
+        queue = QueueManager(connection=self.redis)
+        queue.push('second', 2)
+        queue.push('first', 1)
+        self.assertEqual(self.pool.pop_job(), ('first', '1'), u'Очереди опрашиваются в заданном порядке')
+        self.assertEqual(self.pool.pop_job(), ('second', '2'))
+
+    def test_name(self):
+        self.assertEqual(self.pool.name, 'multi:first,second', u'Отдельное имя для лога и секции настроек')
+        self.assertEqual(self.pool.get_ignored_sections(), [])
+        self.config['pool:second'] = {self.config.POOL_MAX_WORKHORSES: '5'}
+        self.assertEqual(self.pool.get_ignored_sections(), ['second'], u'Настройки очереди не применяются')
+
+    def test_push_back(self):
+        queue = QueueManager(connection=self.redis)
+        queue.push('second', 1)
+        queue.push('second', 2, priority=5)
+        key, pool, job_id = self.pool.pop_queued_job()
+        self.assertEqual((key, pool, job_id), (QueueManager.get_key('second', 5), 'second', '2'))
+        queue.push_back(key, job_id)
+        self.assertEqual(self.pool.pop_job(), ('second', '2'), u'Возвращенная задача сохранила приоритет')
+
+    def test_status(self):
+        self.assertEqual(
+            sorted(name for name, _uuid, status in PoolStatusManager(self.redis).get_statuses()),
+            ['first', 'second'], u'Пул зарегистрирован под каждым именем'
+        )
+        self.pool._statuses = {'first': PoolStatusManager.STATUS_DEAD, 'second': PoolStatusManager.STATUS_ACTIVE}
+        self.assertEqual(self.pool.get_pop_order(), ['second'], u'Остановленная очередь не опрашивается')
+        self.assertEqual(self.pool.get_pool_status(), PoolStatusManager.STATUS_ACTIVE)
+        self.pool._statuses['second'] = PoolStatusManager.STATUS_DEAD
+        self.assertEqual(self.pool.get_pool_status(), PoolStatusManager.STATUS_DEAD, u'Все очереди остановлены')
+
+    def _fork_workhorse(self):
+        pid = os.fork()
+        if not pid:
+            setproctitle.setproctitle(SHIRE_WORKHORSE_PROCESS_NAME + ' test')
+            time.sleep(30)
+            os._exit(0)
+        self.addCleanup(self._kill_workhorse, pid)
+        started_at = time.time()
+        while not check_pid_is_shire(pid) and time.time() - started_at < 5:
+            time.sleep(0.01)
+        return pid
+
+    @staticmethod
+    def _kill_workhorse(pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            # уже завершен и убран тестом
+            pass
+
+    def test_kill_name(self):
+        queue = QueueManager(connection=self.redis)
+        queue.push('first', 1)
+        queue.push('second', 2)
+        for _ in range(2):
+            key, pool, job_id = self.pool.pop_queued_job()
+            self.pool._children[self._fork_workhorse()] = job_id
+        first_pid, second_pid = sorted(self.pool._children, key=self.pool._children.get)
+        self.pool._statuses = {'first': PoolStatusManager.STATUS_KILL, 'second': PoolStatusManager.STATUS_ACTIVE}
+        self.assertEqual(self.pool.get_pool_status(), PoolStatusManager.STATUS_ACTIVE, u'Пул работает с second')
+        self.pool.kill_names_children()
+        pid, status = os.waitpid(first_pid, 0)
+        self.assertEqual(os.WTERMSIG(status), signal.SIGKILL, u'Задача остановленного по KILL имени уничтожена')
+        self.assertTrue(check_pid_is_shire(second_pid), u'Задача другого имени продолжает выполняться')
 
 
 class TestPoolBase(TestBase):
@@ -27,9 +148,28 @@ class TestPoolBase(TestBase):
         self.subprocesses.append(proc)
         return proc
 
-    def _job_to_queue(self, pool_name, job_sleep_time):
-        job = TestSleepJob.delay(config=self.config, pool=pool_name, queue='abc',
-                                 kwargs=dict(sleep=job_sleep_time))
+    def _set_pool_options(self, pool_name, **options):
+        # настройки секции pool:<name>; config общий для класса тестов, поэтому секцию убираем после теста
+        section = self.config.POOL_NAMED_SECTION.format(name=pool_name)
+        self.config[section] = options
+        self.config.save(self.config_path)
+        self.addCleanup(self.config.save, self.config_path)
+        self.addCleanup(self.config.pop, section, None)
+
+    def _start_pool(self, pool_name, **options):
+        self._set_pool_options(pool_name, **options)
+        self.pool_process = self._start_subproc('run_pool', '--name='+pool_name)
+        return self._get_pool_uuid(pool_name=pool_name)
+
+    def _stop_pool(self, pool_name, _uuid):
+        self.pool_process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.pool_process.wait(), 0)
+        pool_status = self.pool_status_manager.get_status(pool=pool_name, _uuid=_uuid)
+        self.assertEqual(pool_status, PoolStatusManager.STATUS_TERMITATED)
+
+    def _job_to_queue(self, pool_name, job_sleep_time=None, job_cls=TestSleepJob):
+        kwargs = dict(sleep=job_sleep_time) if job_sleep_time is not None else {}
+        job = job_cls.delay(config=self.config, pool=pool_name, queue='abc', kwargs=kwargs)
         redis_queue = QueueManager(connection=self.redis)
         redis_queue.push(job.pool, job.id)
         return job
@@ -132,3 +272,197 @@ class TestPool(TestPoolBase):
         self.assertEqual(pool_status, PoolStatusManager.STATUS_TERMITATED)
 
 
+
+
+    def test_multi_kill_name(self):
+        names = ['test_multi_first', 'test_multi_second']
+        self.pool_process = self._start_subproc('run_multi_pool', '--names=' + ','.join(names))
+        _uuid = self._get_pool_uuid(pool_name=names[0])
+        jobs = [self._job_to_queue(name, 30) for name in names]
+        for job in jobs:
+            self.check_for_timeout(
+                callback=lambda: decode_if_not_empty(self.redis.get('test_job {}'.format(job.id))),
+                check_func=lambda value: value == 'STARTED',
+            )
+        pids = [JobEntry.get(JobEntry.id == job.id).worker_pid for job in jobs]
+
+        manager = ShireManager(self.config)
+        manager.terminate_pools(pools=names[:1])
+        manager.kill_pools(pools=names[:1])
+        self.check_for_timeout(
+            callback=lambda: check_pid_is_shire(pids[0]), check_func=lambda value: not value,
+            message=u'Задача имени, получившего KILL, уничтожена'
+        )
+        self.assertTrue(check_pid_is_shire(pids[1]), u'Задачи остальных имен продолжают выполняться')
+        self.assertIsNone(self.pool_process.poll(), u'Пул работает, пока есть активные имена')
+
+        self.pool_status_manager.set_status(pool=names[1], _uuid=_uuid, status=PoolStatusManager.STATUS_KILL)
+        self.assertEqual(self.pool_process.wait(), 0)
+        self.assertFalse(check_pid_is_shire(pids[1]))
+
+
+class TestPreforkPool(TestPoolBase):
+
+    def tearDown(self):
+        # SIGKILL пула оставил бы его процессы-исполнители разбирать очередь следующих тестов
+        for subproc in self.subprocesses:
+            if subproc.poll() is None:
+                subproc.send_signal(signal.SIGTERM)
+                subproc.wait()
+        super(TestPreforkPool, self).tearDown()
+
+    def _get_job_pids(self, pool_name, jobs_count):
+        # задачи ставим по одной, чтобы каждая следующая попала в процесс после завершения предыдущей
+        pids = []
+        for _ in range(jobs_count):
+            job = self._job_to_queue(pool_name, job_cls=TestPidJob)
+            pids.append(self.check_for_timeout(
+                callback=lambda: decode_if_not_empty(self.redis.get('test_job_pid {}'.format(job.id))),
+                timeout=10,
+            ))
+        return pids
+
+    def _start_pool(self, pool_name, **options):
+        options.update({self.config.POOL_BACKEND: self.config.POOL_BACKEND_PREFORK,
+                        self.config.POOL_MAX_WORKHORSES: '1'})
+        return super(TestPreforkPool, self)._start_pool(pool_name, **options)
+
+    def test_worker_reuse(self):
+        pool_name = 'test_prefork'
+        _uuid = self._start_pool(pool_name)
+        pids = self._get_job_pids(pool_name, 3)
+        self.assertEqual(len(set(pids)), 1, u'Задачи выполняются одним процессом без fork на каждую')
+        self.assertNotEqual(pids[0], str(self.pool_process.pid), u'Задачи выполняются не в процессе пула')
+        self._stop_pool(pool_name, _uuid)
+
+    def test_worker_max_jobs(self):
+        pool_name = 'test_prefork_max_jobs'
+        _uuid = self._start_pool(pool_name, **{self.config.POOL_WORKER_MAX_JOBS: '2'})
+        pids = self._get_job_pids(pool_name, 4)
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[1], pids[2], u'После worker_max_jobs задач процесс заменен новым')
+        self._stop_pool(pool_name, _uuid)
+
+    def test_worker_max_rss(self):
+        pool_name = 'test_prefork_max_rss'
+        # 1 мегабайт превышает любой процесс python - замена после каждой задачи
+        _uuid = self._start_pool(pool_name, **{self.config.POOL_WORKER_MAX_RSS: '1'})
+        pids = self._get_job_pids(pool_name, 3)
+        self.assertEqual(len(set(pids)), 3, u'Процесс, превысивший worker_max_rss, заменен новым')
+        self._stop_pool(pool_name, _uuid)
+
+    def test_push_back_on_stop(self):
+        pool_name = 'test_prefork_stop'
+        queue = QueueManager(connection=self.redis)
+        queue.push(pool_name, 1)
+        queue.push(pool_name, 2, priority=5)
+        pool = PreforkPool(config=self.config, name=pool_name)
+        worker = PreforkWorker(pool=pool)
+        pop_queued_job = pool.pop_queued_job
+
+        def pop_and_stop():
+            # SIGTERM пришел, пока процесс ждал задачу в очереди
+            result = pop_queued_job()
+            worker.stop()
+            return result
+
+        pool.pop_queued_job = pop_and_stop
+        worker.run()
+        self.assertEqual(worker.jobs_done, 0, u'Задача не выполнялась')
+        self.assertEqual(pool.pop_job(), (pool_name, '2'), u'Задача возвращена в очередь со своим приоритетом')
+        self.assertEqual(pool.pop_job(), (pool_name, '1'))
+
+
+class TestThreadPool(TestPoolBase):
+
+    def _wait_job_status(self, job, status):
+        self.check_for_timeout(
+            callback=lambda: decode_if_not_empty(self.redis.get('test_job {}'.format(job.id))),
+            check_func=lambda value: value == status,
+        )
+
+    def _run_concurrent_jobs(self, pool_name, job_cls):
+        # две задачи одновременно выполняются в одном процессе пула
+        jobs = [self._job_to_queue(pool_name, 2, job_cls=job_cls) for _ in range(2)]
+        for job in jobs:
+            self._wait_job_status(job, 'STARTED')
+        self.assertEqual([decode_if_not_empty(self.redis.get('test_job {}'.format(job.id))) for job in jobs],
+                         ['STARTED', 'STARTED'], u'Вторая задача началась до завершения первой')
+        for job in jobs:
+            self._wait_job_status(job, 'ENDED')
+        return jobs
+
+    def test_functional(self):
+        pool_name = 'test_thread'
+        _uuid = self._start_pool(pool_name, **{self.config.POOL_BACKEND: self.config.POOL_BACKEND_THREAD})
+        self._run_concurrent_jobs(pool_name, TestSleepJob)
+        job = self._job_to_queue(pool_name, job_cls=TestPidJob)
+        pid = self.check_for_timeout(
+            callback=lambda: decode_if_not_empty(self.redis.get('test_job_pid {}'.format(job.id))),
+        )
+        self.assertEqual(pid, str(self.pool_process.pid), u'Задача выполнена в процессе пула')
+        self._stop_pool(pool_name, _uuid)
+
+    def test_kill(self):
+        pool_name = 'test_thread_kill'
+        _uuid = self._start_pool(pool_name, **{self.config.POOL_BACKEND: self.config.POOL_BACKEND_THREAD})
+        job = self._job_to_queue(pool_name, 30)
+        self._wait_job_status(job, 'STARTED')
+        self.pool_status_manager.set_status(pool=pool_name, _uuid=_uuid, status=PoolStatusManager.STATUS_KILL)
+        self.assertEqual(self.pool_process.wait(), 1, u'Процесс пула завершен, не дожидаясь задачи')
+        pool_status = self.pool_status_manager.get_status(pool=pool_name, _uuid=_uuid)
+        self.assertEqual(pool_status, PoolStatusManager.STATUS_TERMITATED)
+        self.assertEqual(decode_if_not_empty(self.redis.get('test_job {}'.format(job.id))), 'STARTED')
+
+    def test_output_per_thread(self):
+        # capture_thread_output подменяет sys.stdout/sys.stderr на весь процесс
+        self.addCleanup(setattr, sys, 'stdout', sys.stdout)
+        self.addCleanup(setattr, sys, 'stderr', sys.stderr)
+        pool = ThreadPool(config=self.config, name='test_thread')
+        messages = []
+
+        class ListLog(object):
+            def info(self, msg):
+                messages.append(msg)
+
+        turns = [threading.Event(), threading.Event()]
+
+        def run_job(job_id, turn, next_turn):
+            workhorse = ThreadWorkhorse(pool=pool, job_id=job_id)
+            workhorse.log = ListLog()
+            stream = workhorse.create_output()
+            try:
+                with workhorse.capture(stream):
+                    # потоки печатают по очереди, вывод перемешан во времени
+                    for line in range(2):
+                        turn.wait(5)
+                        turn.clear()
+                        print('job {} line {}'.format(job_id, line))
+                        next_turn.set()
+            finally:
+                stream.close()
+
+        threads = [
+            threading.Thread(target=run_job, args=(1, turns[0], turns[1])),
+            threading.Thread(target=run_job, args=(2, turns[1], turns[0])),
+        ]
+        for thread in threads:
+            thread.start()
+        turns[0].set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(messages), [
+            u'Got output for job #1: \njob 1 line 0\njob 1 line 1\n',
+            u'Got output for job #2: \njob 2 line 0\njob 2 line 1\n',
+        ], u'Каждая задача получила только вывод своего потока')
+
+    @skipIf(sys.version_info < (3, 5), 'asyncio backend requires python 3.5+')
+    def test_asyncio(self):
+        pool_name = 'test_asyncio'
+        _uuid = self._start_pool(pool_name, **{self.config.POOL_BACKEND: self.config.POOL_BACKEND_ASYNCIO})
+        jobs = self._run_concurrent_jobs(pool_name, TestAsyncSleepJob)
+        self._stop_pool(pool_name, _uuid)
+        for job in jobs:
+            job_entry = JobEntry.get(JobEntry.id == job.id)
+            self.assertEqual(job_entry.status, JobEntry.STATUS_ENDED, u'Корутина задачи выполнена до конца')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from shire.job import DummyWorkhorse
+from shire.models import JobEntry
+from shire.recorder import Recorder
+from shire.redis_managers import JobEventManager
+from shire.workhorse import WorkhorseStatusContext
+
+from tests.utils import TestBase
+
+
+class TestRecorder(TestBase):
+
+    def setUp(self):
+        self.redis.flushall()
+        self.config[self.config.SHIRE_SECTION][self.config.SHIRE_JOB_EVENTS] = '1'
+        self.config[self.config.RECORDER_SECTION] = {self.config.RECORDER_FLUSH_TIME: '0'}
+        self.manager = JobEventManager(self.redis)
+        self.recorder = Recorder(config=self.config)
+        self.recorder.manager.create_group()
+
+    def tearDown(self):
+        del self.config[self.config.SHIRE_SECTION][self.config.SHIRE_JOB_EVENTS]
+        del self.config[self.config.RECORDER_SECTION]
+
+    def create_job(self):
+        job_entry = JobEntry.create_job(file_path='test.py', file_cls='Test', pool='test', queue='test')
+        job_entry.save()
+        return job_entry
+
+    def test_status_context(self):
+        workhorse = DummyWorkhorse(self.config)
+        workhorse.job_entry = self.create_job()
+        with WorkhorseStatusContext(workhorse=workhorse):
+            self.assertEqual(
+                JobEntry.get(JobEntry.id == workhorse.job_entry.id).status, JobEntry.STATUS_NEW,
+                u'Workhorse не пишет статус в базу'
+            )
+        self.recorder.loop()
+        job_entry = JobEntry.get(JobEntry.id == workhorse.job_entry.id)
+        self.assertEqual(job_entry.status, JobEntry.STATUS_ENDED, u'Recorder применил последний статус')
+        self.assertEqual(job_entry.worker_uuid, workhorse.uuid, u'Поля из разных событий объединены')
+        self.assertEqual(self.redis.xlen(JobEventManager.STREAM_PATH), 0, u'Примененные события удалены')
+
+    def test_take_over_pending(self):
+        job_entry = self.create_job()
+        self.manager.emit(job_entry.id, status=JobEntry.STATUS_IN_PROGRESS)
+        self.manager.read('old_recorder', count=10)
+        self.manager.emit(job_entry.id, status=JobEntry.STATUS_ENDED)
+        self.recorder.take_over_pending()
+        self.assertEqual(
+            JobEntry.get(JobEntry.id == job_entry.id).status, JobEntry.STATUS_IN_PROGRESS,
+            u'Применены события прежнего процесса, новые - позже, по порядку'
+        )
+        self.assertEqual(self.manager.read('old_recorder', count=10, pending=True), [])
+        self.recorder.loop()
+        self.assertEqual(JobEntry.get(JobEntry.id == job_entry.id).status, JobEntry.STATUS_ENDED)
+
+    def test_batch(self):
+        jobs = [self.create_job() for i in range(3)]
+        updated_at = datetime.datetime(2017, 1, 1, 12, 30)
+        self.manager.emit(jobs[0].id, status=JobEntry.STATUS_IN_PROGRESS, worker_pid=10)
+        self.manager.emit(jobs[1].id, status=JobEntry.STATUS_RESTART, updated_at=updated_at)
+        self.manager.emit(jobs[0].id, status=JobEntry.STATUS_ENDED)
+        self.recorder.loop()
+        self.assertEqual(
+            [(x.status, x.worker_pid) for x in JobEntry.select().where(JobEntry.id << [x.id for x in jobs])
+             .order_by(JobEntry.id)],
+            [(JobEntry.STATUS_ENDED, 10), (JobEntry.STATUS_RESTART, 0), (JobEntry.STATUS_NEW, 0)],
+            u'Каждая задача получила свои значения'
+        )
+        self.assertEqual(JobEntry.get(JobEntry.id == jobs[1].id).updated_at, updated_at, u'Дата передана без потерь')
+
+    def test_pending(self):
+        job_entry = self.create_job()
+        self.manager.emit(job_entry.id, status=JobEntry.STATUS_ENDED)
+        # Recorder прочитал событие и упал, не записав его
+        self.manager.read(self.recorder.consumer, count=10)
+        self.assertEqual(self.recorder.loop(), [], u'Новых событий нет')
+        self.recorder.loop(pending=True)
+        self.assertEqual(JobEntry.get(JobEntry.id == job_entry.id).status, JobEntry.STATUS_ENDED)
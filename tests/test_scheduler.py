@@ -2,10 +2,12 @@
 import datetime
 
 import croniter
+import peewee
 
 from shire.models import JobEntry, Crontab
 from shire.pool import Pool
-from shire.scheduler import CrontabJob
+from shire.redis_managers import DelayQueueManager, SchedulerManager, WakeupManager, to_timestamp
+from shire.scheduler import CrontabJob, Scheduler
 from shire.workhorse import Workhorse
 from tests.app import jobs
 from tests.utils import TestBase
@@ -64,6 +66,42 @@ class TestScheduler(TestBase):
                 )
             prev_start_time = job.execute_at
 
+    def test_next_run_at(self):
+        # кронтаб, которому еще рано запускаться, планировщик не выбирает
+        yearly = Crontab(key='test_yearly', cron_string=self.cron_string, pool=self.pool.name, queue='yearly',
+                         host='default')
+        yearly.func_call = self.crontab.func_call
+        yearly.save()
+        Crontab.update(next_run_at=self.started_at + datetime.timedelta(days=1)).where(
+            Crontab.id == yearly.id
+        ).execute()
+        self.redis.flushall()
+        self.test_first_run()
+        first_run = JobEntry.select(peewee.fn.MIN(JobEntry.execute_at)).where(
+            JobEntry.queue == 'default'
+        ).scalar(convert=True)
+        self.assertIn(
+            (self.pool.name, to_timestamp(first_run)), WakeupManager(self.redis).wait('default', 1),
+            u'whip получил сигнал о ближайшем запуске'
+        )
+
+        self.assertEqual(JobEntry.select().where(JobEntry.queue == 'yearly').count(), 0)
+        yearly = Crontab.get(Crontab.id == yearly.id)
+        self.assertIsNone(yearly.last_scheduled, u'Кронтаб не выбран планировщиком')
+        crontab = Crontab.get(Crontab.id == self.crontab.id)
+        self.assertEqual(
+            crontab.next_run_at, crontab.last_scheduled + datetime.timedelta(minutes=self.ONCE_AT_MINUTES),
+            u'Ближайший запуск записан вместе с last_scheduled'
+        )
+
+    def test_scheduler_alive(self):
+        # Кронтабы запускает run_scheduler - CrontabJob ничего не делает и не перезапускает себя
+        SchedulerManager(self.redis).mark_alive(60)
+        self.addCleanup(self.redis.flushall)
+        workhorse = Workhorse(pool=self.pool, job_id=self.crontab_job.id)
+        workhorse.run()
+        self.assertEqual(JobEntry.select().where(JobEntry.execute_at > self.started_at).count(), 0)
+
     def test_other_run(self):
         # ставим задачи на половинное время в будущее - как буд-то они были поставлены в прошлый раз
         schedule_from = self.started_at
@@ -102,3 +140,77 @@ class TestScheduler(TestBase):
         self.crontab.last_scheduled = last_run
         self.crontab.save()
         return last_run
+
+
+class TestSchedulerDaemon(TestBase):
+    ONCE_AT_MINUTES = 10
+
+    def setUp(self):
+        self.redis.flushall()
+        self.crontab = Crontab(
+            key='test_crontab_job',
+            cron_string='*/{} * * * *'.format(self.ONCE_AT_MINUTES),
+            pool='test_pool',
+            queue='default',
+            host='default',
+        )
+        self.crontab.func_call = JobEntry.make_func_call(
+            file_path=jobs.__file__, file_cls=jobs.TestScheduledJob.__name__
+        )
+        self.crontab.save()
+        self.scheduler = Scheduler(config=self.config)
+
+    def tearDown(self):
+        Crontab.truncate_table()
+        JobEntry.truncate_table()
+
+    def test_fire_due(self):
+        self.scheduler.load_crontabs()
+        run_at = self.crontab.next_run_at
+        self.assertEqual(self.scheduler.heap, [(run_at, self.crontab.id)])
+        self.assertEqual(self.scheduler.fire_due(now=run_at - datetime.timedelta(seconds=1)), 0)
+        self.assertEqual(JobEntry.select().count(), 0, u'Будущие задачи заранее не создаются')
+
+        self.assertEqual(self.scheduler.fire_due(now=run_at), 1)
+        job_entry = JobEntry.get()
+        self.assertEqual(job_entry.execute_at, run_at)
+        self.assertEqual(job_entry.status, JobEntry.STATUS_NEW)
+        self.assertIsNotNone(job_entry.updated_at, u'Время записи проставлено')
+        self.assertEqual(job_entry.func_call[JobEntry.FUNC_CALL_CLASS], jobs.TestScheduledJob.__name__)
+        next_run = run_at + datetime.timedelta(minutes=self.ONCE_AT_MINUTES)
+        self.assertEqual(self.scheduler.heap, [(next_run, self.crontab.id)])
+        crontab = Crontab.get(Crontab.id == self.crontab.id)
+        self.assertEqual((crontab.last_scheduled, crontab.next_run_at), (run_at, next_run), u'Запуск записан в базу')
+        self.assertEqual(
+            [pool for pool, timestamp in WakeupManager(self.redis).wait('default', 1)], ['test_pool'],
+            u'whip получил сигнал'
+        )
+
+    def test_stop_crontab_job(self):
+        running = CrontabJob.start_crontab(config=self.config, pool='test_pool')
+        JobEntry.update(status=JobEntry.STATUS_IN_PROGRESS).where(JobEntry.id == running.id).execute()
+        delayed = CrontabJob.start_crontab(config=self.config, pool='test_pool', wait_minutes=30)
+        JobEntry.update(status=JobEntry.STATUS_DELAYED).where(JobEntry.id == delayed.id).execute()
+        delay_queue = DelayQueueManager(self.redis)
+        delay_queue.add(
+            host=delayed.host, job_id=delayed.id, pool=delayed.pool, queue=delayed.queue,
+            execute_at=delayed.execute_at, priority=delayed.priority
+        )
+        self.assertEqual(self.scheduler.stop_crontab_job(), 1, u'Выполняющийся CrontabJob дожидаемся')
+        self.assertEqual([x.id for x in JobEntry.select()], [running.id])
+        self.assertIsNone(delay_queue.get_next_time(delayed.host), u'Отложенный CrontabJob убран и из redis')
+
+    def test_missed_runs(self):
+        # scheduler не работал полчаса - пропущенные запуски создаются все
+        last_scheduled = datetime.datetime.now().replace(second=0, microsecond=0) - datetime.timedelta(minutes=40)
+        last_scheduled -= datetime.timedelta(minutes=last_scheduled.minute % self.ONCE_AT_MINUTES)
+        self.crontab.last_scheduled = last_scheduled
+        self.crontab.save()
+        CrontabJob.start_crontab(config=self.config, pool='test_pool')
+        self.scheduler.stop_crontab_job()
+        self.scheduler.load_crontabs()
+        self.scheduler.fire_due(now=last_scheduled + datetime.timedelta(minutes=3 * self.ONCE_AT_MINUTES))
+        self.assertEqual(
+            [x.execute_at for x in JobEntry.select().order_by(JobEntry.execute_at)],
+            [last_scheduled + datetime.timedelta(minutes=i * self.ONCE_AT_MINUTES) for i in range(1, 4)]
+        )
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+from unittest import TestCase
+
+from shire.config import Config
+from shire.redis_managers import LogStreamManager
+from shire.scribe import Scribe
+
+from tests.utils import TestConfig
+
+
+def make_log(message):
+    return json.dumps({
+        'created': time.time(), 'name': 'test', 'pathname': 'test.py', 'lineno': 1,
+        'levelname': 'INFO', 'message': message,
+    })
+
+
+class TestScribeBatch(TestCase):
+    TEST_POOL = 'test'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = TestConfig()
+        self.config.make_default()
+        self.config[self.config.SCRIBE_SECTION][self.config.SCRIBE_DIRECTORY] = self.tmp_dir
+        self.config[self.config.SCRIBE_SECTION][self.config.SCRIBE_MAX_SIZE] = '1000'
+        self.scribe = Scribe(self.config)
+
+    def tearDown(self):
+        for handler in self.scribe.handlers.values():
+            handler.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_batch(self):
+        self.scribe.write_batch([(self.TEST_POOL, make_log('message {}'.format(i))) for i in range(3)])
+        with open(os.path.join(self.tmp_dir, '{}.log'.format(self.TEST_POOL))) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 3, u'Все записи пачки записаны')
+        self.assertTrue(lines[0].endswith('message 0'), u'Порядок записей сохранен')
+
+    def test_expired(self):
+        self.scribe.write_batch([(self.TEST_POOL, None), (self.TEST_POOL, make_log('message'))])
+        self.assertEqual(self.scribe.expired_logs_count, 1, u'Истекшая запись учтена')
+
+    def test_rollover(self):
+        self.scribe.write_batch([(self.TEST_POOL, make_log('x' * 100)) for i in range(20)])
+        path = os.path.join(self.tmp_dir, '{}.log'.format(self.TEST_POOL))
+        self.assertTrue(os.path.exists(path + '.1'), u'Лог ротирован по размеру')
+        self.assertLess(os.path.getsize(path), 1000, u'Размер лога не превышает ограничение')
+
+
+class TestScribeStream(TestCase):
+    TEST_POOL = 'test'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # mockredis не поддерживает потоки, нужен настоящий redis
+        self.config = Config()
+        self.config.make_default()
+        self.config[Config.CONNECTION_SECTION][Config.CONNECTION_REDIS_URL] = 'redis://localhost:6379/15'
+        self.config[self.config.SCRIBE_SECTION][self.config.SCRIBE_DIRECTORY] = self.tmp_dir
+        self.config[self.config.LOGGER_SECTION] = {self.config.LOGGER_TRANSPORT: self.config.LOGGER_TRANSPORT_STREAM}
+        self.redis = self.config.get_redis()
+        self.redis.flushdb()
+        self.scribe = Scribe(self.config)
+        self.manager = LogStreamManager(self.redis)
+        self.manager.create_group()
+
+    def tearDown(self):
+        for handler in self.scribe.handlers.values():
+            handler.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_consumer(self):
+        self.assertEqual(
+            self.scribe.consumer, '{}:{}'.format(socket.gethostname(), os.getpid()), u'Свое имя у каждого процесса'
+        )
+
+    def test_claim_idle(self):
+        self.manager.write_many([(self.TEST_POOL, make_log('message {}'.format(i))) for i in range(3)])
+        self.manager.read('dead_scribe', count=10)
+        self.assertEqual(self.scribe.claim_idle(), 0, u'Записи живого scribe не забираются')
+        self.scribe.claim_time = 0
+        self.assertEqual(self.scribe.claim_idle(), 3, u'Записи упавшего scribe забраны')
+        with open(os.path.join(self.tmp_dir, '{}.log'.format(self.TEST_POOL))) as f:
+            self.assertEqual(len(f.read().splitlines()), 3, u'и записаны в лог')
+        self.assertEqual(self.manager.read(self.scribe.consumer, count=10, pending=True), [], u'Записи подтверждены')
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import time
+from unittest import TestCase
+
+from shire.utils import OutputFlusher, StreamingOutput
+
+
+class TestStreamingOutput(TestCase):
+
+    def setUp(self):
+        self.emitted = []
+
+    def create(self, **kwargs):
+        kwargs.setdefault('flush_time', 0)
+        return StreamingOutput(self.emitted.append, **kwargs)
+
+    def test_lines(self):
+        stream = self.create()
+        stream.write('first\nsec')
+        self.assertEqual(self.emitted, ['first\n'], u'Целые строки отправлены сразу')
+        stream.write('ond')
+        stream.close()
+        self.assertEqual(self.emitted, ['first\n', 'second'], u'Незаконченная строка отправлена при закрытии')
+
+    def test_flush_time(self):
+        stream = self.create(flush_time=3600)
+        stream.write('first\n')
+        stream.write('second\n')
+        self.assertEqual(self.emitted, [], u'Строки копятся до flush_time')
+        stream.flush()
+        self.assertEqual(self.emitted, ['first\nsecond\n'], u'flush отправляет накопленные строки одной записью')
+
+    def test_flush_due(self):
+        # задача написала строку и надолго замолчала
+        stream = self.create(flush_time=0.1)
+        stream.write('first\n')
+        time.sleep(OutputFlusher.CHECK_TIME * 3)
+        self.assertEqual(self.emitted, ['first\n'], u'Строка отправлена без следующей записи')
+        stream.close()
+
+    def test_chunk_size(self):
+        stream = self.create(flush_time=3600, chunk_size=10)
+        stream.write('x' * 25)
+        self.assertEqual(self.emitted, ['x' * 25], u'Длинный вывод без переводов строк не копится в памяти')
+
+    def test_truncate_head(self):
+        stream = self.create(max_size=10)
+        for i in range(5):
+            stream.write('line {}\n'.format(i))
+        stream.close()
+        self.assertEqual(''.join(self.emitted[:-1]), 'line 0\nlin', u'Сохранено начало вывода')
+        self.assertEqual(self.emitted[-1], u'... 25 characters of output skipped ...')
+
+    def test_truncate_tail(self):
+        stream = self.create(max_size=10, truncate=StreamingOutput.TRUNCATE_TAIL)
+        for i in range(5):
+            stream.write('line {}\n'.format(i))
+            self.assertLessEqual(stream._tail_size, 10 + len('line 0\n'), u'Память ограничена')
+        self.assertEqual(self.emitted, [], u'Конец вывода известен только при закрытии')
+        stream.close()
+        self.assertEqual(
+            self.emitted, [u'... 25 characters of output skipped ...', ' 3\nline 4\n'], u'Сохранен конец вывода'
+        )
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import signal
+import threading
+import time
 
-from shire.redis_managers import QueueManager
-from shire.models import Limit, Queue, JobEntry
+from shire.redis_managers import DelayQueueManager, JobCounterManager, QueueManager, WakeupManager, to_timestamp
+from shire.models import db, Limit, Queue, JobEntry
+from shire.whip import Whip
 from tests.app.jobs import TestSleepJob
 from tests.utils import TestWithPid
 
@@ -19,6 +23,8 @@ class TestWhip(TestWithPid):
     def setUp(self):
         self.redis.flushall()
         self.config.save(self.config_path)
+        # Задачи, оставшиеся от других тестов, занимали бы лимиты
+        JobEntry.delete().execute()
 
         # Создаем очереди
         Queue.create(name=self.FIRST_QUEUE, pool=self.POOL)
@@ -86,3 +92,220 @@ class TestWhip(TestWithPid):
         self.check_for_timeout(
             callback=lambda: self.check_pid(self.active_pid), message=u'Whip завершен некорректно'
         )
+
+    def test_enqueue_jobs(self):
+        other_pool = 'other_test_pool'
+        jobs = [
+            TestSleepJob.delay(config=self.config, pool=self.POOL if i < 3 else other_pool, queue=self.FIRST_QUEUE)
+            for i in range(5)
+        ]
+        whip = Whip(config=self.config)
+        whip.enqueue_jobs(jobs)
+
+        for job in jobs:
+            self.assertEqual(
+                JobEntry.get(JobEntry.id == job.id).status, JobEntry.STATUS_ENQUEUED, u'Статус обновлен пачкой'
+            )
+        redis_queue = QueueManager(connection=self.redis)
+        self.assertEqual(
+            [int(x) for x in reversed(redis_queue.show_queue(self.POOL))], [x.id for x in jobs[:3]],
+            u'Задачи в redis в порядке постановки'
+        )
+        self.assertEqual(
+            [int(x) for x in reversed(redis_queue.show_queue(other_pool))], [x.id for x in jobs[3:]],
+            u'Задачи разложены по пулам'
+        )
+
+    def test_priority(self):
+        jobs = [
+            TestSleepJob.delay(config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE, priority=priority)
+            for priority in (0, 5, 20)
+        ]
+        self.assertEqual(
+            JobEntry.get(JobEntry.id == jobs[2].id).priority, JobEntry.PRIORITY_MAX, u'Приоритет ограничен сверху'
+        )
+        whip = Whip(config=self.config)
+        whip.enqueue_due_jobs()
+        redis_queue = QueueManager(connection=self.redis)
+        self.assertEqual(
+            [int(redis_queue.pop(self.POOL, timeout=1)) for job in jobs], [jobs[2].id, jobs[1].id, jobs[0].id],
+            u'Задачи с большим приоритетом забираются первыми'
+        )
+
+    def test_delay_many(self):
+        ids = TestSleepJob.delay_many(
+            config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE, chunk_size=2,
+            items=[((), {'sleep': i}) for i in range(5)]
+        )
+        self.assertEqual(len(ids), 5, u'Созданы все задачи')
+        self.assertEqual(
+            [JobEntry.get(JobEntry.id == job_id).get_params()[1]['sleep'] for job_id in ids], list(range(5)),
+            u'id задач соответствуют переданным параметрам'
+        )
+        self.assertNotIn(
+            None, [JobEntry.get(JobEntry.id == job_id).updated_at for job_id in ids], u'Время записи проставлено'
+        )
+        whip = Whip(config=self.config)
+        whip.enqueue_due_jobs()
+        redis_queue = QueueManager(connection=self.redis)
+        self.assertEqual(
+            sorted(int(x) for x in redis_queue.show_queue(self.POOL)), sorted(ids), u'Задачи поставлены в очередь'
+        )
+
+    def test_claim_off_by_default(self):
+        # База с блокировками строк (как Postgres/MySQL), но skip_locked не включен
+        db_cls = type(db.obj)
+        self.addCleanup(setattr, db_cls, 'for_update', db_cls.for_update)
+        db_cls.for_update = True
+        whip = Whip(config=self.config)
+        self.assertFalse(whip.use_claim, u'SKIP LOCKED только по настройке: MySQL до 8.0 его не поддерживает')
+        whip.claim_jobs = lambda job_entries: self.fail(u'Без skip_locked задачи ставятся без захвата строк')
+        jobs = [TestSleepJob.delay(config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE) for i in range(2)]
+        self.assertEqual([x.id for x in whip.enqueue_jobs(jobs)], [x.id for x in jobs])
+        self.assertEqual(
+            sorted(int(x) for x in QueueManager(connection=self.redis).show_queue(self.POOL)), [x.id for x in jobs]
+        )
+        self.assertEqual(
+            [JobEntry.get(JobEntry.id == x.id).status for x in jobs], [JobEntry.STATUS_ENQUEUED] * 2
+        )
+
+    def test_claimed_by_other_whip(self):
+        jobs = [TestSleepJob.delay(config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE) for i in range(2)]
+        whip = Whip(config=self.config)
+        # sqlite не умеет SKIP LOCKED - имитируем задачу, которую заблокировал другой whip
+        whip.use_claim = True
+        whip.claim_jobs = lambda job_entries: [x for x in job_entries if x.id != jobs[0].id]
+        self.assertEqual([x.id for x in whip.enqueue_jobs(jobs)], [jobs[1].id], u'Поставлена только захваченная задача')
+        self.assertEqual(
+            [int(x) for x in QueueManager(connection=self.redis).show_queue(self.POOL)], [jobs[1].id],
+            u'Чужая задача не попала в redis'
+        )
+        self.assertEqual(JobEntry.get(JobEntry.id == jobs[0].id).status, JobEntry.STATUS_NEW)
+        current = {'total': 2, 'by_pool': {self.POOL: 2}, 'by_queue': {self.FIRST_QUEUE: 2}}
+        whip.release_slots(jobs, [jobs[1]], current)
+        self.assertEqual(
+            current, {'total': 1, 'by_pool': {self.POOL: 1}, 'by_queue': {self.FIRST_QUEUE: 1}},
+            u'Слот чужой задачи освобожден'
+        )
+
+    def test_current_jobs_counters(self):
+        whip = Whip(config=self.config)
+        initial = whip.get_current_jobs()
+        jobs = [
+            TestSleepJob.delay(config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE)
+            for i in range(3)
+        ]
+        whip.enqueue_jobs(jobs)
+        current = whip.get_current_jobs()
+        self.assertEqual(current['total'], initial['total'] + 3, u'Постановка учтена без пересчета по базе')
+        self.assertEqual(current['by_queue'][self.FIRST_QUEUE], initial['by_queue'][self.FIRST_QUEUE] + 3)
+
+        JobCounterManager(self.redis).incr_completed({(self.POOL, self.FIRST_QUEUE): 2})
+        current = whip.get_current_jobs()
+        self.assertEqual(current['by_pool'][self.POOL], initial['by_pool'][self.POOL] + 1, u'Завершение учтено')
+
+        # Сверка с базой по GROUP BY дает тот же результат для поставленных задач
+        self.assertEqual(whip.load_current_jobs()['total'], initial['total'] + 3)
+
+    def test_reconcile_with_finished_job(self):
+        jobs = [TestSleepJob.delay(config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE) for i in range(2)]
+        whip = Whip(config=self.config)
+        whip.enqueue_jobs(jobs)
+        load_current_jobs = whip.load_current_jobs
+
+        def finish_job(job_entry):
+            # В порядке WorkhorseStatusContext: счетчик, затем статус
+            JobCounterManager(self.redis).incr_completed({(job_entry.pool, job_entry.queue): 1})
+            JobEntry.update(status=JobEntry.STATUS_ENDED).where(JobEntry.id == job_entry.id).execute()
+
+        def load_with_finish(before, after):
+            # Задачи завершаются между снимком счетчиков и запросом к базе и между запросом и снимком
+            def load():
+                for job_entry in before:
+                    finish_job(job_entry)
+                result = load_current_jobs()
+                for job_entry in after:
+                    finish_job(job_entry)
+                return result
+            return load
+
+        whip.load_current_jobs = load_with_finish([jobs[0]], [])
+        whip.reconcile_current_jobs()
+        self.assertEqual(whip.get_current_jobs()['by_queue'][self.FIRST_QUEUE], 1, u'Завершение не учтено дважды')
+
+        whip.load_current_jobs = load_with_finish([], [jobs[1]])
+        whip.reconcile_current_jobs()
+        self.assertEqual(
+            whip.get_current_jobs()['by_queue'][self.FIRST_QUEUE], 1, u'Нагрузка переоценена до следующей сверки'
+        )
+        whip.load_current_jobs = load_current_jobs
+        whip.reconcile_current_jobs()
+        self.assertEqual(whip.get_current_jobs()['by_queue'][self.FIRST_QUEUE], 0)
+
+    def test_move_due(self):
+        delay_queue = DelayQueueManager(self.redis)
+        past = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        delay_queue.add(host='default', job_id=1, pool=self.POOL, queue=self.FIRST_QUEUE, execute_at=past)
+        delay_queue.add(host='default', job_id=2, pool=self.POOL, queue=self.FIRST_QUEUE, execute_at=past, priority=5)
+        delay_queue.add(host='default', job_id=3, pool=self.POOL, queue=self.SECOND_QUEUE, execute_at=past)
+        delay_queue.add(
+            host='default', job_id=4, pool=self.POOL, queue=self.FIRST_QUEUE,
+            execute_at=datetime.datetime.now() + datetime.timedelta(hours=1)
+        )
+        moved = delay_queue.move_due('default', {'total': -1, 'pools': {}, 'queues': {self.SECOND_QUEUE: 0}})
+        self.assertEqual(sorted(moved), [(1, self.POOL, self.FIRST_QUEUE), (2, self.POOL, self.FIRST_QUEUE)])
+        self.assertEqual(
+            [int(x) for x in self.redis.lrange(QueueManager.get_key(self.POOL, 5), 0, -1)], [2],
+            u'Задача попала в очередь своего приоритета'
+        )
+        self.assertEqual([int(x) for x in self.redis.lrange(QueueManager.get_key(self.POOL), 0, -1)], [1])
+        self.assertEqual(
+            self.redis.zcard(DelayQueueManager.PATH.format(host='default')), 2,
+            u'Задача сверх лимита и будущая задача остались отложенными'
+        )
+
+    def _wakeup_whip(self):
+        # Сигналы от постановки задач в тесте не нужны: whip должен проснуться только от того, что проверяет тест
+        self.redis.delete(WakeupManager.PATH.format(host=JobEntry.HOST_DEFAULT))
+        whip = Whip(config=self.config)
+        whip.update_limits()
+        whip._next_execute_at = whip.get_next_execute_at()
+        return whip
+
+    def test_wakeup_notify(self):
+        job = TestSleepJob.delay(config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE)
+        whip = self._wakeup_whip()
+        self.assertIsNone(whip._next_execute_at, u'Будущих задач нет')
+        timer = threading.Timer(0.5, WakeupManager(self.redis).notify, kwargs=dict(
+            host=JobEntry.HOST_DEFAULT, pool=self.POOL
+        ))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        started_at = time.time()
+        whip.wait_for_wakeup(poll_time=30)
+        self.assertLess(time.time() - started_at, 5, u'whip разбужен сигналом, не дожидаясь poll_time')
+        whip.enqueue_due_jobs()
+        self.assertEqual(JobEntry.get(JobEntry.id == job.id).status, JobEntry.STATUS_ENQUEUED)
+
+    def test_wakeup_timeout(self):
+        job = TestSleepJob.delay(config=self.config, pool=self.POOL, queue=self.FIRST_QUEUE)
+        execute_at = datetime.datetime.now() + datetime.timedelta(seconds=2)
+        JobEntry.update(execute_at=execute_at).where(JobEntry.id == job.id).execute()
+        whip = self._wakeup_whip()
+        self.assertAlmostEqual(whip._next_execute_at, to_timestamp(execute_at), delta=1)
+
+        # Без сигнала whip просыпается к ближайшей отложенной задаче
+        started_at = time.time()
+        whip.wait_for_wakeup(poll_time=30)
+        self.assertGreaterEqual(time.time() - started_at, 1)
+        self.assertLess(time.time() - started_at, 5)
+        whip.enqueue_due_jobs()
+        self.assertEqual(JobEntry.get(JobEntry.id == job.id).status, JobEntry.STATUS_ENQUEUED)
+
+        # Без отложенных задач - по poll_time
+        whip._next_execute_at = whip.get_next_execute_at()
+        self.assertIsNone(whip._next_execute_at)
+        started_at = time.time()
+        whip.wait_for_wakeup(poll_time=2)
+        self.assertGreaterEqual(time.time() - started_at, 2)
+        self.assertLess(time.time() - started_at, 5)
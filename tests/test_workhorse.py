@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
+import datetime
+import sys
 
+from shire.job import DummyWorkhorse
+from shire.models import JobEntry
 from shire.pool import Pool
-from shire.workhorse import Workhorse
+from shire.redis_managers import JobCounterManager
+from shire.workhorse import Workhorse, WorkhorseStatusContext
 from tests.app.jobs import TestSleepJob
 from tests.utils import TestBase
 
@@ -23,3 +28,74 @@ class TestWorkhorse(TestBase):
         workhorse.run()
         status = self.redis.get('test_job {}'.format(self.job.id))
         self.assertEquals(status.decode(), 'ENDED')
+
+    def test_completed_counter(self):
+        counters = JobCounterManager(self.redis)
+        workhorse = Workhorse(pool=self.pool, job_id=self.job.id)
+        workhorse.job_entry = JobEntry.get(JobEntry.id == self.job.id)
+        with WorkhorseStatusContext(workhorse=workhorse):
+            pass
+        completed = lambda: counters.get_all()[JobCounterManager.KIND_COMPLETED]['total']
+        self.assertEqual(completed(), 1, u'Завершение задачи пула учтено')
+        dummy = DummyWorkhorse(self.config)
+        dummy.job_entry = JobEntry.get(JobEntry.id == self.job.id)
+        with WorkhorseStatusContext(workhorse=dummy):
+            pass
+        self.assertEqual(completed(), 1, u'Задача, выполненная минуя whip, не уменьшает нагрузку пула')
+
+    def test_output_log_error(self):
+        class BrokenLog(object):
+            def info(self, msg):
+                raise IOError('redis is down')
+
+        workhorse = Workhorse(pool=self.pool, job_id=self.job.id)
+        workhorse.log = BrokenLog()
+        stream = workhorse.create_output()
+        with workhorse.capture(stream):
+            print('output')
+            sys.stdout.flush()
+        stream.close()  # ошибка записи лога не дошла до задачи
+
+    def test_job_cls_cache(self):
+        self.assertIs(self.job.job_cls, self.job.job_cls, u'Модуль задачи не перезагружается без изменений')
+        self.assertIs(
+            self.job.get_job_cls(by_module=True), TestSleepJob, u'Класс задачи получен через стандартный импорт'
+        )
+
+    def test_tick(self):
+        workhorse = Workhorse(pool=self.pool, job_id=self.job.id)
+        workhorse.job_entry = JobEntry.get(JobEntry.id == self.job.id)
+        saves = []
+        save_job_entry = workhorse.save_job_entry
+
+        def counted_save(*args, **kwargs):
+            saves.append(args)
+            return save_job_entry(*args, **kwargs)
+
+        workhorse.save_job_entry = counted_save
+        job = TestSleepJob(workhorse=workhorse)
+        self.assertTrue(job.tick(), u'Первый tick записан')
+        self.assertEqual(len(saves), 1)
+        self.assertFalse(job.tick(), u'Повторный tick в пределах tick_interval не пишет в базу')
+        self.assertEqual(len(saves), 1)
+        self.assertTrue(job.tick(force=True))
+        self.assertEqual(len(saves), 2)
+
+    def test_pool_refresh(self):
+        hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+        JobEntry.update(
+            status=JobEntry.STATUS_IN_PROGRESS, pool_uuid=self.pool.uuid, worker_pid=100001, updated_at=hour_ago
+        ).where(JobEntry.id == self.job.id).execute()
+        other_job = TestSleepJob.delay(config=self.config, pool='test_pool', queue='abc')
+        JobEntry.update(
+            status=JobEntry.STATUS_IN_PROGRESS, pool_uuid=self.pool.uuid, worker_pid=100002, updated_at=hour_ago
+        ).where(JobEntry.id == other_job.id).execute()
+        self.pool._children = {100001: self.job.id}
+        self.pool.refresh_time = 60
+        self.pool.refresh_jobs()
+        self.assertGreater(
+            JobEntry.get(JobEntry.id == self.job.id).updated_at, hour_ago, u'Задача живого потомка обновлена'
+        )
+        self.assertEqual(
+            JobEntry.get(JobEntry.id == other_job.id).updated_at, hour_ago, u'Задача без живого процесса не обновлена'
+        )